@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+BCPL asyncio Front End
+
+Runs BCPL programs under asyncio, with SYSIN read from an
+asyncio.StreamReader and SYSPRINT written to an asyncio.StreamWriter, so
+that one event loop can serve many interactive sessions.  A program runs
+a quantum of steps at a time (see Machine.run_slice()), handing the loop
+back in between.  When it reads input that has not arrived, it waits on
+the reader, and its output is drained to the writer after each slice,
+so a client that reads slowly holds up only its own session.
+
+Given INTCODE files, serves each TCP connection a session running them,
+with the run limits given (see icint.py).  Needs Python 3.7 or later.
+
+Usage: python3 bcplasync.py ICFILE... [-aADDRESS] [-pPORT] [--max-...=N]
+"""
+
+import sys
+import io
+import asyncio
+
+from icint import (Machine, findfile, limit_option, LIMIT_OPTIONS,
+                   STR_NO_ICFILE)
+from bcplsched import QUANTUM, SessionInput
+
+STR_USAGE = ("USAGE: python bcplasync.py ICFILE... [-aADDRESS] [-pPORT] "
+             "[--max-...=N]")
+
+HOST = "127.0.0.1"
+PORT = 7070
+
+# Most input taken from the reader at a time
+READ_SIZE = 4096
+
+async def run(program, reader, writer, quantum=QUANTUM, limits=None,
+              **options):
+    """Run a program with SYSIN from reader and SYSPRINT to writer.
+
+    program is an INTCODE file, or a list of them to load in turn.
+    limits maps run limits, Machine attributes such as time_limit, to
+    their values; other keyword arguments go to Machine().  Returns the
+    exit code.  The writer is drained but left open.
+    """
+    if isinstance(program, str):
+        program = [program]
+    stdin = SessionInput()
+    stdout = io.BytesIO()
+    vm = Machine(stdin=stdin, stdout=stdout, **options)
+    for name, value in (limits or {}).items():
+        setattr(vm, name, value)
+    try:
+        for fn in program:
+            if not vm.load(fn):
+                raise OSError("%s %s" % (STR_NO_ICFILE, fn))
+    except SystemExit as e:
+        return e.code
+    while True:
+        try:
+            status = vm.run_slice(quantum)
+        except SystemExit as e:
+            # halt() ends only this program
+            status = e.code
+        data = stdout.getvalue()
+        if data:
+            stdout.seek(0)
+            stdout.truncate()
+            writer.write(data)
+            await writer.drain()
+        if status is not None:
+            break
+        if vm.waiting and not stdin.ready():
+            data = await reader.read(READ_SIZE)
+            if data:
+                stdin.feed(data)
+            else:
+                stdin.close()
+        else:
+            # Let the other sessions have their turn
+            await asyncio.sleep(0)
+    return status
+
+async def serve(program, host=HOST, port=PORT, **kwargs):
+    """Run program for every connection to host:port, until cancelled.
+
+    Keyword arguments are passed on to run().
+    """
+    async def session(reader, writer):
+        try:
+            await run(program, reader, writer, **kwargs)
+        except OSError:
+            # A lost connection or missing file ends only this session
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(session, host, port)
+    async with server:
+        await server.serve_forever()
+
+def main():
+    """Main entry point."""
+    files = []
+    host = HOST
+    port = PORT
+    limits = {}
+    for arg in sys.argv[1:]:
+        if arg.startswith('-p') and arg[2:].isdigit():
+            port = int(arg[2:])
+        elif arg.startswith('-a') and len(arg) > 2:
+            host = arg[2:]
+        elif arg.split('=')[0] in LIMIT_OPTIONS:
+            try:
+                name, value = limit_option(arg)
+            except ValueError:
+                print(STR_USAGE)
+                sys.exit(1)
+            limits[name] = value
+        elif not arg.startswith('-'):
+            files.append(arg)
+        else:
+            print(STR_USAGE)
+            sys.exit(1)
+    if not files:
+        print(STR_USAGE)
+        sys.exit(0)
+    for fn in files:
+        if findfile(fn) is None:
+            sys.stderr.write("%s %s\n" % (STR_NO_ICFILE, fn))
+            sys.exit(1)
+    try:
+        asyncio.run(serve(files, host, port, limits=limits))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""
+BCPL Build Tool
+
+Builds a program from BCPL modules compiled separately.  Each module
+FILE.b is compiled to an INTCODE unit of its own, FILE.ic (see bcplc.py),
+and the units are linked into one program: their sections, one after
+another, in a single INTCODE file.  The sections share the global vector,
+so modules call each other's routines through globals declared in a
+header they all GET.
+
+Only the modules that changed since the last build are compiled again.  A
+module has changed when its text, that of a file it GETs (directly or
+not) or the compiler has; what each unit was built from is recorded next
+to the program, in PROGRAM.deps.  Linking fails if two modules assign the
+same global, or none of them assigns START.
+
+Usage: python3 bcplbuild.py SOURCE... [-oPROGRAM] [-jN] [-n] [-O0]
+"""
+
+import sys
+import os
+import re
+import json
+import hashlib
+
+from bcplc import batch_output, compile_batch
+from bcplcache import CompileCache, sources
+from icint import K01_START, ASM_COMMENT
+
+STR_USAGE = ("USAGE: python bcplbuild.py SOURCE... [-oPROGRAM] [-jN] [-n] "
+             "[-O0]")
+STR_NO_START = "NO START"
+STR_GLOBAL_CONFLICT = "GLOBAL ASSIGNED TWICE"
+
+PROGRAM = "INTCODE"
+DEPS_SUFFIX = ".deps"
+
+# G directives, Gn Lm, which set global n to the address of label m.  The
+# G of an instruction (LG, LIG, ...) follows its letters.
+ASM_GLOBAL = re.compile(rb'(?<![A-Z])G(\d+)L\d+')
+
+# ============================================================================
+# Dependencies
+# ============================================================================
+
+def _digest(path):
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except OSError:
+        return None
+
+def read_deps(program):
+    """Return the units recorded for program, as {source: record}."""
+    try:
+        with open(program + DEPS_SUFFIX) as f:
+            return json.load(f)["units"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return {}
+
+def write_deps(program, units):
+    """Record units, as read_deps() returns them, for program."""
+    path = program + DEPS_SUFFIX
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    try:
+        with open(tmp, 'w') as f:
+            json.dump({"units": units}, f, indent=1, sort_keys=True)
+            f.write("\n")
+        os.replace(tmp, path)
+    except OSError:
+        # Without the record the next build just compiles everything
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+def unit_record(source, key):
+    """Return what the unit of source was built from, key being its
+    compile cache key."""
+    return {"key": key,
+            "gets": [name for name, _ in sources(source)[1:]],
+            "intcode": _digest(batch_output(source))}
+
+def stale(source, key, units):
+    """Check whether the unit of source must be compiled again.
+
+    It must unless the record in units has the same key, and the unit is
+    as it was written then.
+    """
+    record = units.get(source)
+    return (record is None or record.get("key") != key
+            or record.get("intcode") != _digest(batch_output(source)))
+
+# ============================================================================
+# Linking
+# ============================================================================
+
+def unit_globals(intcode):
+    """Return the globals the G directives of INTCODE text assign."""
+    text = ASM_COMMENT.sub(b"", intcode.replace(b"\r", b"\n"))
+    return [int(n) for n in ASM_GLOBAL.findall(text)]
+
+def link_errors(units):
+    """Return the errors linking units, a list of (name, INTCODE), would
+    give, one line each."""
+    errors = []
+    owner = {}
+    for name, intcode in units:
+        for g in unit_globals(intcode):
+            if g in owner and owner[g] != name:
+                errors.append("%s G%d IN %s AND %s"
+                              % (STR_GLOBAL_CONFLICT, g, owner[g], name))
+            owner.setdefault(g, name)
+    if K01_START not in owner:
+        errors.append(STR_NO_START)
+    return errors
+
+def link(units, program):
+    """Link units, a list of (name, INTCODE), into the file program.
+
+    Returns the errors, as link_errors() does; the program is only
+    written if there are none.
+    """
+    errors = link_errors(units)
+    if errors:
+        return errors
+    tmp = "%s.%d.tmp" % (program, os.getpid())
+    with open(tmp, 'wb') as f:
+        for _, intcode in units:
+            f.write(intcode)
+            if not intcode.endswith((b"\n", b"\r")):
+                f.write(b"\n")
+    os.replace(tmp, program)
+    return []
+
+# ============================================================================
+# Build
+# ============================================================================
+
+def build(modules, program=PROGRAM, jobs=1, out=None, cached=True,
+          optimized=True):
+    """Bring the units of modules and the program linked from them up to
+    date.
+
+    The modules that changed are compiled jobs at a time, as
+    compile_batch() does with cached and optimized, and listed on out,
+    by default standard output, along with those that had not.  Link
+    errors go to standard error.
+    Returns the exit code of the first module that failed to compile, 1
+    if linking failed, or 0.
+    """
+    if out is None:
+        out = sys.stdout.buffer
+    cache = CompileCache()
+    units = read_deps(program)
+    keys = {}
+    todo = []
+    for source in modules:
+        if os.path.isfile(source):
+            keys[source] = cache.key(source, optimized)
+            if not stale(source, keys[source], units):
+                out.write(("%s -> %s: UP TO DATE\n"
+                           % (source, batch_output(source))).encode())
+                continue
+        todo.append(source)
+    out.flush()
+    if todo:
+        status = compile_batch(todo, jobs, out, cached, optimized)
+        if status:
+            return status
+        for source in todo:
+            units[source] = unit_record(source, keys[source])
+    write_deps(program, {source: units[source] for source in modules})
+
+    linked = []
+    for source in modules:
+        with open(batch_output(source), 'rb') as f:
+            linked.append((source, f.read()))
+    errors = link(linked, program)
+    for error in errors:
+        sys.stderr.write(error + "\n")
+    if errors:
+        return 1
+    out.write(("LINKED %d UNITS -> %s\n" % (len(linked), program)).encode())
+    out.flush()
+    return 0
+
+def main():
+    """Main entry point."""
+    modules = []
+    program = PROGRAM
+    jobs = 1
+    cached = True
+    optimized = True
+    for arg in sys.argv[1:]:
+        if arg.startswith('-o') and len(arg) > 2:
+            program = arg[2:]
+        elif arg == '-j':
+            jobs = os.cpu_count() or 1
+        elif arg.startswith('-j') and arg[2:].isdigit() and int(arg[2:]) > 0:
+            jobs = int(arg[2:])
+        elif arg == '-n':
+            cached = False
+        elif arg == '-O0':
+            optimized = False
+        elif not arg.startswith('-') and arg not in modules:
+            modules.append(arg)
+        else:
+            print(STR_USAGE)
+            sys.exit(1)
+    if not modules:
+        print(STR_USAGE)
+        sys.exit(0)
+    if program in map(batch_output, modules):
+        print(STR_USAGE)
+        sys.exit(1)
+    sys.exit(build(modules, program, jobs, cached=cached,
+                   optimized=optimized))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+"""
+BCPL Compiler Driver
+
+Compiles a BCPL source file to INTCODE in a single process.  The front end
+(syni + trni) and the code generator (cgi) run at the same time, each on
+its own icint Machine, and the OCODE passes between them through a bounded
+in-memory channel instead of the OCODE file.  On its way the OCODE is
+improved by the optimizer in bcplopt.py, a section at a time on a third
+thread, so cgi starts on the first section while the front end works on
+the rest.  The INTCODE cgi writes is improved by the peephole optimizer
+in bcplpeep.py.  -O0 turns both off.
+
+Given several sources, each FILE.b is compiled to FILE.ic, N files at a
+time with -jN, each in its own worker process.
+
+Results are kept in the compile cache (see bcplcache.py), so compiling
+unchanged source again only copies out its INTCODE; -n bypasses the cache.
+
+Usage: python3 bcplc.py SOURCE... [-oINTCODE] [-jN] [-n] [-O0]
+"""
+
+import sys
+import os
+import io
+import time
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from icint import Machine, STR_NO_ICFILE
+from bcplcache import CompileCache
+from bcplopt import optimize_ocode, section_end
+from bcplpeep import optimize_intcode
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FRONT_END = [os.path.join(HERE, "syni"), os.path.join(HERE, "trni")]
+CODE_GENERATOR = [os.path.join(HERE, "cgi")]
+
+STR_USAGE = "USAGE: python bcplc.py SOURCE... [-oINTCODE] [-jN] [-n] [-O0]"
+
+# Suffix of the INTCODE files written when compiling several sources
+BATCH_SUFFIX = ".ic"
+
+# The channel holds at most CHANNEL_CHUNKS chunks of CHUNK_SIZE bytes
+CHUNK_SIZE = 4096
+CHANNEL_CHUNKS = 16
+
+# ============================================================================
+# OCODE Channel
+# ============================================================================
+
+class Channel:
+    """Bounded byte stream from one interpreter thread to another.
+
+    Provides the read()/write()/flush()/close() subset of a binary file
+    that icint uses for its streams.  Writes are gathered into chunks, so
+    the reader only takes the lock once per chunk; a writer that gets
+    CHANNEL_CHUNKS chunks ahead waits for the reader to catch up.
+    """
+
+    def __init__(self, chunks=CHANNEL_CHUNKS):
+        self._chunks = queue.Queue(chunks)
+        self._out = bytearray()
+        self._in = b""
+        self._pos = 0
+        self._eof = False
+        self._closed = False
+        self._aborted = False
+
+    def write(self, data):
+        if self._aborted:
+            return len(data)
+        self._out += data
+        if len(self._out) >= CHUNK_SIZE:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if self._out and not self._aborted:
+            self._chunks.put(bytes(self._out))
+        self._out.clear()
+
+    def close(self):
+        """End the stream; the reader sees end of file after the data."""
+        if not self._closed:
+            self._closed = True
+            self.flush()
+            if not self._aborted:
+                self._chunks.put(b"")
+
+    def abort(self):
+        """Give up on the stream, unblocking and discarding any writes."""
+        self._aborted = True
+        while True:
+            try:
+                self._chunks.get_nowait()
+            except queue.Empty:
+                break
+
+    def read(self, n=-1):
+        if n < 0:
+            data = bytearray()
+            while True:
+                chunk = self.read(CHUNK_SIZE)
+                if not chunk:
+                    return bytes(data)
+                data += chunk
+        if self._pos >= len(self._in):
+            if self._eof:
+                return b""
+            self._in = self._chunks.get()
+            self._pos = 0
+            if not self._in:
+                self._eof = True
+                return b""
+        data = self._in[self._pos:self._pos + n]
+        self._pos += len(data)
+        return data
+
+# ============================================================================
+# Driver
+# ============================================================================
+
+def _stage(vm, files, status, done):
+    """Load and run one compiler stage, recording its exit code in status."""
+    try:
+        for fn in files:
+            if not vm.load(fn):
+                vm.halt(STR_NO_ICFILE)
+        status.append(vm.run())
+    except SystemExit as e:
+        status.append(e.code)
+    finally:
+        done()
+
+def _optimize_section(text):
+    """Return the OCODE text optimized, or as it was should the optimizer
+    fail on it."""
+    try:
+        return optimize_ocode(text)
+    except Exception:
+        return text
+
+def _optimize(ocode, optimized, status):
+    """Pass the OCODE from one channel on to another, optimized a section
+    at a time, recording 0 in status once it has all gone."""
+    try:
+        pending = b""
+        while True:
+            chunk = ocode.read(CHUNK_SIZE)
+            pending += chunk
+            end = section_end(pending)
+            while end is not None:
+                optimized.write(_optimize_section(pending[:end]))
+                optimized.flush()
+                pending = pending[end:]
+                end = section_end(pending)
+            if not chunk:
+                break
+        if pending.strip():
+            optimized.write(_optimize_section(pending))
+        status.append(0)
+    finally:
+        # Should the optimizer stop, the front end must not wait for it
+        ocode.abort()
+        optimized.close()
+
+def compile_file(source, intcode="INTCODE", out=None, cache=None,
+                 optimized=True):
+    """Compile the BCPL file source to INTCODE.
+
+    The front end's listing and then the code generator's go to out,
+    by default standard output.  optimized says whether to put the OCODE
+    through the optimizer on the way, and the INTCODE through the
+    peephole optimizer.  With a CompileCache, source that was compiled
+    before is not compiled again: the INTCODE and listings are taken from
+    the cache.  Returns the exit code of the first stage that failed, or
+    0.
+    """
+    if out is None:
+        out = sys.stdout.buffer
+    if cache is not None:
+        key = cache.key(source, optimized)
+        hit = cache.get(key)
+        if hit is not None:
+            listings, code = hit
+            with open(intcode, 'wb') as f:
+                f.write(code)
+            out.write(b"".join(listings))
+            out.flush()
+            return 0
+    channel = Channel()
+    ocode = Channel() if optimized else channel
+    listings = [io.BytesIO(), io.BytesIO()]
+    front = Machine(stdout=listings[0])
+    back = Machine(stdout=listings[1])
+    front.named_streams["OCODE"] = channel
+    back.named_streams["OCODE"] = ocode
+    back.named_streams["INTCODE"] = open(intcode, 'wb')
+    front.pipeinput(source)
+    back.pipeinput("OCODE")
+
+    front_status = []
+    back_status = []
+    optimizer_status = []
+    threads = [
+        threading.Thread(target=_stage,
+                         args=(front, FRONT_END, front_status, channel.close)),
+        # If cgi stops early, the front end must not wait for it forever
+        threading.Thread(target=_stage,
+                         args=(back, CODE_GENERATOR, back_status, ocode.abort)),
+    ]
+    if optimized:
+        threads.append(threading.Thread(target=_optimize,
+                                        args=(channel, ocode,
+                                              optimizer_status)))
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    back.named_streams["INTCODE"].close()
+    listings = [f.getvalue() for f in listings]
+    out.write(b"".join(listings))
+    out.flush()
+
+    # What the optimizer did not pass on, cgi never saw
+    stages = [front_status, back_status]
+    if optimized:
+        stages.insert(1, optimizer_status)
+    for status in stages:
+        if not status:
+            return 1
+        if status[0]:
+            return status[0]
+    if optimized or cache is not None:
+        with open(intcode, 'rb') as f:
+            code = f.read()
+        if optimized:
+            code = optimize_intcode(code)
+            with open(intcode, 'wb') as f:
+                f.write(code)
+        if cache is not None:
+            cache.put(key, listings, code)
+    return 0
+
+# ============================================================================
+# Batch Compilation
+# ============================================================================
+
+def batch_output(source):
+    """Return the INTCODE file that a batch compile of source writes."""
+    stem, ext = os.path.splitext(source)
+    if ext.lower() != ".b":
+        stem = source
+    return stem + BATCH_SUFFIX
+
+def _batch_job(source, intcode, cached, optimized):
+    """Compile one file of a batch.
+
+    Returns (exit code, listing, seconds taken).  Everything the job
+    writes other than intcode stays in memory, so jobs running at the
+    same time in one directory cannot get in each other's way.
+    """
+    start = time.perf_counter()
+    listing = io.BytesIO()
+    if os.path.isfile(source):
+        cache = CompileCache() if cached else None
+        status = compile_file(source, intcode, listing, cache, optimized)
+    else:
+        listing.write(b"NO INPUT\n")
+        status = 1
+    return status, listing.getvalue(), time.perf_counter() - start
+
+def compile_batch(sources, jobs=1, out=None, cached=True, optimized=True):
+    """Compile each file in sources to its batch_output(), jobs at a time.
+
+    With jobs above 1 the files are compiled in a pool of worker
+    processes.  cached says whether to use the compile cache, and
+    optimized whether to use the optimizers.  For each
+    file in turn, its listing and then a line with the result and time
+    taken go to out, by default standard output.  Returns the exit code
+    of the first file that failed, or 0.
+    """
+    if out is None:
+        out = sys.stdout.buffer
+    targets = [batch_output(source) for source in sources]
+    pool = None
+    if jobs > 1 and len(sources) > 1:
+        pool = ProcessPoolExecutor(min(jobs, len(sources)))
+        results = pool.map(_batch_job, sources, targets,
+                           [cached] * len(sources),
+                           [optimized] * len(sources))
+    else:
+        results = map(_batch_job, sources, targets, [cached] * len(sources),
+                      [optimized] * len(sources))
+    result = 0
+    try:
+        for source, target, (status, listing, seconds) in zip(
+                sources, targets, results):
+            outcome = "OK" if not status else "FAILED (%s)" % status
+            out.write(listing)
+            out.write(("%s -> %s: %s %.2fs\n"
+                       % (source, target, outcome, seconds)).encode())
+            out.flush()
+            if status and not result:
+                result = status
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return result
+
+def main():
+    """Main entry point."""
+    sources = []
+    intcode = None
+    jobs = 1
+    cached = True
+    optimized = True
+    for arg in sys.argv[1:]:
+        if arg.startswith('-o') and len(arg) > 2:
+            intcode = arg[2:]
+        elif arg == '-j':
+            jobs = os.cpu_count() or 1
+        elif arg.startswith('-j') and arg[2:].isdigit() and int(arg[2:]) > 0:
+            jobs = int(arg[2:])
+        elif arg == '-n':
+            cached = False
+        elif arg == '-O0':
+            optimized = False
+        elif not arg.startswith('-'):
+            sources.append(arg)
+        else:
+            print(STR_USAGE)
+            sys.exit(1)
+    if not sources:
+        print(STR_USAGE)
+        sys.exit(0)
+    if len(sources) > 1:
+        if intcode is not None:
+            print(STR_USAGE)
+            sys.exit(1)
+        sys.exit(compile_batch(sources, jobs, cached=cached,
+                               optimized=optimized))
+    source = sources[0]
+    if not os.path.isfile(source):
+        sys.stderr.write("NO INPUT\n")
+        sys.exit(1)
+    cache = CompileCache() if cached else None
+    sys.exit(compile_file(source, intcode or "INTCODE", cache=cache,
+                          optimized=optimized))
+
+if __name__ == "__main__":
+    main()
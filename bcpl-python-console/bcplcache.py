@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+BCPL Compile Cache
+
+Remembers the result of compiling BCPL source, keyed by the contents of
+everything that went into it: the source, the files it GETs (found the
+way the interpreter's openfile() finds them) and the compiler itself.
+Compiling the same text again with the same compiler then just fetches
+the INTCODE.  The cache lives in one directory, holds at most a given
+number of bytes and drops the least recently used results first.
+
+Usage: python3 bcplcache.py [-x]
+
+prints the cache statistics, or with -x empties the cache.
+"""
+
+import sys
+import os
+import re
+import json
+import hashlib
+
+from icint import findfile
+
+STR_USAGE = "USAGE: python bcplcache.py [-x]"
+
+CACHE_DIR = os.environ.get("BCPL_CACHE") or os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+    "bcpl")
+CACHE_LIMIT = 64 * 1024 * 1024
+
+# The compiler: its stages, the optimizers and the interpreter running
+# them
+HERE = os.path.dirname(os.path.abspath(__file__))
+COMPILER = [os.path.join(HERE, fn) for fn in ("syni", "trni", "cgi",
+                                              "icint.py", "bcplopt.py",
+                                              "bcplpeep.py")]
+
+ENTRY_SUFFIX = ".json"
+
+# A file of hits or misses, a byte each, is folded into its total, a
+# number in KIND.total, once it holds COUNT_LIMIT of them
+COUNT_LIMIT = 64 * 1024
+TOTAL_SUFFIX = ".total"
+
+# GET "FILE" directives in BCPL source
+GET_DIRECTIVE = re.compile(rb'\bGET\s+"([^"*]*)"')
+
+def sources(source):
+    """Return the files the BCPL file source consists of.
+
+    That is source itself and the files it GETs, directly or not, as
+    (name, path) pairs.  The path is None for a file that is not there.
+    """
+    files = []
+    seen = set()
+    todo = [(source, source)]
+    while todo:
+        name, path = todo.pop()
+        if name in seen:
+            continue
+        seen.add(name)
+        files.append((name, path))
+        if path is not None:
+            with open(path, 'rb') as f:
+                text = f.read()
+            for get in GET_DIRECTIVE.findall(text):
+                get = get.decode("latin-1")
+                todo.append((get, findfile(get)))
+    return files
+
+class CompileCache:
+    """Compiled INTCODE, stored by the hash of what it was compiled from.
+
+    Each entry is a file KEY.json holding the compiler listings and the
+    INTCODE.  An entry's modification time is when it was last used, and
+    the oldest entries go once the cache holds more than limit bytes.
+    Hits and misses are counted by appending a byte to a file per kind,
+    so processes sharing the cache never lose each other's counts; a
+    file that gets to COUNT_LIMIT bytes is folded into the kind's total.
+    """
+
+    def __init__(self, path=CACHE_DIR, limit=CACHE_LIMIT):
+        self.path = path
+        self.limit = limit
+        h = hashlib.sha1()
+        for fn in COMPILER:
+            with open(fn, 'rb') as f:
+                h.update(hashlib.sha1(f.read()).digest())
+        self.compiler = h.digest()
+
+    def key(self, source, optimized=True):
+        """Return the key for compiling the BCPL file source here, with
+        the optimizers or (optimized false) without."""
+        h = hashlib.sha1(self.compiler)
+        if not optimized:
+            h.update(b"-O0")
+        for i, (name, path) in enumerate(sources(source)):
+            # The source is known by its contents alone; a GET file missing
+            # is recorded too, so that creating it changes the key
+            if i:
+                h.update(name.encode("latin-1") + b"\0")
+            if path is None:
+                h.update(b"-")
+            else:
+                with open(path, 'rb') as f:
+                    h.update(b"+" + hashlib.sha1(f.read()).digest())
+        return h.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.path, key + ENTRY_SUFFIX)
+
+    def _count(self, kind):
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            with open(os.path.join(self.path, kind), 'ab') as f:
+                f.write(b".")
+                full = f.tell() >= COUNT_LIMIT
+        except OSError:
+            return
+        if full:
+            self._fold(kind)
+
+    def _total(self, kind):
+        try:
+            with open(os.path.join(self.path, kind + TOTAL_SUFFIX)) as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return 0
+
+    def _fold(self, kind):
+        """Add the bytes counted in the file kind to its total, leaving
+        the file to start again."""
+        path = os.path.join(self.path, kind)
+        moved = "%s.%d.tmp" % (path, os.getpid())
+        total = path + TOTAL_SUFFIX
+        tmp = "%s.%d.tmp" % (total, os.getpid())
+        try:
+            # Only one process gets to move the file; counts made after
+            # go into a new one
+            os.replace(path, moved)
+        except OSError:
+            return
+        try:
+            n = self._total(kind) + os.path.getsize(moved)
+            with open(tmp, 'w') as f:
+                f.write("%d\n" % n)
+            os.replace(tmp, total)
+            os.remove(moved)
+        except OSError:
+            pass
+
+    def get(self, key):
+        """Return (listings, INTCODE) stored under key, or None."""
+        entry = self._entry(key)
+        try:
+            with open(entry, 'rb') as f:
+                data = json.loads(f.read().decode("ascii"))
+            listings = [s.encode("latin-1") for s in data["listings"]]
+            intcode = data["intcode"].encode("latin-1")
+            os.utime(entry)
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            self._count("misses")
+            return None
+        self._count("hits")
+        return listings, intcode
+
+    def put(self, key, listings, intcode):
+        """Store the listings and INTCODE compiled for key."""
+        data = json.dumps({
+            "listings": [s.decode("latin-1") for s in listings],
+            "intcode": intcode.decode("latin-1"),
+        }).encode("ascii")
+        entry = self._entry(key)
+        tmp = "%s.%d.tmp" % (entry, os.getpid())
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, entry)
+        except OSError:
+            # A cache that cannot be written just means compiling again
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            return
+        self.evict()
+
+    def _entries(self):
+        """Return (last used, size, path) of each entry, oldest first."""
+        entries = []
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return entries
+        for name in names:
+            if name.endswith(ENTRY_SUFFIX):
+                path = os.path.join(self.path, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        entries.sort()
+        return entries
+
+    def evict(self):
+        """Drop the least recently used entries until within the limit."""
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.limit:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        """Drop every entry and reset the statistics."""
+        for _, _, path in self._entries():
+            os.remove(path)
+        for kind in ("hits", "misses"):
+            for name in (kind, kind + TOTAL_SUFFIX):
+                try:
+                    os.remove(os.path.join(self.path, name))
+                except FileNotFoundError:
+                    pass
+
+    def stats(self):
+        """Return a dict of the number of entries, bytes, hits and misses."""
+        entries = self._entries()
+        counts = {}
+        for kind in ("hits", "misses"):
+            try:
+                counts[kind] = os.path.getsize(os.path.join(self.path, kind))
+            except OSError:
+                counts[kind] = 0
+            counts[kind] += self._total(kind)
+        return {"entries": len(entries),
+                "bytes": sum(size for _, size, _ in entries),
+                "limit": self.limit,
+                "hits": counts["hits"],
+                "misses": counts["misses"]}
+
+def main():
+    """Main entry point."""
+    cache = CompileCache()
+    args = sys.argv[1:]
+    if args == ['-x']:
+        cache.clear()
+    elif args:
+        print(STR_USAGE)
+        sys.exit(1)
+    stats = cache.stats()
+    looked_up = stats["hits"] + stats["misses"]
+    print("CACHE   %s" % cache.path)
+    print("ENTRIES %d" % stats["entries"])
+    print("SIZE    %d OF %d BYTES" % (stats["bytes"], stats["limit"]))
+    print("HITS    %d OF %d (%d%%)" % (
+        stats["hits"], looked_up,
+        100 * stats["hits"] // looked_up if looked_up else 0))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,656 @@
+#!/usr/bin/env python3
+"""
+BCPL OCODE Optimizer
+
+Improves the OCODE the front end (syni + trni) writes before the code
+generator (cgi) turns it into INTCODE.  The OCODE is read into a list of
+instructions, and each section of it, whose labels are its own, is put
+through these passes until they find nothing more to do, and written
+out again:
+
+  fold         operators applied to constants, x + 0 and the like, NOT
+               of a comparison and conditional jumps on a constant
+  reuse        an expression computed again while the variable it was
+               just stored in still holds its value is loaded from the
+               variable instead
+  dead_stores  stores to a local that is stored to again, or goes out of
+               scope, before anything can read it
+  thread       jumps to jumps go to the end of the chain, and jumps to
+               the next instruction go
+  unreachable  code after a jump, return or FINISH up to a label that
+               something jumps to, and labels that nothing does
+
+cgi simulates the run-time stack as it reads OCODE, so the passes keep
+its depth at every instruction they leave as it was, adding a STACK
+where code that changed it has gone.  Folding only produces numbers that
+fit in 16 bits, which mean the same at any word width, and none that
+cgi could not write out.
+
+bcplc.py runs the optimizer between the stages unless told not to, one
+section at a time as the front end writes them (see section_end()), and
+bcplverify.py checks that programs behave the same with and without it.
+Given an OCODE file, optimizes it in place or into OUTPUT, and reports
+what it did on standard error.
+
+Usage: python3 bcplopt.py [OCODE] [-oOUTPUT]
+"""
+
+import sys
+import re
+from collections import Counter
+
+STR_USAGE = "USAGE: python bcplopt.py [OCODE] [-oOUTPUT]"
+
+# The passes are repeated at most this many times
+OPT_ROUNDS = 8
+
+# The range folded constants must be in: 16-bit numbers, but for the
+# most negative, which cgi cannot write
+CONST_MIN = -0x7FFF
+CONST_MAX = 0x7FFF
+
+# Length of the lines of OCODE written
+LINE_WIDTH = 64
+
+# ============================================================================
+# OCODE
+# ============================================================================
+
+# Instructions by operands: none, a number or a label
+PLAIN_OPS = {"MULT", "DIV", "REM", "PLUS", "MINUS", "EQ", "NE", "LS", "GR",
+             "LE", "GE", "LSHIFT", "RSHIFT", "LOGAND", "LOGOR", "EQV",
+             "NEQV", "NEG", "NOT", "RV", "TRUE", "FALSE", "QUERY", "STIND",
+             "GOTO", "FNRN", "RTRN", "FINISH", "STORE"}
+NUMBER_OPS = {"LP", "LG", "LN", "LLP", "LLG", "SP", "SG", "STACK", "SAVE",
+              "FNAP", "RTAP", "RSTACK", "ENDPROC", "ITEMN"}
+LABEL_OPS = {"LL", "LLL", "SL", "JUMP", "JT", "JF", "LAB", "RES", "DATALAB",
+             "ITEML"}
+# and those with a count of operands to follow:
+#   LSTR n c1 ... cn
+#   ENTRY n Ll c1 ... cn
+#   SWITCHON n Ldefault k1 L1 ... kn Ln
+#   GLOBAL n g1 L1 ... gn Ln
+
+def read_ocode(text):
+    """Parse OCODE text (bytes) into a list of instructions.
+
+    An instruction is a tuple of its name and its operands, a label
+    operand being the label's number.  Raises ValueError if text is not
+    OCODE.
+    """
+    tokens = iter(text.decode("latin-1").split())
+
+    def number():
+        return int(next(tokens, ""))
+
+    def label():
+        token = next(tokens, "")
+        if token[:1] != "L":
+            raise ValueError("LABEL EXPECTED, NOT %r" % token)
+        return int(token[1:])
+
+    code = []
+    for op in tokens:
+        if op in PLAIN_OPS:
+            code.append((op,))
+        elif op in NUMBER_OPS:
+            code.append((op, number()))
+        elif op in LABEL_OPS:
+            code.append((op, label()))
+        elif op == "LSTR":
+            n = number()
+            code.append((op, n) + tuple(number() for _ in range(n)))
+        elif op == "ENTRY":
+            n = number()
+            code.append((op, n, label()) + tuple(number() for _ in range(n)))
+        elif op in ("SWITCHON", "GLOBAL"):
+            n = number()
+            ins = [op, n]
+            if op == "SWITCHON":
+                ins.append(label())
+            for _ in range(n):
+                ins += [number(), label()]
+            code.append(tuple(ins))
+        else:
+            raise ValueError("UNKNOWN OCODE %r" % op)
+    return code
+
+def _label_operands(ins):
+    """Return the positions in ins of its label operands."""
+    op = ins[0]
+    if op in LABEL_OPS:
+        return (1,)
+    if op == "ENTRY":
+        return (2,)
+    if op == "SWITCHON":
+        return range(2, len(ins), 2)
+    if op == "GLOBAL":
+        return range(3, len(ins), 2)
+    return ()
+
+def write_ocode(code):
+    """Return the OCODE text (bytes) of a list of instructions."""
+    lines = []
+    line = []
+    width = 0
+    for ins in code:
+        words = [str(x) for x in ins]
+        for i in _label_operands(ins):
+            words[i] = "L%d" % ins[i]
+        for word in words:
+            if line and width + len(word) > LINE_WIDTH:
+                lines.append(" ".join(line))
+                line = []
+                width = 0
+            line.append(word)
+            width += len(word) + 1
+    if line:
+        lines.append(" ".join(line))
+    return ("\n".join(lines) + "\n").encode("latin-1")
+
+def references(code):
+    """Return how many times each label is used, other than by its LAB."""
+    refs = Counter()
+    for ins in code:
+        if ins[0] != "LAB":
+            refs.update(ins[i] for i in _label_operands(ins))
+    return refs
+
+def sections(code):
+    """Split a list of instructions into sections, each ending with its
+    GLOBAL (but for any instructions after the last).  Label numbers are
+    local to one."""
+    start = 0
+    for i, ins in enumerate(code):
+        if ins[0] == "GLOBAL":
+            yield code[start:i + 1]
+            start = i + 1
+    if start < len(code):
+        yield code[start:]
+
+# A word of OCODE, and the GLOBAL instruction that ends each section, up
+# to its count
+OCODE_WORD = re.compile(rb'\S+')
+OCODE_GLOBAL = re.compile(rb'(?<!\S)GLOBAL\s+([0-9]+)\s')
+
+def section_end(text):
+    """Return where the first section of OCODE text (bytes) ends, after
+    the operands of its GLOBAL, or None if text does not hold all of it
+    yet.  Sections have labels of their own, so each can be optimized
+    as it comes."""
+    m = OCODE_GLOBAL.search(text)
+    if m is None:
+        return None
+    end = m.end()
+    words = OCODE_WORD.finditer(text, end)
+    for _ in range(2 * int(m.group(1))):
+        word = next(words, None)
+        if word is None:
+            return None
+        end = word.end()
+    # The last word may go on in what is still to come
+    return end if end < len(text) else None
+
+# ============================================================================
+# Stack Depth
+# ============================================================================
+
+# Instructions that push a value onto the stack
+LOADS = {"LP", "LG", "LN", "LL", "LLP", "LLG", "LLL", "LSTR", "TRUE",
+         "FALSE", "QUERY"}
+# ... that replace the value on top
+UNARY = {"NEG", "NOT", "RV"}
+# ... that pop one value (binary operators do too)
+POPS = {"SP", "SG", "SL", "JT", "JF", "GOTO", "RES", "SWITCHON", "FNRN"}
+# ... that set the depth to their operand, or to one more
+SETS_DEPTH = {"STACK", "SAVE", "RTAP"}
+SETS_DEPTH_ABOVE = {"FNAP", "RSTACK"}
+
+def _div(b, a):
+    # Truncating towards zero, as X6 does
+    if a == 0:
+        return None
+    q = abs(b) // abs(a)
+    return -q if (b < 0) != (a < 0) else q
+
+def _rem(b, a):
+    if a == 0:
+        return None
+    r = abs(b) % abs(a)
+    return -r if b < 0 else r
+
+# Binary operators, and the value of b op a for constants, or None if it
+# depends on the word width
+BINARY = {
+    "MULT": lambda b, a: b * a,
+    "DIV": _div,
+    "REM": _rem,
+    "PLUS": lambda b, a: b + a,
+    "MINUS": lambda b, a: b - a,
+    "EQ": lambda b, a: -1 if b == a else 0,
+    "NE": lambda b, a: -1 if b != a else 0,
+    "LS": lambda b, a: -1 if b < a else 0,
+    "GR": lambda b, a: -1 if b > a else 0,
+    "LE": lambda b, a: -1 if b <= a else 0,
+    "GE": lambda b, a: -1 if b >= a else 0,
+    "LSHIFT": lambda b, a: b << a if 0 <= a < 16 else None,
+    "RSHIFT": lambda b, a: b >> a if 0 <= a < 16 and b >= 0 else None,
+    "LOGAND": lambda b, a: b & a,
+    "LOGOR": lambda b, a: b | a,
+    "EQV": lambda b, a: ~(b ^ a),
+    "NEQV": lambda b, a: b ^ a,
+}
+
+def depth_after(ins, s):
+    """Return the depth of cgi's stack after ins, s being that before."""
+    op = ins[0]
+    if op in LOADS:
+        return s + 1
+    if op in BINARY or op in POPS:
+        return s - 1
+    if op == "STIND":
+        return s - 2
+    if op in SETS_DEPTH:
+        return ins[1]
+    if op in SETS_DEPTH_ABOVE:
+        return ins[1] + 1
+    return s
+
+def depths(code):
+    """Return the depth of cgi's stack before each instruction of code,
+    and at the end."""
+    d = [0]
+    for ins in code:
+        d.append(depth_after(ins, d[-1]))
+    return d
+
+# Loads without side effects, which give the same value every time
+PURE_LOADS = LOADS - {"LSTR", "QUERY"}
+PURE = PURE_LOADS | UNARY | set(BINARY)
+
+def _value_start(code, end):
+    """Return where the expression computing the value code[:end] leaves
+    on top starts, or None if it is not made of PURE instructions."""
+    need = 1
+    i = end
+    while need:
+        i -= 1
+        if i < 0:
+            return None
+        op = code[i][0]
+        if op in BINARY:
+            need += 1
+        elif op in PURE_LOADS:
+            need -= 1
+        elif op not in UNARY:
+            return None
+    return i
+
+def _drop_value(out, depth):
+    """Throw away the value on top of the stack at the end of out, depth
+    being the depth there: with the code computing it if that is pure."""
+    start = _value_start(out, len(out))
+    if start is not None:
+        del out[start:]
+    elif out and out[-1][0] == "FNAP":
+        out[-1] = ("RTAP", out[-1][1])
+    else:
+        out.append(("STACK", depth - 1))
+
+# ============================================================================
+# Passes
+# ============================================================================
+
+# Constant right operands that leave the left one as it is
+IDENTITY = {"PLUS": 0, "MINUS": 0, "MULT": 1, "DIV": 1, "LSHIFT": 0,
+            "RSHIFT": 0, "LOGAND": -1, "LOGOR": 0, "EQV": -1, "NEQV": 0}
+
+# Operators whose operands can be swapped
+COMMUTATIVE = {"MULT", "PLUS", "EQ", "NE", "LOGAND", "LOGOR", "EQV", "NEQV"}
+
+# The comparison that is NOT of another, whose value is TRUE or FALSE
+INVERSE = {"EQ": "NE", "NE": "EQ", "LS": "GE", "GE": "LS", "GR": "LE",
+           "LE": "GR"}
+
+def _const(ins):
+    """Return the constant value ins loads, or None."""
+    op = ins[0]
+    if op == "LN" and CONST_MIN <= ins[1] <= CONST_MAX:
+        return ins[1]
+    if op == "TRUE":
+        return -1
+    if op == "FALSE":
+        return 0
+    return None
+
+def _fold_tail(out):
+    """Fold the instructions at the end of out once, if they can be.
+    Returns whether they were."""
+    if len(out) < 2:
+        return False
+    op = out[-1][0]
+    if op in COMMUTATIVE and _const(out[-2]) is None:
+        # A constant left operand goes on the right, where the rules
+        # below look for it
+        r = _value_start(out, len(out) - 1)
+        if r and _const(out[r - 1]) is not None:
+            out[r - 1:-1] = out[r:-1] + [out[r - 1]]
+    a = _const(out[-2])
+    if a is not None:
+        if op == "NEG" or op == "NOT":
+            r = -a if op == "NEG" else ~a
+            if CONST_MIN <= r <= CONST_MAX:
+                out[-2:] = [("LN", r)]
+                return True
+        elif op in BINARY:
+            b = _const(out[-3]) if len(out) > 2 else None
+            r = BINARY[op](b, a) if b is not None else None
+            if r is not None and CONST_MIN <= r <= CONST_MAX:
+                out[-3:] = [("LN", r)]
+                return True
+            if IDENTITY.get(op) == a:
+                del out[-2:]
+                return True
+            # x + b + a is x + (b + a)
+            if (op in ("PLUS", "MINUS") and len(out) > 3
+                    and out[-3][0] in ("PLUS", "MINUS")):
+                b = _const(out[-4])
+                if b is not None:
+                    r = ((b if out[-3][0] == "PLUS" else -b)
+                         + (a if op == "PLUS" else -a))
+                    if CONST_MIN <= r <= CONST_MAX:
+                        out[-4:] = [("LN", r), ("PLUS",)]
+                        return True
+        elif op == "JT" or op == "JF":
+            if (a != 0) == (op == "JT"):
+                out[-2:] = [("JUMP", out[-1][1])]
+            else:
+                del out[-2:]
+            return True
+    if op == "NOT" and out[-2][0] in INVERSE:
+        out[-2:] = [(INVERSE[out[-2][0]],)]
+        return True
+    if (op == "NOT" or op == "NEG") and out[-2] == out[-1]:
+        del out[-2:]
+        return True
+    return False
+
+def fold(code, stats):
+    """Fold constant expressions and conditions."""
+    out = []
+    for ins in code:
+        out.append(ins)
+        while _fold_tail(out):
+            stats["folded"] += 1
+    return out
+
+# What a store instruction stores to, as the load of it
+STORE_LOADS = {"SP": "LP", "SG": "LG", "SL": "LL"}
+
+def _top_slot(expr, load):
+    """Return the highest local that expr or load reads, or -1."""
+    return max([ins[1] for ins in expr + (load,) if ins[0] == "LP"],
+               default=-1)
+
+def reuse(code, stats):
+    """Load the values of expressions stored in variables from them.
+
+    Within straight-line code, after e SP n (or e SG, e SL, or e STORE,
+    which leaves e in the local on top of the stack) e is replaced by
+    LP n until something that could change either is reached.
+    """
+    out = []
+    # {expression: (load of the variable holding it, highest local read)}
+    avail = {}
+    s = 0
+    for ins in code:
+        op = ins[0]
+        if op in PURE:
+            out.append(ins)
+            for expr, (load, _) in avail.items():
+                if tuple(out[-len(expr):]) == expr:
+                    out[-len(expr):] = [load]
+                    stats["reused"] += 1
+                    break
+        else:
+            if op in STORE_LOADS or op == "STORE":
+                if op == "STORE":
+                    load = ("LP", s - 1)
+                else:
+                    load = (STORE_LOADS[op], ins[1])
+                    avail = {e: v for e, v in avail.items()
+                             if v[0] != load and load not in e
+                             and ("RV",) not in e}
+                start = _value_start(out, len(out))
+                if start is not None and len(out) - start > 1:
+                    expr = tuple(out[start:])
+                    if load not in expr:
+                        avail[expr] = (load, _top_slot(expr, load))
+            elif op != "STACK":
+                avail.clear()
+            out.append(ins)
+        s = depth_after(ins, s)
+        # Locals the stack no longer reaches may be used for something
+        # else
+        if avail:
+            avail = {e: v for e, v in avail.items() if v[1] < s}
+    return out
+
+# What may come between a store to a local and the next store to it, for
+# the first to be dead, as long as it does not read the local
+_CANNOT_READ = (PURE - {"RV"}) | set(STORE_LOADS) | {"STORE", "STACK"}
+
+def _dead_store(code, i, n):
+    """Check whether the value code[i] stores in local n is never read."""
+    for ins in code[i + 1:]:
+        op = ins[0]
+        if op == "LP" and ins[1] == n:
+            return False
+        if ((op == "SP" and ins[1] == n) or op == "RTRN" or op == "FNRN"
+                or (op == "STACK" and ins[1] <= n)):
+            return True
+        if op not in _CANNOT_READ:
+            return False
+    return False
+
+def dead_stores(code, stats):
+    """Remove stores to locals that are overwritten, or returned from,
+    before they are read, and the computing of the values stored."""
+    d = depths(code)
+    dead = [i for i, ins in enumerate(code)
+            if ins[0] == "SP" and ins[1] < d[i + 1]
+            and _dead_store(code, i, ins[1])]
+    if not dead:
+        return code
+    out = []
+    for i, ins in enumerate(code):
+        if dead and dead[0] == i:
+            dead.pop(0)
+            _drop_value(out, d[i])
+            stats["dead stores"] += 1
+        else:
+            out.append(ins)
+    return out
+
+# What may come between a jump and its label without doing anything
+_NO_CODE = {"LAB", "STACK", "STORE"}
+
+def _next_code(code, i):
+    """Return the index of the first instruction from code[i] on that is
+    not in _NO_CODE."""
+    while i < len(code) and code[i][0] in _NO_CODE:
+        i += 1
+    return i
+
+def thread(code, stats):
+    """Send jumps to jumps to the end of the chain, and remove jumps to
+    the next instruction."""
+    where = {ins[1]: i for i, ins in enumerate(code) if ins[0] == "LAB"}
+
+    def target(label):
+        seen = set()
+        while label in where and label not in seen:
+            seen.add(label)
+            j = _next_code(code, where[label])
+            if j == len(code) or code[j][0] != "JUMP":
+                break
+            label = code[j][1]
+        return label
+
+    def follows(label, i):
+        # Where LAB label is, if it comes before any code after code[i]
+        j = i + 1
+        while j < len(code) and code[j][0] in _NO_CODE:
+            if code[j] == ("LAB", label):
+                return j
+            j += 1
+        return None
+
+    refs = references(code)
+    d = depths(code)
+    out = []
+    skip = 0
+    for i, ins in enumerate(code):
+        if skip:
+            skip -= 1
+            continue
+        op = ins[0]
+        if op in ("JUMP", "JT", "JF"):
+            label = target(ins[1])
+            if follows(label, i) is not None:
+                if op != "JUMP":
+                    _drop_value(out, d[i])
+                stats["threaded"] += 1
+                continue
+            if label != ins[1]:
+                ins = (op, label)
+                stats["threaded"] += 1
+        elif op == "SWITCHON":
+            new = list(ins)
+            for j in range(2, len(ins), 2):
+                new[j] = target(ins[j])
+            if tuple(new) != ins:
+                ins = tuple(new)
+                stats["threaded"] += 1
+        elif op == "RES" and refs[ins[1]] == 1:
+            # If nothing else gives the result, and it is where RSTACK
+            # would put it already, the RES, LAB and RSTACK can all go
+            j = follows(ins[1], i)
+            if (j is not None and j + 1 < len(code)
+                    and code[j + 1] == ("RSTACK", d[i] - 1)
+                    and ("LAB",) not in [c[:1] for c in code[i + 1:j]]):
+                skip = j + 1 - i
+                stats["threaded"] += 1
+                continue
+        out.append(ins)
+    return out
+
+# Instructions after which the next is not reached
+_ENDS = {"JUMP", "GOTO", "RES", "FNRN", "RTRN", "FINISH", "SWITCHON"}
+# ... and those that are not code, kept where they are not reached
+_NOT_CODE = {"STACK", "STORE", "SAVE", "ENDPROC", "RSTACK", "DATALAB",
+             "ITEML", "ITEMN", "GLOBAL"}
+
+def unreachable(code, stats):
+    """Remove the code that cannot be reached, and unused labels."""
+    refs = references(code)
+    d = depths(code)
+    out = []
+    s = 0
+    reached = True
+    for i, ins in enumerate(code):
+        op = ins[0]
+        if op == "LAB":
+            if not refs[ins[1]]:
+                stats["unreachable"] += 1
+                continue
+            reached = True
+        elif op == "ENTRY":
+            reached = True
+        elif not reached and op not in _NOT_CODE:
+            stats["unreachable"] += 1
+            continue
+        if s != d[i] and op not in ("STACK", "SAVE"):
+            out.append(("STACK", d[i]))
+        if op == "STACK" and out and out[-1][0] == "STACK":
+            out.pop()
+        out.append(ins)
+        s = depth_after(ins, d[i])
+        if op in _ENDS:
+            reached = False
+    return out
+
+PASSES = [fold, reuse, dead_stores, thread, unreachable]
+
+# ============================================================================
+# Optimizer
+# ============================================================================
+
+def optimize(code, stats=None):
+    """Optimize a list of OCODE instructions, returning a new list.
+
+    What each pass did is counted in stats, a Counter, if given.
+    """
+    if stats is None:
+        stats = Counter()
+    out = []
+    for section in sections(code):
+        for _ in range(OPT_ROUNDS):
+            done = sum(stats.values())
+            for opt in PASSES:
+                section = opt(section, stats)
+            if sum(stats.values()) == done:
+                break
+        out += section
+    return out
+
+def optimize_ocode(text, stats=None):
+    """Optimize OCODE text (bytes), as optimize() does.
+
+    Text that is not OCODE, such as what is left of it when the front
+    end stopped early, is returned as it is, for cgi to complain about.
+    """
+    try:
+        code = read_ocode(text)
+    except ValueError:
+        return text
+    return write_ocode(optimize(code, stats))
+
+def report(stats, before, after):
+    """Return a report of what optimize() did, counted in stats, to
+    before instructions leaving after."""
+    counts = ", ".join("%s %d" % (name.upper(), stats[name])
+                       for name in ("folded", "reused", "dead stores",
+                                    "threaded", "unreachable"))
+    return "OCODE %d -> %d INSTRUCTIONS\n%s\n" % (before, after, counts)
+
+def main():
+    """Main entry point."""
+    source = None
+    output = None
+    for arg in sys.argv[1:]:
+        if arg.startswith('-o') and len(arg) > 2:
+            output = arg[2:]
+        elif not arg.startswith('-') and source is None:
+            source = arg
+        else:
+            print(STR_USAGE)
+            sys.exit(1)
+    source = source or "OCODE"
+    try:
+        with open(source, 'rb') as f:
+            code = read_ocode(f.read())
+    except OSError:
+        sys.stderr.write("NO INPUT\n")
+        sys.exit(1)
+    except ValueError as e:
+        sys.stderr.write("BAD OCODE: %s\n" % e)
+        sys.exit(1)
+    stats = Counter()
+    optimized = optimize(code, stats)
+    with open(output or source, 'wb') as f:
+        f.write(write_ocode(optimized))
+    sys.stderr.write(report(stats, len(code), len(optimized)))
+
+if __name__ == "__main__":
+    main()
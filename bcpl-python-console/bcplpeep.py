@@ -0,0 +1,528 @@
+#!/usr/bin/env python3
+"""
+BCPL INTCODE Peephole Optimizer
+
+Improves the INTCODE the code generator (cgi) writes.  The INTCODE is
+read into a list of instructions, labels and data, put through these
+passes until they find nothing more to do, and written out again:
+
+  thread       jumps to jumps go to the end of the chain, a jump to a
+               return returns, a conditional jump over a jump becomes
+               the opposite one, and jumps to the next instruction go
+  fold         L 0 before an X operation that leaves A as it was
+               (X8 adding, X5 multiplying by L 1, ...), L n X8 and
+               L n X9 turned into A n and A -n, and comparisons with 0
+               just before a conditional jump
+  reload       loads of the cell just stored to, which A still holds
+  dead         loads and operations whose results nothing reads
+  unreachable  code after a jump, return, FINISH or SWITCHON up to a
+               label, and labels that nothing refers to
+
+Which of the registers A and B may be read after each instruction is
+worked out from the jumps between the labels of a section, so that the
+passes only change what a register holds where it is not read before
+being set again.  Data, global initializations and the labels used stay
+as they were, and the result is INTCODE that icint's assembler reads as
+it does cgi's.
+
+bcplc.py runs the optimizer on what cgi writes unless told not to, and
+bcplverify.py checks that programs behave the same with and without it.
+Given an INTCODE file, optimizes it in place or into OUTPUT, and reports
+what it did on standard error.
+
+Usage: python3 bcplpeep.py [INTCODE] [-oOUTPUT]
+"""
+
+import sys
+from collections import Counter
+
+from icint import ASM_COMMENT, ASM_TOKEN, asm_number
+
+STR_USAGE = "USAGE: python bcplpeep.py [INTCODE] [-oOUTPUT]"
+
+# The passes are repeated at most this many times
+OPT_ROUNDS = 8
+
+# Length of the lines of INTCODE written
+LINE_WIDTH = 64
+
+# ============================================================================
+# INTCODE
+# ============================================================================
+
+# Items other than instructions: label definitions, characters, data
+# words, data words holding a label's address, global initializations
+# and section ends
+NOT_CODE = {"LAB", "C", "D", "DL", "G", "Z"}
+
+def read_intcode(text):
+    """Parse INTCODE text (bytes) into a list of items.
+
+    An instruction is a tuple of its name, its letters as written ("LIP",
+    "JL", "SG", ...), and its number, a label's for names ending in L
+    after the first letter.  The other items are ("LAB", label),
+    ("C", ch), ("D", n), ("DL", label), ("G", global, label) and ("Z",).
+    Raises ValueError if the assembler would not take text.
+    """
+    text = ASM_COMMENT.sub(b"", text.replace(b"\r", b"\n"))
+    code = []
+    defined = set()
+    for m in ASM_TOKEN.finditer(text):
+        t = m.groups(b"")
+        if t[0]:
+            # G, for a global, is only written, not captured
+            g = m.group()[len(t[0] + t[1] + t[2]):][:1] == b"G"
+            op = (t[0] + t[1] + t[2] + b"G" * g + t[3]).decode()
+            code.append((op, asm_number(t[4])))
+        elif t[5]:
+            n = int(t[5])
+            if n in defined:
+                raise ValueError("DUPLICATE LABEL %d" % n)
+            defined.add(n)
+            code.append(("LAB", n))
+        elif t[6]:
+            code.append(("C", asm_number(t[7])))
+        elif t[8]:
+            code.append(("DL" if t[9] else "D", asm_number(t[10])))
+        elif t[11]:
+            if not t[13]:
+                raise ValueError("BAD CODE AT G%s" % t[12].decode())
+            code.append(("G", asm_number(t[12]), asm_number(t[14])))
+        elif t[15]:
+            code.append(("Z",))
+            defined.clear()
+        elif t[16]:
+            raise ValueError("BAD CH %d" % t[16][0])
+    return code
+
+def _word(ins):
+    op = ins[0]
+    if op == "LAB":
+        return "%d" % ins[1]
+    if op == "G":
+        return "G%dL%d" % ins[1:]
+    if op == "Z":
+        return op
+    return "%s%d" % ins
+
+def write_intcode(code):
+    """Return the INTCODE text (bytes) of a list of items."""
+    lines = []
+    line = []
+    width = 0
+    for ins in code:
+        word = _word(ins)
+        if line and (width + len(word) > LINE_WIDTH or ins[0] in ("G", "Z")):
+            lines.append(" ".join(line))
+            line = []
+            width = 0
+        line.append(word)
+        width += len(word) + 1
+        if ins[0] in ("G", "Z"):
+            lines.append(word)
+            line = []
+            width = 0
+    if line:
+        lines.append(" ".join(line))
+    return ("\n".join(lines) + "\n").encode("latin-1")
+
+def label_of(ins):
+    """Return the label ins refers to, or None."""
+    op = ins[0]
+    if op == "DL":
+        return ins[1]
+    if op == "G":
+        return ins[2]
+    if op not in NOT_CODE and len(op) > 1 and op[-1] == "L":
+        return ins[1]
+    return None
+
+def references(code):
+    """Return how many times each label is referred to."""
+    refs = Counter()
+    for ins in code:
+        label = label_of(ins)
+        if label is not None:
+            refs[label] += 1
+    return refs
+
+def sections(code):
+    """Split a list of items into sections, each ending with its Z (but
+    for any items after the last).  Label numbers are local to one."""
+    start = 0
+    for i, ins in enumerate(code):
+        if ins[0] == "Z":
+            yield code[start:i + 1]
+            start = i + 1
+    if start < len(code):
+        yield code[start:]
+
+def switch_table(code, i):
+    """Return the positions of the DL items of the SWITCHON table after
+    code[i], the default's first, or None if there is none there."""
+    if (i + 2 < len(code) and code[i + 1][0] == "D"
+            and code[i + 2][0] == "DL"):
+        end = i + 3 + 2 * code[i + 1][1]
+        if i + 3 <= end <= len(code) and all(
+                code[j][0] == "D" and code[j + 1][0] == "DL"
+                for j in range(i + 3, end, 2)):
+            return [i + 2] + list(range(i + 4, end, 2))
+    return None
+
+# ============================================================================
+# Registers
+# ============================================================================
+
+A_REG = 1
+B_REG = 2
+BOTH = A_REG | B_REG
+
+# X operations on A alone, and on B and A, leaving the result in A
+X_UNARY = {1, 2, 3}
+X_BINARY = set(range(5, 22))
+
+def _successors(code, i, where):
+    # Where control may go from code[i], len(code) standing for
+    # anywhere else (calls, returns, computed jumps)
+    end = len(code)
+    ins = code[i]
+    op = ins[0]
+    if op in ("LAB", "G"):
+        return [i + 1]
+    if op in NOT_CODE:
+        return [end]
+    if op in ("JL", "TL", "FL"):
+        label = where.get(ins[1], end)
+    else:
+        label = end
+    if op[0] == "J":
+        return [label]
+    if op[0] in "TF":
+        return [i + 1, label]
+    if op == "X" and ins[1] == 23:
+        table = switch_table(code, i)
+        if table is None:
+            return [end]
+        return [where.get(code[j][1], end) for j in table]
+    if op == "X" and ins[1] not in X_UNARY and ins[1] not in X_BINARY:
+        return [end]
+    if op[0] == "K":
+        return [end]
+    return [i + 1]
+
+def _live_before(ins, after):
+    # The registers that may be read before ins, given those after it
+    op = ins[0]
+    if op in ("LAB", "G"):
+        return after
+    if op in NOT_CODE:
+        return BOTH
+    fn = op[0]
+    if fn == "L":
+        # B takes A's value
+        return A_REG if after & B_REG else 0
+    if fn == "S":
+        return A_REG | after & B_REG
+    if fn in "AJ":
+        return after
+    if fn in "TF":
+        return A_REG | after
+    if op == "X":
+        if ins[1] in X_UNARY:
+            return after
+        if ins[1] in X_BINARY:
+            return BOTH if after & A_REG else after & B_REG
+        if ins[1] == 23:
+            return A_REG | after
+    return BOTH
+
+def liveness(code):
+    """Return, for each item of a section, the registers (A_REG | B_REG)
+    whose values may be read after it."""
+    where = {ins[1]: i for i, ins in enumerate(code) if ins[0] == "LAB"}
+    succ = [_successors(code, i, where) for i in range(len(code))]
+    live_in = [0] * len(code) + [BOTH]
+    live_out = [0] * len(code)
+    changed = True
+    while changed:
+        changed = False
+        for i in range(len(code) - 1, -1, -1):
+            after = 0
+            for j in succ[i]:
+                after |= live_in[j]
+            live_out[i] = after
+            before = _live_before(code[i], after)
+            if before != live_in[i]:
+                live_in[i] = before
+                changed = True
+    return live_out
+
+def _sets(ins):
+    """Return the registers ins sets, if that is all it does, or 0."""
+    op = ins[0]
+    if op in NOT_CODE:
+        return 0
+    if op[0] == "L":
+        return BOTH
+    if op[0] == "A":
+        return A_REG
+    if op == "X" and (ins[1] in X_UNARY or ins[1] in X_BINARY):
+        return A_REG
+    return 0
+
+# ============================================================================
+# Passes
+# ============================================================================
+
+def _next_code(code, i):
+    """Return the index of the first item from code[i] on that is not a
+    label or global initialization."""
+    while i < len(code) and code[i][0] in ("LAB", "G"):
+        i += 1
+    return i
+
+def thread(code, stats):
+    """Send jumps to jumps to the end of the chain, return instead of
+    jumping to a return, turn a conditional jump over a jump into the
+    opposite one, and remove jumps to the next instruction."""
+    where = {ins[1]: i for i, ins in enumerate(code) if ins[0] == "LAB"}
+
+    def target(label):
+        seen = set()
+        while label in where and label not in seen:
+            seen.add(label)
+            j = _next_code(code, where[label])
+            if j == len(code) or code[j][0] != "JL":
+                break
+            label = code[j][1]
+        return label
+
+    def follows(label, i):
+        # Whether label is defined after code[i], before any more code
+        j = i + 1
+        while j < len(code) and code[j][0] in ("LAB", "G"):
+            if code[j] == ("LAB", label):
+                return True
+            j += 1
+        return False
+
+    cases = set()
+    for i, ins in enumerate(code):
+        if ins == ("X", 23):
+            cases.update(switch_table(code, i) or ())
+    out = []
+    skip = False
+    for i, ins in enumerate(code):
+        if skip:
+            skip = False
+            continue
+        op = ins[0]
+        if op in ("JL", "TL", "FL"):
+            label = target(ins[1])
+            if follows(label, i):
+                stats["threaded"] += 1
+                continue
+            if (op != "JL" and i + 1 < len(code) and code[i + 1][0] == "JL"
+                    and follows(label, i + 1)):
+                out.append(("FL" if op == "TL" else "TL", code[i + 1][1]))
+                skip = True
+                stats["threaded"] += 1
+                continue
+            j = _next_code(code, where[label]) if label in where else None
+            if op == "JL" and j is not None and j < len(code) \
+                    and code[j] == ("X", 4):
+                ins = ("X", 4)
+                stats["threaded"] += 1
+            elif label != ins[1]:
+                ins = (op, label)
+                stats["threaded"] += 1
+        elif op == "DL" and i in cases:
+            label = target(ins[1])
+            if label != ins[1]:
+                ins = (op, label)
+                stats["threaded"] += 1
+        out.append(ins)
+    return out
+
+# X operations, and the number L puts in A before them for which they
+# leave the value L moved to B as it was
+IDENTITY = {5: 1, 6: 1, 8: 0, 9: 0, 16: 0, 17: 0, 18: -1, 19: 0, 20: 0,
+            21: -1}
+# Comparisons with 0 that a conditional jump can test A for itself, and
+# the jump that does: X11 (not equal) T is just T, X10 (equal) T is F
+ZERO_TESTS = {(11, "TL"): "TL", (11, "FL"): "FL",
+              (10, "TL"): "FL", (10, "FL"): "TL"}
+
+def fold(code, stats):
+    """Remove L n X pairs that leave A as it was, turn those adding a
+    number into A, and drop comparisons with 0 before conditional
+    jumps; all only where what is then in B is not read."""
+    live = liveness(code)
+    out = []
+    i = 0
+    while i < len(code):
+        ins = code[i]
+        if (ins[0] == "L" and i + 1 < len(code) and code[i + 1][0] == "X"
+                and not live[i + 1] & B_REG):
+            n = ins[1]
+            d = code[i + 1][1]
+            jump = code[i + 2] if i + 2 < len(code) else ("Z",)
+            if IDENTITY.get(d) == n:
+                stats["folded"] += 1
+                i += 2
+                continue
+            if d in (8, 9):
+                out.append(("A", n if d == 8 else -n))
+                stats["folded"] += 1
+                i += 2
+                continue
+            if n == 0 and (d, jump[0]) in ZERO_TESTS and not live[i + 2]:
+                # The jump's A, the comparison's, is not read after it
+                out.append((ZERO_TESTS[d, jump[0]], jump[1]))
+                stats["folded"] += 1
+                i += 3
+                continue
+        out.append(ins)
+        i += 1
+    return out
+
+def reload(code, stats):
+    """Remove loads of the cell just stored to, where what the load
+    would have put in B is not read."""
+    live = liveness(code)
+    out = []
+    for i, ins in enumerate(code):
+        if (out and i and code[i - 1] is out[-1] and ins[0][:2] == "LI"
+                and not live[i] & B_REG):
+            store = out[-1]
+            if (store[0][0] == "S" and "I" not in store[0]
+                    and store[0][1:].replace("G", "")
+                    == ins[0][2:].replace("G", "")
+                    and store[1] == ins[1]):
+                stats["reloads"] += 1
+                continue
+        out.append(ins)
+    return out
+
+def dead(code, stats):
+    """Remove loads and operations whose results are not read."""
+    live = liveness(code)
+    out = []
+    for i, ins in enumerate(code):
+        sets = _sets(ins)
+        if sets and not live[i] & sets:
+            stats["dead"] += 1
+            continue
+        out.append(ins)
+    return out
+
+def _ends(ins):
+    """Check whether the instruction after ins is not reached from it."""
+    op = ins[0]
+    return (op not in NOT_CODE and op[0] == "J"
+            or ins in (("X", 4), ("X", 22), ("X", 23)))
+
+def unreachable(code, stats):
+    """Remove the code that cannot be reached, and unused labels."""
+    refs = references(code)
+    out = []
+    reached = True
+    for ins in code:
+        op = ins[0]
+        if op == "LAB":
+            # A label between characters keeps them in separate words
+            if not refs[ins[1]] and not (out and out[-1][0] == "C"):
+                stats["unreachable"] += 1
+                continue
+            reached = True
+        elif op in NOT_CODE:
+            # What follows data may be reached some other way
+            if op != "G":
+                reached = True
+        elif not reached:
+            stats["unreachable"] += 1
+            continue
+        out.append(ins)
+        if _ends(ins):
+            reached = False
+    return out
+
+PASSES = [thread, fold, reload, dead, unreachable]
+
+# ============================================================================
+# Optimizer
+# ============================================================================
+
+def optimize(code, stats=None):
+    """Optimize a list of INTCODE items, returning a new list.
+
+    What each pass did is counted in stats, a Counter, if given.
+    """
+    if stats is None:
+        stats = Counter()
+    out = []
+    for section in sections(code):
+        for _ in range(OPT_ROUNDS):
+            done = sum(stats.values())
+            for opt in PASSES:
+                section = opt(section, stats)
+            if sum(stats.values()) == done:
+                break
+        out += section
+    return out
+
+def optimize_intcode(text, stats=None):
+    """Optimize INTCODE text (bytes), as optimize() does.
+
+    Text the assembler would not take is returned as it is, for it to
+    complain about.
+    """
+    try:
+        code = read_intcode(text)
+    except ValueError:
+        return text
+    return write_intcode(optimize(code, stats))
+
+def instructions(code):
+    """Return the number of instructions in a list of items."""
+    return sum(ins[0] not in NOT_CODE for ins in code)
+
+def report(stats, before, after):
+    """Return a report of what optimize() did, counted in stats, to
+    before instructions leaving after."""
+    counts = ", ".join("%s %d" % (name.upper(), stats[name])
+                       for name in ("threaded", "folded", "reloads", "dead",
+                                    "unreachable"))
+    return "INTCODE %d -> %d INSTRUCTIONS\n%s\n" % (before, after, counts)
+
+def main():
+    """Main entry point."""
+    source = None
+    output = None
+    for arg in sys.argv[1:]:
+        if arg.startswith('-o') and len(arg) > 2:
+            output = arg[2:]
+        elif not arg.startswith('-') and source is None:
+            source = arg
+        else:
+            print(STR_USAGE)
+            sys.exit(1)
+    source = source or "INTCODE"
+    try:
+        with open(source, 'rb') as f:
+            code = read_intcode(f.read())
+    except OSError:
+        sys.stderr.write("NO INPUT\n")
+        sys.exit(1)
+    except ValueError as e:
+        sys.stderr.write("BAD INTCODE: %s\n" % e)
+        sys.exit(1)
+    stats = Counter()
+    optimized = optimize(code, stats)
+    with open(output or source, 'wb') as f:
+        f.write(write_intcode(optimized))
+    sys.stderr.write(report(stats, instructions(code),
+                            instructions(optimized)))
+
+if __name__ == "__main__":
+    main()
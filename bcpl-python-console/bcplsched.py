@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""
+BCPL Session Scheduler
+
+Runs many BCPL programs in one process and on one thread, each as a
+session on its own icint Machine.  Sessions take turns: each runs for a
+quantum of steps (see Machine.check_limits()) and then gives way to the
+next, its registers saved until its next turn.  A session whose program
+reads input that has not arrived yet is passed over until it has.  A
+session's priority is the number of quanta it runs for in each turn, so
+one of priority 2 gets about twice the CPU of one of priority 1.
+
+Given several INTCODE files, runs each as a session, all reading the
+same input (from INPUT with -i, or none), then prints each session's
+output in turn and a report of the steps, time and share of the CPU
+each one took.
+
+Usage: python3 bcplsched.py ICFILE... [-iINPUT] [-qSTEPS]
+"""
+
+import sys
+import io
+import time
+
+from icint import Machine, STR_NO_ICFILE, STR_NO_INPUT
+
+STR_USAGE = "USAGE: python bcplsched.py ICFILE... [-iINPUT] [-qSTEPS]"
+
+# Steps a session of priority 1 runs for in each turn
+QUANTUM = 1000
+
+# ============================================================================
+# Sessions
+# ============================================================================
+
+class SessionInput:
+    """Input stream of a session, fed to it as the input arrives.
+
+    Provides the read() of a binary file that icint uses for SYSIN.
+    While no input is ready and the stream is open, read() returns None,
+    which makes the program wait for it (see icint.InputPending).
+    """
+
+    def __init__(self, data=b""):
+        self.buf = bytearray(data)
+        self.closed = False
+
+    def feed(self, data):
+        """Add data to the input."""
+        self.buf += data
+
+    def close(self):
+        """End the input; the program sees end of file after the data."""
+        self.closed = True
+
+    def ready(self):
+        """Check whether a read would return at once."""
+        return bool(self.buf) or self.closed
+
+    def isatty(self):
+        return False
+
+    def read(self, n=-1):
+        if not self.buf:
+            return b"" if self.closed else None
+        if n < 0:
+            n = len(self.buf)
+        data = bytes(self.buf[:n])
+        del self.buf[:n]
+        return data
+
+class Session:
+    """A program loaded on its own Machine, with its input and output.
+
+    files are the INTCODE files to load, and stdin the input ready for
+    the program at the start; feed it more through input.  The output
+    collects in output, a BytesIO.  Other keyword arguments are passed
+    on to Machine().
+    """
+
+    def __init__(self, name, files, stdin=b"", priority=1, **options):
+        self.name = name
+        self.priority = priority
+        self.input = SessionInput(stdin)
+        self.output = io.BytesIO()
+        self.vm = Machine(stdin=self.input, stdout=self.output, **options)
+        for fn in files:
+            if not self.vm.load(fn):
+                raise OSError("%s %s" % (STR_NO_ICFILE, fn))
+        # Exit code once the program has stopped, turns taken and the
+        # seconds they took
+        self.status = None
+        self.slices = 0
+        self.seconds = 0.0
+
+    def runnable(self):
+        """Check whether the session can run now."""
+        return self.status is None and (not self.vm.waiting
+                                        or self.input.ready())
+
+    def state(self):
+        """Return the exit code, or what the session is doing, as text."""
+        if self.status is not None:
+            return str(self.status)
+        return "WAITING" if self.vm.waiting else "READY"
+
+# ============================================================================
+# Scheduler
+# ============================================================================
+
+class Scheduler:
+    """Round-robin scheduler of Sessions.
+
+    In each turn, every session that can run does so for its priority
+    times quantum steps, in the order they were added.
+    """
+
+    def __init__(self, quantum=QUANTUM):
+        self.quantum = quantum
+        self.sessions = []
+
+    def add(self, session):
+        """Add session to those scheduled and return it."""
+        self.sessions.append(session)
+        return session
+
+    def turn(self):
+        """Give every session that can run its turn.
+
+        Returns how many sessions ran.
+        """
+        ran = 0
+        for session in self.sessions:
+            if session.runnable():
+                self._slice(session)
+                ran += 1
+        return ran
+
+    def run(self):
+        """Take turns until no session can run.
+
+        Returns the sessions that have not finished, all waiting for input.
+        """
+        while self.turn():
+            pass
+        return [s for s in self.sessions if s.status is None]
+
+    def _slice(self, session):
+        start = time.perf_counter()
+        try:
+            session.status = session.vm.run_slice(session.priority
+                                                  * self.quantum)
+        except SystemExit as e:
+            # halt() stops only the session
+            session.status = e.code
+        session.seconds += time.perf_counter() - start
+        session.slices += 1
+
+    def report(self):
+        """Return a text report of the sessions and their share of the CPU."""
+        total = sum(s.seconds for s in self.sessions) or 1
+        lines = ["SESSION              STATUS  PRI  SLICES       STEPS"
+                 "   SECONDS    CPU"]
+        for s in self.sessions:
+            lines.append("%-20s %7s %4d %7d %11d %9.3f %5.1f%%"
+                         % (s.name[-20:], s.state(), s.priority, s.slices,
+                            s.vm.steps, s.seconds, 100 * s.seconds / total))
+        return "\n".join(lines) + "\n"
+
+def main():
+    """Main entry point."""
+    files = []
+    stdin = b""
+    quantum = QUANTUM
+    for arg in sys.argv[1:]:
+        if arg.startswith('-q') and arg[2:].isdigit() and int(arg[2:]) > 0:
+            quantum = int(arg[2:])
+        elif arg.startswith('-i') and len(arg) > 2:
+            try:
+                with open(arg[2:], 'rb') as f:
+                    stdin = f.read()
+            except OSError:
+                sys.stderr.write(STR_NO_INPUT + "\n")
+                sys.exit(1)
+        elif not arg.startswith('-'):
+            files.append(arg)
+        else:
+            print(STR_USAGE)
+            sys.exit(1)
+    if not files:
+        print(STR_USAGE)
+        sys.exit(0)
+
+    scheduler = Scheduler(quantum)
+    for fn in files:
+        try:
+            session = scheduler.add(Session(fn, [fn], stdin))
+        except OSError as e:
+            sys.stderr.write("%s\n" % e)
+            sys.exit(1)
+        session.input.close()
+    scheduler.run()
+
+    out = sys.stdout.buffer
+    for s in scheduler.sessions:
+        if len(scheduler.sessions) > 1:
+            out.write(("==> %s <==\n" % s.name).encode())
+        out.write(s.output.getvalue())
+    out.flush()
+    sys.stderr.write(scheduler.report())
+    sys.exit(next((s.status for s in scheduler.sessions if s.status), 0))
+
+if __name__ == "__main__":
+    main()
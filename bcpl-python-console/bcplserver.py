@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+"""
+BCPL Compile Server
+
+Keeps the compiler stages (syni + trni and cgi) assembled in memory and
+compiles BCPL source sent to it over a Unix-domain socket, so a compile
+costs neither a Python start-up nor loading the compiler.  Requests are
+handled by a pool of worker processes, each holding its own copy of the
+assembled stages.
+
+Usage: python3 bcplserver.py [-sSOCKET] [-jN]
+
+compile.py is the client.
+"""
+
+import sys
+import os
+import io
+import json
+import signal
+import socket
+import socketserver
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from icint import Machine, STR_NO_ICFILE
+from bcplc import FRONT_END, CODE_GENERATOR
+from bcplopt import optimize_ocode
+from bcplpeep import optimize_intcode
+
+STR_USAGE = "USAGE: python bcplserver.py [-sSOCKET] [-jN]"
+STR_RUNNING = "SERVER ALREADY RUNNING"
+
+# Where the server listens unless told otherwise
+SOCKET_PATH = os.environ.get(
+    "BCPL_SOCKET",
+    os.path.join(tempfile.gettempdir(), "bcplserver-%d.sock" % os.getuid()))
+
+# ============================================================================
+# Compiler
+# ============================================================================
+
+def _run(vm):
+    """Run a loaded machine, returning its exit code."""
+    try:
+        return vm.run()
+    except SystemExit as e:
+        return e.code
+
+class Compiler:
+    """The compiler stages, assembled once and kept resident.
+
+    Each stage is kept as the memory it occupies after loading, and every
+    compile starts from a fresh Machine with that memory copied in.
+    """
+
+    def __init__(self):
+        self.front = self._assemble(FRONT_END)
+        self.back = self._assemble(CODE_GENERATOR)
+
+    @staticmethod
+    def _assemble(files):
+        vm = Machine(stdin=io.BytesIO(), stdout=io.BytesIO())
+        for fn in files:
+            if not vm.load(fn):
+                raise OSError("%s %s" % (STR_NO_ICFILE, fn))
+        return vm.m[:vm.lomem]
+
+    @staticmethod
+    def _machine(image, stdin, stdout):
+        vm = Machine(stdin=stdin, stdout=stdout)
+        vm.m[:len(image)] = image
+        vm.lomem = len(image)
+        return vm
+
+    def compile(self, source, optimized=True):
+        """Compile the BCPL text source (bytes).
+
+        Files the source GETs are looked for in the current directory.
+        Returns (exit code, listings, OCODE, INTCODE), with the listing of
+        each stage that ran.  The code generator only runs if the front
+        end succeeded, on the OCODE put through the optimizer unless
+        optimized is false; that is the OCODE returned.  The INTCODE then
+        goes through the peephole optimizer, unless optimized is false.
+        """
+        listings = [io.BytesIO()]
+        ocode = io.BytesIO()
+        intcode = io.BytesIO()
+        front = self._machine(self.front, io.BytesIO(source), listings[0])
+        front.named_streams["OCODE"] = ocode
+        status = _run(front)
+        ocode = ocode.getvalue()
+        if not status:
+            if optimized:
+                ocode = optimize_ocode(ocode)
+            listings.append(io.BytesIO())
+            back = self._machine(self.back, io.BytesIO(ocode), listings[1])
+            back.named_streams["INTCODE"] = intcode
+            status = _run(back)
+        intcode = intcode.getvalue()
+        if not status and optimized:
+            intcode = optimize_intcode(intcode)
+        return (status, [f.getvalue() for f in listings], ocode, intcode)
+
+# ============================================================================
+# Worker Processes
+# ============================================================================
+
+_compiler = None
+
+def _start_worker():
+    global _compiler
+    # Stopping is up to the server process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _compiler = Compiler()
+
+def _ping():
+    return os.getpid()
+
+def _compile_job(source, directory, optimized):
+    """Compile source in directory, in a worker process."""
+    if directory:
+        os.chdir(directory)
+    return _compiler.compile(source, optimized)
+
+# ============================================================================
+# Protocol
+# ============================================================================
+
+# A client connects, sends one JSON object and shuts down its side of the
+# connection:
+#   {"source": text, "directory": path, "optimize": false to turn the
+#    OCODE optimizer off}
+# and the server answers with one JSON object and closes the connection:
+#   {"status": n, "listings": [front end, code generator if it ran],
+#    "ocode": text, "intcode": text}
+# or {"error": message}.  Text is bytes decoded as Latin-1.
+
+def encode(obj):
+    return json.dumps(obj).encode("ascii")
+
+def decode(data):
+    return json.loads(data.decode("ascii"))
+
+def listening(path=SOCKET_PATH):
+    """Check whether a server is accepting connections at path."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        try:
+            s.connect(path)
+        except OSError:
+            return False
+    return True
+
+def request(source, directory, path=SOCKET_PATH, optimized=True):
+    """Send source to the server at path and return its answer.
+
+    Raises OSError if no server is listening there.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(path)
+        s.sendall(encode({"source": source.decode("latin-1"),
+                          "directory": directory,
+                          "optimize": optimized}))
+        s.shutdown(socket.SHUT_WR)
+        with s.makefile("rb") as f:
+            return decode(f.read())
+
+def answer(result):
+    """The reply for a result from Compiler.compile()."""
+    status, listings, ocode, intcode = result
+    return {"status": status,
+            "listings": [text.decode("latin-1") for text in listings],
+            "ocode": ocode.decode("latin-1"),
+            "intcode": intcode.decode("latin-1")}
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        data = self.rfile.read()
+        if not data:
+            return  # just checking that the server is there
+        try:
+            req = decode(data)
+            source = req["source"].encode("latin-1")
+            directory = req.get("directory")
+            optimized = bool(req.get("optimize", True))
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            reply = {"error": "BAD REQUEST: %s" % e}
+        else:
+            try:
+                reply = answer(self.server.pool.submit(
+                    _compile_job, source, directory, optimized).result())
+            except Exception as e:
+                reply = {"error": "%s: %s" % (type(e).__name__, e)}
+        self.wfile.write(encode(reply))
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Compile server on a Unix-domain socket, backed by a process pool."""
+
+    daemon_threads = True
+
+    def __init__(self, path=SOCKET_PATH, jobs=None):
+        if os.path.exists(path):
+            if listening(path):
+                raise OSError(STR_RUNNING)
+            os.remove(path)  # left behind by a server that died
+        jobs = jobs or os.cpu_count() or 1
+        self.pool = ProcessPoolExecutor(jobs, initializer=_start_worker)
+        # Start the workers, and so load the compiler, before listening
+        for f in [self.pool.submit(_ping) for _ in range(jobs)]:
+            f.result()
+        super().__init__(path, _Handler)
+
+    def server_close(self):
+        super().server_close()
+        os.remove(self.server_address)
+        self.pool.shutdown()
+
+def main():
+    """Main entry point."""
+    path = SOCKET_PATH
+    jobs = None
+    for arg in sys.argv[1:]:
+        if arg.startswith('-s') and len(arg) > 2:
+            path = arg[2:]
+        elif arg.startswith('-j') and arg[2:].isdigit() and int(arg[2:]) > 0:
+            jobs = int(arg[2:])
+        else:
+            print(STR_USAGE)
+            sys.exit(1)
+    try:
+        server = Server(path, jobs)
+    except OSError as e:
+        sys.stderr.write("%s\n" % e)
+        sys.exit(1)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    with server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+BCPL Optimizer Verifier
+
+Checks that the OCODE optimizer (see bcplopt.py) and the INTCODE peephole
+optimizer (see bcplpeep.py) do not change what programs do.  Each source
+is compiled three times: without the optimizers, with them as bcplc.py
+runs them, a section at a time, and with them on the whole file as the
+compile server (see bcplserver.py) does.  All three programs are run on
+the same input, and their output and exit codes must be the same.  The
+verifier also reports the size of the first two programs' INTCODE and
+how many steps they ran for.
+
+The sample programs are verified when no source is given.  As when
+compiling, files the sources GET are looked for in the current directory.
+
+Usage: python3 bcplverify.py [SOURCE...] [-iINPUT] [--max-steps=N]
+"""
+
+import sys
+import os
+import io
+import tempfile
+
+from icint import Machine, STR_NO_INPUT
+from bcplc import compile_file
+from bcplserver import Compiler
+
+STR_USAGE = ("USAGE: python bcplverify.py [SOURCE...] [-iINPUT] "
+             "[--max-steps=N]")
+STR_DIFFERENT = "OUTPUT DIFFERS"
+
+VERIFY_SOURCES = ["test.b", "fact.b", "queens.b", "cmpltest.b",
+                  "sections.b"]
+
+# Programs that run longer than this are stopped
+VERIFY_STEPS = 100000000
+
+_compiler = None
+
+def _compile_whole(source, intcode):
+    """Compile source to the file intcode as the compile server does,
+    optimizing all of its OCODE at once.  Returns the exit code."""
+    global _compiler
+    if _compiler is None:
+        _compiler = Compiler()
+    with open(source, 'rb') as f:
+        status, _, _, code = _compiler.compile(f.read(), True)
+    with open(intcode, 'wb') as f:
+        f.write(code)
+    return status
+
+def _words(intcode):
+    """Return the words of memory the INTCODE file takes when loaded."""
+    vm = Machine(stdin=io.BytesIO(), stdout=io.BytesIO())
+    vm.image_cache = False
+    start = vm.lomem
+    if not vm.load(intcode):
+        return 0
+    return vm.lomem - start
+
+def run(intcode, stdin=b"", steps=VERIFY_STEPS):
+    """Run the INTCODE file on stdin (bytes).
+
+    Returns (exit code, output, steps run).
+    """
+    stdout = io.BytesIO()
+    vm = Machine(stdin=io.BytesIO(stdin), stdout=stdout)
+    vm.image_cache = False
+    vm.step_limit = steps
+    try:
+        if not vm.load(intcode):
+            return 1, b"", 0
+        status = vm.run()
+    except SystemExit as e:
+        status = e.code
+    return status, stdout.getvalue(), vm.steps
+
+def verify(source, stdin=b"", steps=VERIFY_STEPS):
+    """Compile and run source without the optimizers, with them a
+    section at a time and with them on the whole file.
+
+    Returns (line of report, whether the programs all did the same).
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for optimized in (False, True, None):
+            intcode = os.path.join(tmp, "INTCODE%s" % optimized)
+            if optimized is None:
+                status = _compile_whole(source, intcode)
+            else:
+                status = compile_file(source, intcode, io.BytesIO(),
+                                      optimized=optimized)
+            if status:
+                return "%s: COMPILE FAILED (%s)" % (source, status), False
+            results.append((_words(intcode),) + run(intcode, stdin, steps))
+    ((words, status, output, ran), (owords, ostatus, ooutput, oran),
+     (_, wstatus, woutput, _)) = results
+    same = (status == ostatus == wstatus
+            and output == ooutput == woutput)
+    line = ("%s: %s, %d -> %d WORDS, %d -> %d STEPS"
+            % (source, "SAME OUTPUT" if same else STR_DIFFERENT, words,
+               owords, ran, oran))
+    return line, same
+
+def main():
+    """Main entry point."""
+    sources = []
+    stdin = b""
+    steps = VERIFY_STEPS
+    for arg in sys.argv[1:]:
+        if arg.startswith('-i') and len(arg) > 2:
+            try:
+                with open(arg[2:], 'rb') as f:
+                    stdin = f.read()
+            except OSError:
+                sys.stderr.write(STR_NO_INPUT + "\n")
+                sys.exit(1)
+        elif arg.startswith('--max-steps=') and arg[12:].isdigit():
+            steps = int(arg[12:])
+        elif not arg.startswith('-'):
+            sources.append(arg)
+        else:
+            print(STR_USAGE)
+            sys.exit(1)
+    failed = 0
+    for source in sources or VERIFY_SOURCES:
+        line, same = verify(source, stdin, steps)
+        print(line)
+        failed += not same
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
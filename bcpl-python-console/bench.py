@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+"""
+BCPL Benchmarks
+
+Times the compiler stages and the sample programs separately, each in
+this process on a fresh icint Machine:
+
+  assemble  assembling syni and trni
+  syn       syni + trni compiling cmpltest.b to OCODE
+  cgi       cgi compiling that OCODE to INTCODE
+  queens, fact, test
+            running the sample programs, compiled beforehand
+
+Each benchmark is run several times and its best time kept.  One more,
+untimed run counts the INTCODE instructions executed (see Profiler) and
+another measures the peak memory allocated.  The results can be saved
+as JSON and compared with a baseline saved earlier, a benchmark that
+got slower by more than the threshold counting as a regression.
+
+Usage: python3 bench.py [NAME...] [-rN] [-oRESULTS] [-bBASELINE] [-tPERCENT]
+"""
+
+import sys
+import os
+import io
+import gc
+import json
+import time
+import platform
+import tracemalloc
+
+from icint import Machine, STR_NO_ICFILE
+from bcplc import HERE, FRONT_END, CODE_GENERATOR
+
+STR_USAGE = ("USAGE: python bench.py [NAME...] [-rN] [-oRESULTS] "
+             "[-bBASELINE] [-tPERCENT]")
+
+BENCH_SOURCE = os.path.join(HERE, "cmpltest.b")
+BENCH_PROGRAMS = ["queens", "fact", "test"]
+BENCHMARKS = ["assemble", "syn", "cgi"] + BENCH_PROGRAMS
+
+BENCH_REPEAT = 5
+# A benchmark this many percent slower than its baseline is a regression
+BENCH_THRESHOLD = 10
+
+# ============================================================================
+# Stages
+# ============================================================================
+
+def _machine(stdin=b""):
+    vm = Machine(stdin=io.BytesIO(stdin), stdout=io.BytesIO())
+    vm.image_cache = False
+    return vm
+
+def _load(vm, files):
+    for fn in files:
+        if not vm.load(fn):
+            raise OSError("%s %s" % (STR_NO_ICFILE, fn))
+
+def _stage(files, stdin=b"", output=None):
+    """Return a function that sets up a machine to run files on stdin.
+
+    The machine's output to the file output is kept in its named_streams.
+    """
+    def setup():
+        vm = _machine(stdin)
+        if output is not None:
+            vm.named_streams[output] = io.BytesIO()
+        _load(vm, files)
+        return vm
+    return setup
+
+def _run(vm):
+    status = vm.run()
+    if status:
+        raise RuntimeError("EXIT CODE %s" % status)
+
+def _compile(source):
+    """Compile the BCPL text source, returning (OCODE, INTCODE)."""
+    front = _stage(FRONT_END, source, "OCODE")()
+    _run(front)
+    ocode = front.named_streams["OCODE"].getvalue()
+    back = _stage(CODE_GENERATOR, ocode, "INTCODE")()
+    _run(back)
+    return ocode, back.named_streams["INTCODE"].getvalue()
+
+def _program(intcode):
+    """Return a function that sets up a machine to run intcode."""
+    def setup():
+        vm = _machine()
+        vm.named_streams["BENCH"] = io.BytesIO(intcode)
+        _load(vm, ["BENCH"])
+        return vm
+    return setup
+
+def benchmarks(names):
+    """Return (name, setup, timed) for each benchmark in names.
+
+    setup() is called untimed before each run and its result passed to
+    timed(), which returns the machine that ran, if any.
+    """
+    with open(BENCH_SOURCE, 'rb') as f:
+        source = f.read()
+    found = []
+    for name in names:
+        if name == "assemble":
+            found.append((name, _machine, lambda vm: _load(vm, FRONT_END)))
+        elif name == "syn":
+            found.append((name, _stage(FRONT_END, source, "OCODE"),
+                          _timed_run))
+        elif name == "cgi":
+            ocode, _ = _compile(source)
+            found.append((name, _stage(CODE_GENERATOR, ocode, "INTCODE"),
+                          _timed_run))
+        else:
+            with open(os.path.join(HERE, name + ".b"), 'rb') as f:
+                _, intcode = _compile(f.read())
+            found.append((name, _program(intcode), _timed_run))
+    return found
+
+def _timed_run(vm):
+    _run(vm)
+    return vm
+
+# ============================================================================
+# Measuring
+# ============================================================================
+
+def measure(setup, timed, repeat=BENCH_REPEAT):
+    """Run a benchmark, returning its results as a dict.
+
+    seconds is the best of repeat timed runs and instructions the INTCODE
+    instructions executed (None for assembly), counted by a profiled run.
+    peak_kb is the most memory allocated at once while setting up and
+    running the benchmark again, if the Python implementation can tell.
+    """
+    runs = []
+    for _ in range(repeat):
+        vm = setup()
+        gc.collect()
+        start = time.perf_counter()
+        timed(vm)
+        runs.append(time.perf_counter() - start)
+    best = min(runs)
+
+    instructions = None
+    vm = setup()
+    vm.profile = True
+    if timed(vm) is not None:
+        instructions = sum(vm.profiler.stacks.values())
+
+    peak = None
+    try:
+        tracemalloc.start()
+    except Exception:
+        pass  # not every implementation can trace allocations
+    try:
+        timed(setup())
+        if tracemalloc.is_tracing():
+            peak = tracemalloc.get_traced_memory()[1] // 1024
+    finally:
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+    return {"seconds": best,
+            "runs": runs,
+            "instructions": instructions,
+            "ips": instructions / best if instructions and best else None,
+            "peak_kb": peak}
+
+def compare(results, baseline, threshold=BENCH_THRESHOLD):
+    """Return {name: percent change} and the names that regressed."""
+    changes = {}
+    regressed = []
+    for name, r in results.items():
+        base = baseline.get(name)
+        if not base or not base.get("seconds"):
+            continue
+        change = 100 * (r["seconds"] / base["seconds"] - 1)
+        changes[name] = change
+        if change > threshold:
+            regressed.append(name)
+    return changes, regressed
+
+def report(results, changes, regressed):
+    """Return the results, and any changes from a baseline, as text."""
+    lines = ["BENCHMARK     SECONDS  INSTRUCTIONS     INSTR/S   PEAK KB"
+             + ("    CHANGE" if changes else "")]
+    for name, r in results.items():
+        line = "%-10s %10.4f %13s %11s %9s" % (
+            name, r["seconds"],
+            "" if r["instructions"] is None else r["instructions"],
+            "" if r["ips"] is None else "%.0f" % r["ips"],
+            "" if r["peak_kb"] is None else r["peak_kb"])
+        if name in changes:
+            line += " %+8.1f%%" % changes[name]
+            if name in regressed:
+                line += " REGRESSION"
+        lines.append(line)
+    return "\n".join(lines) + "\n"
+
+def main():
+    """Main entry point."""
+    names = []
+    repeat = BENCH_REPEAT
+    output = None
+    baseline = None
+    threshold = BENCH_THRESHOLD
+    for arg in sys.argv[1:]:
+        if arg.startswith('-r') and arg[2:].isdigit() and int(arg[2:]) > 0:
+            repeat = int(arg[2:])
+        elif arg.startswith('-o') and len(arg) > 2:
+            output = arg[2:]
+        elif arg.startswith('-b') and len(arg) > 2:
+            baseline = arg[2:]
+        elif arg.startswith('-t') and arg[2:].isdigit():
+            threshold = int(arg[2:])
+        elif arg in BENCHMARKS and arg not in names:
+            names.append(arg)
+        else:
+            print(STR_USAGE)
+            sys.exit(1)
+    if baseline is not None:
+        with open(baseline) as f:
+            base = json.load(f)["benchmarks"]
+
+    results = {}
+    for name, setup, timed in benchmarks(names or BENCHMARKS):
+        results[name] = measure(setup, timed, repeat)
+    changes, regressed = {}, []
+    if baseline is not None:
+        changes, regressed = compare(results, base, threshold)
+
+    sys.stdout.write(report(results, changes, regressed))
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump({"python": platform.python_implementation(),
+                       "version": platform.python_version(),
+                       "machine": platform.machine(),
+                       "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                       "repeat": repeat,
+                       "benchmarks": results}, f, indent=2)
+            f.write("\n")
+    if regressed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
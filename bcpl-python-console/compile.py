@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+BCPL Compile and Run
+
+A replacement for compile.sh: compiles a BCPL file to OCODE and INTCODE in
+the current directory, then runs it.  The compiling is done by
+bcplserver.py if one is running, and in this process otherwise.
+
+Source compiled before comes out of the compile cache (see bcplcache.py)
+instead, in which case no OCODE is written; -n bypasses the cache.  The
+OCODE written is what the optimizer (see bcplopt.py) made of it, and the
+INTCODE has been through the peephole optimizer (see bcplpeep.py), unless
+-O0 turns them off.
+
+Usage: python3 compile.py SOURCE [-sSOCKET] [-n] [-O0]
+"""
+
+import sys
+import os
+
+from icint import Machine
+from bcplserver import SOCKET_PATH, Compiler, request, answer
+from bcplcache import CompileCache
+
+STR_USAGE = "USAGE: python compile.py SOURCE [-sSOCKET] [-n] [-O0]"
+
+STAGES = ["Compiling {} to OCODE...", "Compiling OCODE to INTCODE..."]
+
+def compile_source(source, path=SOCKET_PATH, optimized=True):
+    """Compile the BCPL text source (bytes), returning the server's answer.
+
+    Falls back to compiling here when no server is listening at path.
+    """
+    try:
+        return request(source, os.getcwd(), path, optimized)
+    except OSError:
+        return answer(Compiler().compile(source, optimized))
+
+def main():
+    """Main entry point."""
+    source = None
+    path = SOCKET_PATH
+    cache = CompileCache()
+    optimized = True
+    for arg in sys.argv[1:]:
+        if arg.startswith('-s') and len(arg) > 2:
+            path = arg[2:]
+        elif arg == '-n':
+            cache = None
+        elif arg == '-O0':
+            optimized = False
+        elif not arg.startswith('-') and source is None:
+            source = arg
+        else:
+            print(STR_USAGE)
+            sys.exit(1)
+    if source is None:
+        print(STR_USAGE)
+        sys.exit(1)
+    if not os.path.isfile(source):
+        print("Error: Source file '%s' not found" % source)
+        sys.exit(1)
+    hit = None
+    if cache is not None:
+        key = cache.key(source, optimized)
+        hit = cache.get(key)
+    if hit is not None:
+        listings, intcode = hit
+        reply = {"status": 0,
+                 "listings": [s.decode("latin-1") for s in listings],
+                 "intcode": intcode.decode("latin-1")}
+    else:
+        with open(source, 'rb') as f:
+            reply = compile_source(f.read(), path, optimized)
+        if "error" in reply:
+            sys.stderr.write(reply["error"] + "\n")
+            sys.exit(1)
+        if cache is not None and not reply["status"]:
+            cache.put(key, [s.encode("latin-1") for s in reply["listings"]],
+                      reply["intcode"].encode("latin-1"))
+
+    out = sys.stdout.buffer
+    for stage, listing in zip(STAGES, reply["listings"]):
+        out.write((stage.format(source) + "\n").encode("latin-1"))
+        out.write(listing.encode("latin-1"))
+    out.flush()
+    if "ocode" in reply:
+        with open("OCODE", 'wb') as f:
+            f.write(reply["ocode"].encode("latin-1"))
+    if reply["status"]:
+        sys.exit(reply["status"])
+    with open("INTCODE", 'wb') as f:
+        f.write(reply["intcode"].encode("latin-1"))
+
+    out.write(b"Running INTCODE...\n")
+    out.flush()
+    vm = Machine()
+    if not vm.load("INTCODE"):
+        sys.exit(1)
+    sys.exit(vm.run())
+
+if __name__ == "__main__":
+    main()
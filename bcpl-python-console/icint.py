@@ -10,6 +10,14 @@ Ported from the Node.js version at https://github.com/dagfinndybvig/nodeBCPL
 
 import sys
 import os
+import operator
+import re
+import hashlib
+import json
+import mmap
+import struct
+import time
+from array import array
 
 # ============================================================================
 # Constants
@@ -59,13 +67,23 @@ STR_BAD_CH = "BAD CH"
 STR_UNKNOWN_CALL = "UNKNOWN CALL"
 STR_UNKNOWN_EXEC = "UNKNOWN EXEC"
 STR_INTCODE_ERROR_AT_PC = "INTCODE ERROR AT PC"
-STR_USAGE = "USAGE: python icint.py ICFILE [...] [-iINPUT] [-oOUTPUT]"
+STR_BAD_FREEVEC = "BAD FREEVEC"
+STR_BAD_KCALL = "K-CODE CANNOT BE REDEFINED"
+STR_NO_CHECKPOINT = "NO CHECKPOINT"
+STR_STACK_OVERFLOW = "STACK OVERFLOW"
+STR_BAD_STRING = "BAD STRING"
+STR_USAGE = "USAGE: python icint.py ICFILE [...] [-iINPUT] [-oOUTPUT] [-f] [-tN] [-l] [-mWORDS] [-wBITS] [-g]\n       [--profile[=FILE]] [--max-steps=N] [--max-output=BYTES] [--max-stack=WORDS]\n       [--max-time=SECONDS] [--checkpoint=FILE] [--restore=FILE]"
 
-# Memory configuration
+# Memory configuration: the default size in words and word width, as in
+# icint.c.  Machine(words=..., bits=...) chooses others.
 PROGSTART = 401
 WORDCOUNT = 19900
+WORDBITS = 16
 LABVCOUNT = 500
 
+# Word widths supported, with the array typecode that holds a word
+WORD_TYPES = {16: 'h', 32: 'i'}
+
 # Instruction encoding
 FN_BITS = 8
 FN_MASK = 255
@@ -81,6 +99,68 @@ FI_BIT = 1 << 3
 FP_BIT = 1 << 4
 FD_BIT = 1 << 5
 
+# Decoded opcodes: the function code with its FI/FP bits folded in,
+# plus a marker for words that still have to be decoded
+OP_MASK = FP_BIT | FI_BIT | 7
+OP_DECODE = 32
+
+# Superinstructions: common pairs of decoded instructions fused by fuse()
+OP_SP_LIP = 40
+OP_SP_LI = 41
+OP_SP_L = 42
+OP_LIP_SP = 43
+OP_LI_SP = 44
+OP_L_SP = 45
+OP_LIP_AIP = 46
+OP_L_X = 47
+OP_LI_X = 48
+OP_LIP_X = 49
+OP_LI_K = 50
+OP_CMP_F = 51
+OP_CMP_T = 52
+OP_LIMIT = 64
+
+# Added to a superinstruction when its executions are being counted
+OP_COUNTED = 32
+
+# Compiled block and block leader entries (see mark_leaders())
+OP_JIT = 96
+OP_ENTRY = 97
+
+# Entry that counts its instruction for the profiler
+OP_PROFILE = 98
+
+# Loop head entry that counts a step against the run limits
+OP_CHECK = 99
+
+# Heap free lists: one per block size below HEAP_SMALL words, then one per
+# power of two
+HEAP_SMALL = 32
+HEAP_CLASSES = HEAP_SMALL + 32
+
+# Words kept free between the stack and the heap, for the frame of the
+# routine called last: the stack is checked against the heap on calls
+STACK_MARGIN = 128
+
+# Block compiler: entries before a block is compiled, fewest and most
+# instructions compiled into one function
+JIT_THRESHOLD = 200
+JIT_MIN_BLOCK = 4
+JIT_MAX_BLOCK = 100
+
+# Longest run of words a single decoded entry can read
+DEC_SPAN = 4
+
+# Run limits: most steps taken between two checks of the time limit, and
+# the exit code of a run stopped by a limit, one that neither timeout(1)
+# (124 to 127), xargs (123) nor Python (120) exits with
+LIMIT_INTERVAL = 1000
+LIMIT_STATUS = 121
+
+# Command line options that set the run limits, and the Machine attributes
+LIMIT_OPTIONS = {"--max-steps": "step_limit", "--max-output": "output_limit",
+                 "--max-stack": "stack_limit", "--max-time": "time_limit"}
+
 # K-codes (system calls)
 K01_START = 1
 K02_SETPM = 2
@@ -126,84 +206,195 @@ K88_FREEVEC = 88
 K89_RANDOM = 89
 K90_MULDIV = 90
 K91_RESULT2 = 91
+K92_CHECKPOINT = 92
+
+# K-codes that change or save the interpreter's registers and so are
+# handled in interpret() itself; every other K-code goes through
+# Machine.kcalls
+KCONTROL = (K02_SETPM, K30_STOP, K31_LEVEL, K32_LONGJUMP, K40_APTOVEC,
+            K92_CHECKPOINT)
+
+# RANDOM(seed) is this linear congruential step, wrapped to a word
+RANDOM_MULTIPLIER = 2147001325
+RANDOM_INCREMENT = 715136305
+
+# Library routine names by K-code, which is also their global number
+KNAMES = {v: k[4:] for k, v in list(globals().items())
+          if k[0] == 'K' and k[1:3].isdigit() and k[3] == '_'}
 
 ENDSTREAMCH = -1
-BYTESPERWORD = 2
 
 # ============================================================================
-# Memory - Using a list for fast access (Python lists are faster than array.array)
+# Word Arithmetic
 # ============================================================================
 
-# Use a plain Python list - values stored as Python integers,
-# converted to 16-bit signed values when needed for INTCODE semantics
-m = [0] * WORDCOUNT
-
-def _get_byte(byte_idx):
-    """Get a byte from memory (little-endian)."""
-    word_idx = byte_idx >> 1
-    val = m[word_idx] & 0xFFFF
-    if byte_idx & 1:
-        return (val >> 8) & 0xFF
-    return val & 0xFF
-
-def _set_byte(byte_idx, val):
-    """Set a byte in memory (little-endian)."""
-    word_idx = byte_idx >> 1
-    current = m[word_idx] & 0xFFFF
-    val = val & 0xFF
-    if byte_idx & 1:
-        new_val = (current & 0x00FF) | (val << 8)
-    else:
-        new_val = (current & 0xFF00) | val
-    # Convert to signed 16-bit if > 32767
-    if new_val >= 0x8000:
-        new_val -= 0x10000
-    m[word_idx] = new_val
-
-def mu_get(idx):
-    """Get unsigned 16-bit value at index."""
-    return m[idx] & 0xFFFF
-
-def m_set(idx, val):
-    """Set a 16-bit value in memory, handling sign."""
+def _signed16(val):
+    """val wrapped to a signed 16-bit value."""
     val = val & 0xFFFF
-    if val >= 0x8000:
-        val -= 0x10000
-    m[idx] = val
-
-# Global state
-lomem = 0
-himem = WORDCOUNT - 1
-cis = 0
-cos = 0
-sysin = 0
-sysprint = 0
-
-# Assembler state
-cp = 0
-ch = 0
-labv_offset = WORDCOUNT - LABVCOUNT
-
-# File handles - dictionary to track open files
-_file_handles = {}
-_next_handle = 10  # Start from 10 to avoid conflicts with stdin/stdout
+    return val - 0x10000 if val >= 0x8000 else val
+
+def _signed32(val):
+    """val wrapped to a signed 32-bit value."""
+    val = val & 0xFFFFFFFF
+    return val - 0x100000000 if val >= 0x80000000 else val
+
+# SIGNED[bits] wraps a value to a word of that width
+SIGNED = {16: _signed16, 32: _signed32}
+
+# ============================================================================
+# Superinstructions
+# ============================================================================
+
+# Pairs (first op, second op) rewritten by fuse().  The second op 7 (X)
+# matches any X operation.
+FUSIONS = {
+    (17, 24): OP_SP_LIP,
+    (17, 8): OP_SP_LI,
+    (17, 0): OP_SP_L,
+    (24, 17): OP_LIP_SP,
+    (8, 17): OP_LI_SP,
+    (0, 17): OP_L_SP,
+    (24, 26): OP_LIP_AIP,
+    (0, 7): OP_L_X,
+    (8, 7): OP_LI_X,
+    (24, 7): OP_LIP_X,
+    (8, 6): OP_LI_K,
+}
+
+FUSION_NAMES = {
+    OP_SP_LIP: "SP;LIP",
+    OP_SP_LI: "SP;LI",
+    OP_SP_L: "SP;L",
+    OP_LIP_SP: "LIP;SP",
+    OP_LI_SP: "LI;SP",
+    OP_L_SP: "L;SP",
+    OP_LIP_AIP: "LIP;AIP",
+    OP_L_X: "L;X",
+    OP_LI_X: "LI;X",
+    OP_LIP_X: "LIP;X",
+    OP_LI_K: "LI;K",
+    OP_CMP_F: "X(cmp);F",
+    OP_CMP_T: "X(cmp);T",
+}
+
+# X operations 10-15 that a compare-and-jump superinstruction can absorb
+COMPARISONS = {
+    10: operator.eq,
+    11: operator.ne,
+    12: operator.lt,
+    13: operator.ge,
+    14: operator.gt,
+    15: operator.le,
+}
+
+# ============================================================================
+# Block Compiler (JIT)
+# ============================================================================
+
+def _signed_expr(expr, bits):
+    """Python expression for expr wrapped to a signed value of bits bits."""
+    half = 1 << (bits - 1)
+    return "(((%s) + %d) & %d) - %d" % (expr, half, 2 * half - 1, half)
+
+def _jit_xops(bits):
+    """Straight-line X operations as Python source, mirroring interpret()."""
+    def wrap(expr):
+        return ["a = " + _signed_expr(expr, bits)]
+    return {
+        1: ["a = m[a]"],
+        2: wrap("-a"),
+        3: wrap("~a"),
+        5: wrap("b * a"),
+        6: ["if a != 0:",
+            "    a = (-1 if (b < 0) != (a < 0) else 1) * (abs(b) // abs(a))"],
+        7: ["if a != 0:",
+            "    a = -(abs(b) % abs(a)) if b < 0 else abs(b) % abs(a)"],
+        8: wrap("b + a"),
+        9: wrap("b - a"),
+        10: ["a = -1 if (b == a) else 0"],
+        11: ["a = -1 if (b != a) else 0"],
+        12: ["a = -1 if (b < a) else 0"],
+        13: ["a = -1 if (b >= a) else 0"],
+        14: ["a = -1 if (b > a) else 0"],
+        15: ["a = -1 if (b <= a) else 0"],
+        16: wrap("b << a"),
+        17: wrap("(b & %d) >> a" % ((1 << bits) - 1)),
+        18: wrap("b & a"),
+        19: wrap("b | a"),
+        20: wrap("b ^ a"),
+        21: wrap("b ^ ~a"),
+    }
+
+# JIT_XOPS[bits] is the X operation table for words of that width
+JIT_XOPS = {bits: _jit_xops(bits) for bits in WORD_TYPES}
+
+def _operand(op, d):
+    """Python expression for the resolved operand of a decoded op."""
+    if op & FP_BIT:
+        expr = "sp + %d" % d
+        return "m[%s]" % expr if op & FI_BIT else "(%s)" % expr
+    return "m[%d]" % d if op & FI_BIT else "%d" % d
+
+def _address(op, d):
+    """Python expression for the address a decoded S op stores to."""
+    if op & FP_BIT:
+        return "m[sp + %d]" % d if op & FI_BIT else "sp + %d" % d
+    return "m[%d]" % d if op & FI_BIT else "%d" % d
+
+def _enters(insts, pc):
+    """Check that the compiled code can start at pc without exiting at once."""
+    op, d, _ = insts[pc]
+    fn = op & 7
+    if fn == F6_K:
+        return False
+    if fn == F7_X:
+        return op == F7_X and (d in JIT_XOPS[WORDBITS] or d == 4 or d == 23)
+    return True
+
+def _place(lines, blocks, labels, ind):
+    """Lay out the blocks at the sorted labels behind a tree of pc tests.
+
+    Entering at any label takes about log2(len(labels)) tests.  Blocks
+    stay in address order, so a forward jump falls through to its target.
+    """
+    if len(labels) <= 4:
+        for label in labels:
+            lines.append("%sif pc == %d:" % (ind, label))
+            lines.extend(ind + "    " + s for s in blocks[label])
+        return
+    mid = len(labels) // 2
+    lines.append("%sif pc < %d:" % (ind, labels[mid]))
+    _place(lines, blocks, labels[:mid], ind + "    ")
+    _place(lines, blocks, labels[mid:], ind)
 
 # ============================================================================
 # String Handling
 # ============================================================================
 
-def cstr(s_ptr):
-    """Convert BCPL string (packed) to Python string.
-    
-    BCPL strings are packed: length byte, then chars.
-    s_ptr is a word index in memory.
+# BCPL packs strings into words low byte first, so a run of words is
+# converted to and from bytes in one go through an array view.  typecode
+# is the array typecode of a word (see WORD_TYPES).
+
+def words_to_bytes(words, typecode='h'):
+    """Return the bytes packed in a sequence of words."""
+    words = array(typecode, words)
+    if sys.byteorder == 'big':
+        words.byteswap()
+    return words.tobytes()
+
+def bytes_to_words(data, typecode='h'):
+    """Return a list of the words that pack data.
+
+    Bytes left over at the end go in the low bytes of a word of their own.
     """
-    byte_idx = s_ptr * 2
-    length = _get_byte(byte_idx)
-    chars = []
-    for i in range(length):
-        chars.append(chr(_get_byte(byte_idx + 1 + i)))
-    return ''.join(chars)
+    words = array(typecode)
+    spare = len(data) % words.itemsize
+    if spare:
+        data += bytes(words.itemsize - spare)
+    words.frombytes(data)
+    if sys.byteorder == 'big':
+        words.byteswap()
+    return words.tolist()
 
 def decval(c):
     """Convert character to decimal value."""
@@ -215,717 +406,2587 @@ def decval(c):
 
 STRDIGITS = "0123456789ABCDEF"
 
+def _decimal(n, d):
+    """Digits of n right-justified in a field of width d."""
+    return str(n).rjust(d).encode()
+
+def _digits(n, d, shift):
+    """The low d (at least one) digits of unsigned n in base 2 ** shift."""
+    mask = (1 << shift) - 1
+    return "".join(STRDIGITS[(n >> (shift * i)) & mask]
+                   for i in range(max(d, 1) - 1, -1, -1)).encode()
+
 # ============================================================================
 # File I/O
 # ============================================================================
 
-def openfile(fn, mode):
-    """Open a file and return a handle."""
-    global _next_handle, _file_handles
-    
-    fn_upper = fn.upper()
-    if fn_upper == "SYSIN":
-        return sysin
-    if fn_upper == "SYSPRINT":
-        return sysprint
-    
+# Output is collected in OutputBuffers and written OUTPUT_BUFFER bytes at a
+# time.  SYSPRINT is also flushed at every newline if its buffer has lines
+# set (by default, if it is a terminal), before reading from a terminal,
+# and when the program stops.
+OUTPUT_BUFFER = 8192
+
+def findfile(fn):
+    """Return the file that opening fn for input reads, or None.
+
+    That is fn itself or, failing that, fn in lower case.
+    """
+    if os.path.exists(fn):
+        return fn
+    if fn != fn.lower() and os.path.exists(fn.lower()):
+        return fn.lower()
+    return None
+
+class OutputBuffer:
+    """Buffer in front of a binary output stream.
+
+    written counts the bytes passed on to the stream so far.
+    """
+
+    def __init__(self, stream, lines=False):
+        self.stream = stream
+        self.lines = lines
+        self.buf = bytearray()
+        self.written = 0
+
+    def putc(self, c):
+        """Write the byte c."""
+        self.buf.append(c)
+        if (c == ASC_LF and self.lines) or len(self.buf) >= OUTPUT_BUFFER:
+            self.flush()
+
+    def write(self, data):
+        """Write the bytes in data."""
+        self.buf += data
+        if (self.lines and b"\n" in data) or len(self.buf) >= OUTPUT_BUFFER:
+            self.flush()
+
+    def flush(self):
+        if self.buf:
+            self.stream.write(self.buf)
+            self.written += len(self.buf)
+            self.buf.clear()
+        self.stream.flush()
+
+    def close(self):
+        self.flush()
+        self.stream.close()
+
+class InputPending(Exception):
+    """Raised by rdch() when the input stream has no character ready yet.
+
+    A stream says so by returning None from read(), as non-blocking
+    streams do.  interpret() then returns with the call waiting, to make
+    it again when resumed.
+    """
+
+# ============================================================================
+# Assembler
+# ============================================================================
+
+# INTCODE comments run from / to the end of the line, taking the line ends
+# after them too
+ASM_COMMENT = re.compile(rb'/[^\n]*\n*')
+
+# The tokens of INTCODE, each with the layout after it.  A number is read
+# as far as it goes; "-" alone is 0, like no number at all (see
+# asm_number()).
+_ASM_NUMBER = rb'(-?[0-9]*)'
+ASM_TOKEN = re.compile(rb'''(?:
+    ([LSAJTFKX])(I?)(P?)G?(L?)%(n)s     # 0-4 instruction
+  | ([0-9]+)                            # 5 label definition
+  | (C)%(n)s                            # 6-7 character
+  | (D)(L?)%(n)s                        # 8-10 data word or label
+  | (G)%(n)s(L?)%(n)s                   # 11-14 global initialized to label
+  | (Z)                                 # 15 end of section
+  | ^                                   # layout at the start
+  | (.)                                 # 16 anything else
+)[$ \n]*''' % {b"n": _ASM_NUMBER}, re.X | re.S)
+
+def asm_number(s):
+    """Return the value of a number ASM_TOKEN matched."""
+    return int(s) if s and s != b"-" else 0
+
+ASM_FUNCTIONS = {b"L": F0_L, b"S": F1_S, b"A": F2_A, b"J": F3_J, b"T": F4_T,
+                 b"F": F5_F, b"K": F6_K, b"X": F7_X}
+
+# ============================================================================
+# Memory Images
+# ============================================================================
+
+# Each assembled file is cached next to it as FILE.icimg so that later runs
+# can skip assemble().  All fields are little-endian:
+#   IMAGE_MAGIC, SHA-1 of the source (20 bytes), word width in bits (uint8),
+#   start, end, number of globals (uint32 each),
+#   the globals as (index, value) pairs of words,
+#   the assembled words m[start:end].
+# Assembled code is position dependent, so an image only matches a load at
+# the same start address and word width.  Set image_cache to False to
+# always assemble.
+IMAGE_MAGIC = b"ICIMG\x00\x02\x00"
+IMAGE_SUFFIX = ".icimg"
+IMAGE_HEADER = struct.Struct("<8s20sBIII")
+
+# ============================================================================
+# Checkpoints
+# ============================================================================
+
+# A checkpoint holds the state of a run, to carry on from later (see
+# Machine.checkpoint()).  Little-endian, like an image:
+#   CHECKPOINT_MAGIC, word width in bits (uint8), words of memory and
+#   bytes of state (uint32 each),
+#   the state as JSON: registers, lomem, streams, heap,
+#   all of memory, m[0:words].
+CHECKPOINT_MAGIC = b"ICCKP\x00\x01\x00"
+CHECKPOINT_HEADER = struct.Struct("<8sBII")
+
+# CHECKPOINT() returns this in a run restored from the checkpoint
+CHECKPOINT_RESTORED = 1
+
+def checkpoint_shape(path):
+    """Return (words, bits) of the memory saved in the checkpoint at path.
+
+    Raises OSError if it cannot be read and ValueError if it is not a
+    checkpoint.
+    """
+    with open(path, 'rb') as f:
+        header = f.read(CHECKPOINT_HEADER.size)
     try:
-        if mode == 'r':
-            # Try original filename first, then lowercase
-            try:
-                f = open(fn, 'rb')
-            except FileNotFoundError:
-                if fn != fn.lower():
-                    f = open(fn.lower(), 'rb')
+        magic, bits, words, _ = CHECKPOINT_HEADER.unpack(header)
+    except struct.error:
+        magic = None
+    if magic != CHECKPOINT_MAGIC:
+        raise ValueError("%s is not a checkpoint" % path)
+    return words, bits
+
+# ============================================================================
+# Profiler
+# ============================================================================
+
+PROFILE_FILE = "profile.folded"
+PROFILE_TOP = 20
+PROFILE_ROOT = "(startup)"
+
+FN_NAMES = "LSAJTFKX"
+
+def disassemble(op, d):
+    """INTCODE text for the decoded instruction (op, d)."""
+    return "%s%s%s %d" % (FN_NAMES[op & 7], "I" if op & FI_BIT else "",
+                          "P" if op & FP_BIT else "", d)
+
+class Profiler:
+    """Counts the instructions a machine executes, by pc and by routine.
+
+    step() is called before every instruction.  A routine is entered when
+    the stack pointer rises to a new frame, and left when it falls back
+    below that frame, so calls, returns, APTOVEC and LONGJUMP are all
+    followed.  Each instruction is charged to the chain of routines active
+    at the time, and library calls are timed separately.
+    """
+
+    def __init__(self, vm):
+        self.vm = vm
+        self.counts = [0] * (vm.words + 1)
+        self.calls = {}             # routine entry -> times entered
+        self.stacks = {}            # tuple of routine entries -> count
+        # (entry, frame) of the active routines, the first being the
+        # startup code at the bottom of the stack
+        self.frames = [(None, vm.lomem)]
+        self.stack = ()
+        self.kcalls = {}            # K-code -> [calls, seconds]
+
+    def step(self, pc, sp):
+        frames = self.frames
+        frame = frames[-1][1]
+        if sp != frame:
+            while sp < frame:
+                frames.pop()
+                frame = frames[-1][1]
+            if sp > frame:
+                frames.append((pc, sp))
+                self.calls[pc] = self.calls.get(pc, 0) + 1
+            self.stack = tuple(entry for entry, _ in frames[1:])
+        self.counts[pc] += 1
+        stack = self.stack
+        self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def timed(self, kcalls):
+        """Return a copy of the handler table kcalls that times each call."""
+        def wrap(code, fn):
+            stats = self.kcalls.setdefault(code, [0, 0.0])
+            clock = time.perf_counter
+
+            def call(vm, v):
+                start = clock()
+                try:
+                    return fn(vm, v)
+                finally:
+                    stats[0] += 1
+                    stats[1] += clock() - start
+            return call
+        return {code: wrap(code, fn) for code, fn in kcalls.items()}
+
+    def names(self):
+        """Return a function naming routine entries.
+
+        A routine is named after the lowest global that holds its entry:
+        by its library name if it has one, or as Gn.  Others are Ln, n
+        being the entry address.
+        """
+        m = self.vm.m
+        globals_at = {}
+        for g in range(PROGSTART - 1, -1, -1):
+            globals_at[m[g]] = g
+
+        def name(entry):
+            if entry is None:
+                return PROFILE_ROOT
+            g = globals_at.get(entry)
+            if g is None:
+                return "L%d" % entry
+            return KNAMES.get(g, "G%d" % g)
+        return name
+
+    def collapsed(self):
+        """Return the instruction counts as collapsed stacks.
+
+        Each line is the active routines, outermost first, separated by
+        semicolons, and the number of instructions executed there, as the
+        flame graph tools expect.
+        """
+        name = self.names()
+        lines = []
+        for stack, n in self.stacks.items():
+            lines.append("%s %d" % (";".join(
+                [PROFILE_ROOT] + [name(entry) for entry in stack]), n))
+        lines.sort()
+        return "\n".join(lines) + "\n"
+
+    def report(self, top=PROFILE_TOP):
+        """Return a text report of the routines, pcs and K-codes."""
+        name = self.names()
+        total = sum(self.stacks.values())
+        inclusive = {}
+        exclusive = {}
+        for stack, n in self.stacks.items():
+            entry = stack[-1] if stack else None
+            exclusive[entry] = exclusive.get(entry, 0) + n
+            for e in set(stack) | {None}:
+                inclusive[e] = inclusive.get(e, 0) + n
+        lines = ["PROFILE: %d INSTRUCTIONS" % total, "",
+                 "ROUTINE        ENTRY      CALLS   INCLUSIVE   EXCLUSIVE"]
+        for entry in sorted(inclusive, key=lambda e: (-exclusive.get(e, 0),
+                                                      -inclusive[e],
+                                                      e or 0)):
+            lines.append("%-12s %7s %10d %11d %11d" % (
+                name(entry), "" if entry is None else entry,
+                self.calls.get(entry, 1 if entry is None else 0),
+                inclusive[entry], exclusive.get(entry, 0)))
+        lines += ["", "PC           COUNT  INSTRUCTION"]
+        hot = sorted((pc for pc, n in enumerate(self.counts) if n),
+                     key=lambda pc: -self.counts[pc])
+        for pc in hot[:top]:
+            op, d, _, _ = self.vm.decode(pc)
+            lines.append("%-7d %10d  %s" % (pc, self.counts[pc],
+                                            disassemble(op, d)))
+        lines += ["", "K-CODE             CALLS     SECONDS"]
+        for code, (calls, seconds) in sorted(self.kcalls.items(),
+                                             key=lambda kv: -kv[1][1]):
+            if calls:
+                lines.append("%2d %-12s %8d %11.6f" % (
+                    code, KNAMES.get(code, ""), calls, seconds))
+        return "\n".join(lines) + "\n"
+
+# ============================================================================
+# Machine
+# ============================================================================
+
+class Machine:
+    """An INTCODE machine: memory, streams and assembler state.
+
+    Each machine is independent of the others, so several can run in one
+    process, one per thread.  load() assembles INTCODE files into memory,
+    run() executes them and reset() clears the machine for another program.
+    stdin and stdout are the binary streams behind SYSIN and SYSPRINT, by
+    default those of the process.  Memory holds words words of bits bits
+    each (16 or 32); the defaults match icint.c.
+    """
+
+    # Entries before a block is compiled; 0 turns the block compiler off
+    jit_threshold = JIT_THRESHOLD
+    # Count superinstruction hits for fusion_report()
+    fusion_stats = False
+    # Cache assembled files as memory images
+    image_cache = True
+    # Count instructions with a Profiler, left in profiler by run().  The
+    # superinstructions and block compiler are off while profiling.
+    profile = False
+    profiler = None
+    # Run limits, 0 for none: steps (see check_limits()), bytes of output,
+    # words of stack and seconds of wall time.  A run that reaches one
+    # stops with exit code LIMIT_STATUS and names it in limit_hit.
+    step_limit = 0
+    output_limit = 0
+    stack_limit = 0
+    time_limit = 0
+    # Save a checkpoint to this file when a run limit stops the program
+    checkpoint_file = None
+
+    def __init__(self, stdin=None, stdout=None, line_flush=None,
+                 words=WORDCOUNT, bits=WORDBITS):
+        if bits not in WORD_TYPES:
+            raise ValueError("word width must be one of %s, not %r"
+                             % (sorted(WORD_TYPES), bits))
+        # Addresses are words too, so all of memory must be addressable
+        if not PROGSTART < words <= 1 << (bits - 1):
+            raise ValueError("%d words of memory with %d-bit words"
+                             % (words, bits))
+        if stdin is None:
+            stdin = sys.stdin.buffer
+        if stdout is None:
+            stdout = sys.stdout.buffer
+        if line_flush is None:
+            line_flush = stdout.isatty()
+        self.stdin = stdin
+        self.stdout = OutputBuffer(stdout, line_flush)
+        self._tty_input = stdin.isatty()
+        self.words = words
+        self.bits = bits
+        self.bytesperword = bits // 8
+        self.mask = (1 << bits) - 1
+        self.signed = SIGNED[bits]
+        self.typecode = WORD_TYPES[bits]
+        self.jit_xops = JIT_XOPS[bits]
+        # K-code -> fn(machine, v), where v is the address of the first
+        # argument; see register_kcall()
+        self.kcalls = dict(self.KCALLS)
+        # Binary streams that opening a file of the given (upper case) name
+        # returns instead of a file on disk, e.g. to pass OCODE between two
+        # machines
+        self.named_streams = {}
+        self._file_handles = {}
+        self.reset()
+
+    def reset(self):
+        """Close the program's files and clear memory, ready for load()."""
+        if self._file_handles:
+            self.closefiles()
+
+        # Memory - a plain Python list of ints, kept as signed values of
+        # the word width for INTCODE semantics
+        self.m = [0] * self.words
+
+        # dec[i] holds (op, d, e, next_pc) for the instruction starting at
+        # word i, so interpret() does not have to re-decode raw words on
+        # every step.  e is only used by superinstructions and is 0
+        # otherwise.  Words never executed are None and invalidated entries
+        # are (OP_DECODE, 0, 0, i); both get decoded on first use.  The
+        # extra entry at the end is scratch space for interpret().  Any
+        # store into [code_lo, code_hi) must call invalidate() so that
+        # programs which write into their own code keep working.
+        self.dec = [None] * (self.words + 1)
+        self.code_lo = 0
+        self.code_hi = 0
+
+        # SWITCHON table address -> (cases, default), and word -> set of
+        # the tables it is part of
+        self.switches = {}
+        self.switch_cover = {}
+
+        self._reset_heap()
+
+        # Per-superinstruction counts: sites rewritten and times executed.
+        # Hits are only counted when fusion_stats is set, since counting
+        # costs time.
+        self.fusion_sites = [0] * OP_LIMIT
+        self.fusion_hits = [0] * OP_LIMIT
+
+        # Block compiler: entry pc -> (function, block starts, words it was
+        # built from), and word -> set of entry pcs of functions built from
+        # that word
+        self.jit_blocks = {}
+        self.jit_cover = {}
+
+        # Run limits: whether the running program is limited, the steps it
+        # has taken, those allowed before the next check, and the limit
+        # that stopped it
+        self.limited = False
+        self.steps = 0
+        self._slice_end = 0
+        self._allowed = 0
+        self._depth = 0
+        self.limit_hit = None
+        self._started = 0
+        self._output_base = 0
+        self._output_closed = 0
+        # Bytes of output the limit still allows, None without one
+        self._output_room = None
+
+        # A run in progress: the registers (a, b, sp, pc) it stopped with,
+        # the library call (handler, argument pointer) waiting for input,
+        # and what interpret() set up for it
+        self._regs = None
+        self._pending = None
+        self.waiting = False
+        self._run_kcalls = self.kcalls
+        self._heads = None
+        # The registers a restored run starts from (see restore())
+        self._restored = None
+
+        # Assembler state.  The label vector is kept apart from memory, so
+        # that all of it is left for the program.
+        self.labv = [0] * LABVCOUNT
+        self.assembled_globals = set()  # global vector entries set by G
+
+        # File handles; stdin = 1, stdout = 2 (1-based, like the C/JS
+        # version) and opened files from 10 up
+        self._file_handles = {1: self.stdin, 2: self.stdout}
+        self._next_handle = 10
+        # handle -> (name, mode, in named_streams) of the opened files
+        self._file_names = {}
+        self.cis = self.sysin = 1
+        self.cos = self.sysprint = 2
+        # The last character read, as (handle, character), for UNRDCH, and
+        # by handle the characters given back, to be read again last first
+        self._lastread = None
+        self._unread = {}
+        self.result2 = 0
+
+        # Initialize global vector
+        m = self.m
+        for i in range(PROGSTART):
+            m[i] = i
+        self.lomem = PROGSTART
+
+        # Store initial code
+        self.stw(F0_L | FI_BIT | (K01_START << FN_BITS))
+        self.stw(F6_K | (2 << FN_BITS))
+        self.stw(F7_X | (22 << FN_BITS))
+
+    # ========================================================================
+    # Memory
+    # ========================================================================
+
+    def _get_byte(self, byte_idx):
+        """Get a byte from memory (little-endian)."""
+        word_idx, i = divmod(byte_idx, self.bytesperword)
+        return (self.m[word_idx] >> (i << 3)) & 0xFF
+
+    def _set_byte(self, byte_idx, val):
+        """Set a byte in memory (little-endian)."""
+        word_idx, i = divmod(byte_idx, self.bytesperword)
+        shift = i << 3
+        self.m[word_idx] = self.signed((self.m[word_idx] & ~(0xFF << shift))
+                                       | ((val & 0xFF) << shift))
+        if self.code_lo <= word_idx < self.code_hi:
+            self.invalidate(word_idx, word_idx + 1)
+
+    def mu_get(self, idx):
+        """Get the unsigned value of the word at index."""
+        return self.m[idx] & self.mask
+
+    def m_set(self, idx, val):
+        """Set a word in memory, handling sign."""
+        self.m[idx] = self.signed(val)
+        if self.code_lo <= idx < self.code_hi:
+            self.invalidate(idx, idx + 1)
+
+    # ========================================================================
+    # Heap
+    # ========================================================================
+
+    # GETVEC takes vectors from a heap at the top of memory, which grows
+    # down towards the stack as it fills.  The blocks are in memory; their
+    # sizes are kept here, where the program cannot overwrite them.  Free
+    # blocks are merged with free neighbours as they are freed, and a free
+    # block at the bottom of the heap goes back to the stack.
+
+    def _reset_heap(self):
+        self.heap_lo = self.words
+        self.heap_used = {}         # start -> size of each allocated block
+        self.heap_free = {}         # start -> size of each free block
+        self.heap_free_end = {}     # end -> start of each free block
+        # Free block starts by size class, and a bit per non-empty class
+        self.heap_lists = [{} for _ in range(HEAP_CLASSES)]
+        self.heap_classes = 0
+        self.heap_in_use = 0
+        self.heap_peak = 0
+        self.heap_peak_size = 0
+        self.heap_allocs = 0
+        self.heap_frees = 0
+
+    @staticmethod
+    def _heap_class(size):
+        if size < HEAP_SMALL:
+            return size
+        return HEAP_SMALL + size.bit_length() - HEAP_SMALL.bit_length()
+
+    def _add_free(self, start, size):
+        c = self._heap_class(size)
+        self.heap_free[start] = size
+        self.heap_free_end[start + size] = start
+        self.heap_lists[c][start] = None
+        self.heap_classes |= 1 << c
+
+    def _remove_free(self, start):
+        size = self.heap_free.pop(start)
+        del self.heap_free_end[start + size]
+        c = self._heap_class(size)
+        free = self.heap_lists[c]
+        del free[start]
+        if not free:
+            self.heap_classes &= ~(1 << c)
+        return size
+
+    def _take_free(self, size):
+        """Remove a free block of at least size words; None if there is none.
+
+        Every block in a class above size's own is big enough, so only
+        when there is none is size's class searched for one that fits.
+        """
+        c = self._heap_class(size)
+        if c < HEAP_SMALL:
+            above = self.heap_classes >> c
+        else:
+            above = self.heap_classes >> (c + 1) << 1
+        if above:
+            c += (above & -above).bit_length() - 1
+            start = next(iter(self.heap_lists[c]))
+        else:
+            start = next((b for b in self.heap_lists[c]
+                          if self.heap_free[b] >= size), None)
+            if start is None:
+                return None
+        return start, self._remove_free(start)
+
+    def getvec(self, n, limit):
+        """Allocate a vector with subscripts 0 to n.
+
+        Returns its address, or 0 if there is no room for it without the
+        heap reaching down to STACK_MARGIN words above limit, the top of
+        the stack.
+        """
+        if n < 0:
+            return 0
+        size = n + 1
+        block = self._take_free(size)
+        if block is None:
+            start = self.heap_lo - size
+            if start <= limit + STACK_MARGIN:
+                return 0
+            self.heap_lo = start
+        else:
+            start, free = block
+            if free > size:
+                self._add_free(start + size, free - size)
+        self.heap_used[start] = size
+        self.heap_allocs += 1
+        self.heap_in_use += size
+        self.heap_peak = max(self.heap_peak, self.heap_in_use)
+        self.heap_peak_size = max(self.heap_peak_size,
+                                  self.words - self.heap_lo)
+        return start
+
+    def freevec(self, v):
+        """Free the vector at v, which GETVEC returned.  0 is ignored."""
+        if v == 0:
+            return
+        size = self.heap_used.pop(v, None)
+        if size is None:
+            self.halt(STR_BAD_FREEVEC, v)
+        self.heap_frees += 1
+        self.heap_in_use -= size
+        if v + size in self.heap_free:
+            size += self._remove_free(v + size)
+        if v in self.heap_free_end:
+            start = self.heap_free_end[v]
+            size += self._remove_free(start)
+            v = start
+        if v == self.heap_lo:
+            self.heap_lo += size
+        else:
+            self._add_free(v, size)
+
+    def heap_stats(self):
+        """Return a dict of statistics on the heap, sizes in words.
+
+        fragmentation is the part of the free space that is not in the
+        largest free block, from 0 (none) to 1.
+        """
+        free = sum(self.heap_free.values())
+        largest = max(self.heap_free.values(), default=0)
+        return {"size": self.words - self.heap_lo,
+                "peak_size": self.heap_peak_size,
+                "in_use": self.heap_in_use,
+                "peak_in_use": self.heap_peak,
+                "free": free,
+                "free_blocks": len(self.heap_free),
+                "largest_free": largest,
+                "fragmentation": 1 - largest / free if free else 0.0,
+                "allocs": self.heap_allocs,
+                "frees": self.heap_frees}
+
+    def heap_report(self):
+        """Return a text report of heap_stats()."""
+        st = self.heap_stats()
+        return ("HEAP SIZE %d WORDS (PEAK %d)\n"
+                "IN USE    %d WORDS (PEAK %d)\n"
+                "FREE      %d WORDS IN %d BLOCKS (LARGEST %d)\n"
+                "FRAGMENTATION %.1f%%\n"
+                "GETVEC %d FREEVEC %d\n"
+                % (st["size"], st["peak_size"], st["in_use"],
+                   st["peak_in_use"], st["free"], st["free_blocks"],
+                   st["largest_free"], 100 * st["fragmentation"],
+                   st["allocs"], st["frees"]))
+
+    # ========================================================================
+    # Decoded Instruction Stream
+    # ========================================================================
+
+    def decode(self, pc):
+        """Decode the instruction at pc into an (op, d, e, next_pc) entry."""
+        w = self.m[pc] & self.mask
+        if w & FD_BIT:
+            return (w & OP_MASK, self.m[pc + 1], 0, pc + 2)
+        return (w & OP_MASK, w >> FN_BITS, 0, pc + 1)
+
+    def predecode(self, lo, hi):
+        """Decode every word in [lo, hi) and mark it as code."""
+        for pc in range(lo, hi):
+            self.dec[pc] = self.decode(pc)
+        self.code_lo = lo
+        self.code_hi = hi
+
+    def invalidate(self, lo, hi):
+        """Drop the decoded entries that read any word in [lo, hi)."""
+        if hi <= self.code_lo or lo >= self.code_hi:
+            return
+        # An entry starting up to DEC_SPAN - 1 words earlier may read word lo
+        for i in range(max(lo - DEC_SPAN + 1, 0), hi):
+            self.dec[i] = (OP_DECODE, 0, 0, i)
+        if self.switch_cover:
+            for w in range(lo, hi):
+                for t in self.switch_cover.pop(w, ()):
+                    self.switches.pop(t, None)
+        if self.jit_blocks:
+            self.evict(lo, hi)
+
+    def switch_table(self, t):
+        """Index the SWITCHON table at t and return it as (cases, default).
+
+        cases maps each case value to its target.  The table's words are
+        marked as code, so that a store into them drops the index again.
+        """
+        m = self.m
+        cnt = m[t]
+        end = t + 2 + 2 * max(cnt, 0)
+        cases = {}
+        for i in range(t + 2, end, 2):
+            # The first of two equal cases wins, as in a linear search
+            cases.setdefault(m[i], m[i + 1])
+        table = self.switches[t] = (cases, m[t + 1])
+        for w in range(t, end):
+            self.switch_cover.setdefault(w, set()).add(t)
+        if t < self.code_lo:
+            self.code_lo = t
+        if end > self.code_hi:
+            self.code_hi = end
+        return table
+
+    def index_switches(self, lo, hi):
+        """Index the tables of the SWITCHONs in [lo, hi) ahead of time."""
+        m = self.m
+        for pc in range(lo, hi):
+            op, d, _, t = self.dec[pc]
+            if op == F7_X and d == 23 and t < hi and t + 2 + 2 * m[t] <= hi:
+                self.switch_table(t)
+
+    # ========================================================================
+    # Superinstructions
+    # ========================================================================
+
+    def _is_cmp_jump(self, pc, hi):
+        """Check for a comparison followed by a T or F jump at pc."""
+        dec = self.dec
+        op1, d1, _, npc = dec[pc]
+        return (op1 == 7 and d1 in COMPARISONS and npc < hi
+                and dec[npc][0] in (4, 5))
+
+    def fuse(self, lo, hi, counted=False):
+        """Rewrite common instruction pairs in [lo, hi) as superinstructions.
+
+        The fused entry replaces the first instruction only, so a jump to the
+        second instruction still finds its own decoded entry.  With counted
+        set, the entries are marked so that interpret() counts their hits.
+        """
+        dec = self.dec
+        bias = OP_COUNTED if counted else 0
+        for pc in range(lo, hi):
+            op1, d1, _, npc = dec[pc]
+            if npc >= hi:
+                continue
+            op2, d2, _, npc2 = dec[npc]
+            if op1 == 7:
+                cmp = COMPARISONS.get(d1)
+                if cmp is None or (op2 != 4 and op2 != 5):
+                    continue
+                f = OP_CMP_T if op2 == 4 else OP_CMP_F
+                dec[pc] = (f + bias, cmp, d2, npc2)
+            else:
+                f = FUSIONS.get((op1, op2))
+                if f is None:
+                    continue
+                # A compare-and-jump saves more than loading into the compare
+                if op2 == 7 and self._is_cmp_jump(npc, hi):
+                    continue
+                # A store-first pair whose store lands in the code region
+                # restarts at its second instruction, which must be one word
+                # long for the interpreter to find it at next_pc - 1
+                if op1 == 17 and npc2 != npc + 1:
+                    continue
+                dec[pc] = (f + bias, d1, d2, npc2)
+            self.fusion_sites[f] += 1
+
+    def fusion_report(self):
+        """Return a text report of the superinstructions that fired."""
+        sites = self.fusion_sites
+        hits = self.fusion_hits
+        lines = ["SUPERINSTRUCTION      SITES        HITS"]
+        ops = sorted(FUSION_NAMES, key=lambda f: -hits[f])
+        for f in ops:
+            lines.append("%-16s %10d %11d" % (FUSION_NAMES[f], sites[f],
+                                              hits[f]))
+        return "\n".join(lines) + "\n"
+
+    # ========================================================================
+    # Block Compiler (JIT)
+    # ========================================================================
+
+    def mark_leaders(self, lo, hi):
+        """Wrap the loop heads and routine entries in [lo, hi) for counting.
+
+        Loop heads are the targets of backward J/T/F jumps.  Routine entries
+        are code addresses held in the global vector or loaded by L.
+        """
+        m = self.m
+        leaders = set()
+        for g in range(PROGSTART):
+            if lo <= m[g] < hi:
+                leaders.add(m[g])
+        for pc in range(lo, hi):
+            op, d, _, npc = self.decode(pc)
+            fn = op & 7
+            if (op & (FI_BIT | FP_BIT)) == 0:
+                if fn == F0_L or (fn in (F3_J, F4_T, F5_F) and d <= pc):
+                    leaders.add(d)
+        dec = self.dec
+        for pc in leaders:
+            if lo <= pc < hi:
+                dec[pc] = (OP_ENTRY, 0, dec[pc], pc)
+
+    def _region(self, entry):
+        """Find the code reachable from entry without leaving the routine.
+
+        Follows fall-through, direct J/T/F jumps, SWITCHON tables and the
+        return points after K.  Returns (insts, labels, words): the decoded
+        instructions by address, the addresses control can arrive at other
+        than by falling through, and every word the instructions were
+        decoded from.
+        """
+        m = self.m
+        hi = self.code_hi
+        insts = {}
+        labels = {entry}
+        words = set()
+        todo = [entry]
+        # Breadth first, so a large routine is cut off far from entry
+        for pc in todo:
+            if len(insts) == JIT_MAX_BLOCK:
+                break
+            if pc in insts or not PROGSTART <= pc < hi:
+                continue
+            op, d, _, npc = self.decode(pc)
+            fn = op & 7
+            direct = (op & (FI_BIT | FP_BIT)) == 0
+            insts[pc] = (op, d, npc)
+            words.update(range(pc, npc))
+            if fn in (F0_L, F1_S, F2_A):
+                todo.append(npc)
+            elif fn == F3_J:
+                if direct:
+                    labels.add(d)
+                    todo.append(d)
+            elif fn in (F4_T, F5_F):
+                labels.add(npc)
+                todo.append(npc)
+                if direct:
+                    labels.add(d)
+                    todo.append(d)
+            elif fn == F6_K:
+                labels.add(npc)
+                todo.append(npc)
+            elif op == F7_X and d in self.jit_xops:
+                todo.append(npc)
+            elif op == F7_X and d == 23:
+                cnt = m[npc]
+                if 0 <= cnt and npc + 2 + 2 * cnt <= hi:
+                    words.update(range(npc, npc + 2 + 2 * cnt))
+                    for t in [m[npc + 1]] + [m[npc + 3 + 2 * i]
+                                             for i in range(cnt)]:
+                        labels.add(t)
+                        todo.append(t)
+        return insts, labels & insts.keys(), words
+
+    def _stored(self, x, words):
+        """Invalidate after compiled code stored into code at x.
+
+        Returns True if the compiled function was built from word x.
+        """
+        self.invalidate(x, x + 1)
+        return x in words
+
+    def compile_block(self, entry):
+        """Compile the blocks reachable from entry and install them in dec.
+
+        The blocks become one function, each one guarded by a test on pc, so
+        jumps and loops between them stay inside the function.  K, RTN,
+        computed jumps, FINISH and stores into its own code return to the
+        interpreter.  Every block start is installed as an entry to the
+        function.  Returns False if the code cannot be compiled or is too
+        short to gain from it, in which case entry is left to the
+        interpreter.
+        """
+        insts, labels, words = self._region(entry)
+        if entry not in insts or not _enters(insts, entry):
+            return False
+        if len(insts) < JIT_MIN_BLOCK:
+            return False
+        m = self.m
+        blocks = {}
+        exits = set()
+        # The function's free names, bound as default arguments
+        ns = {"m": m, "vm": self, "invalidate": self.invalidate,
+              "stored": self._stored}
+
+        def emit(s, depth=0):
+            code.append("    " * depth + s)
+
+        def goto(target, here, depth=0):
+            # Forward jumps fall through the later pc tests; backward ones
+            # restart the chain, or leave for the interpreter to count the
+            # step when the run is limited
+            if target not in labels:
+                emit("return a, b, sp, %d" % target, depth)
+                exits.add(target)
+            elif target <= here and self.limited:
+                emit("return a, b, sp, %d" % target, depth)
+            else:
+                emit("pc = %d" % target, depth)
+                if target <= here:
+                    emit("continue", depth)
+
+        for label in labels:
+            code = blocks[label] = []
+            pc = label
+            while True:
+                op, d, npc = insts[pc]
+                fn = op & 7
+                direct = (op & (FI_BIT | FP_BIT)) == 0
+                if fn == F0_L:
+                    emit("b = a")
+                    emit("a = " + _operand(op, d))
+                elif fn == F1_S:
+                    emit("x = " + _address(op, d))
+                    emit("m[x] = a")
+                    emit("if vm.code_lo <= x < vm.code_hi and "
+                         "stored(x, words): return a, b, sp, %d" % npc)
+                elif fn == F2_A:
+                    emit("a = " + _signed_expr("a + " + _operand(op, d),
+                                               self.bits))
+                elif fn == F3_J:
+                    if direct:
+                        goto(d, label)
+                    else:
+                        emit("return a, b, sp, " + _operand(op, d))
+                    break
+                elif fn in (F4_T, F5_F):
+                    emit("if a != 0:" if fn == F4_T else "if a == 0:")
+                    if direct:
+                        goto(d, label, 1)
+                    else:
+                        emit("return a, b, sp, " + _operand(op, d), 1)
+                    emit("else:")
+                    goto(npc, label, 1)
+                    break
+                elif fn == F6_K:
+                    emit("if a < %d:" % PROGSTART)
+                    emit("return a, b, sp, %d" % pc, 1)
+                    emit("x = sp + " + _operand(op, d))
+                    emit("m[x] = sp")
+                    emit("m[x + 1] = %d" % npc)
+                    emit("if vm.code_lo <= x + 1 and x < vm.code_hi: "
+                         "invalidate(x, x + 2)")
+                    emit("return a, b, x, a")
+                    exits.add(npc)
+                    break
+                elif op == F7_X and d in self.jit_xops:
+                    for s in self.jit_xops[d]:
+                        emit(s)
+                elif op == F7_X and d == 4:
+                    emit("return a, b, m[sp], m[sp + 1]")
+                    break
+                elif op == F7_X and d == 23 and npc + 1 in words:
+                    cnt = m[npc]
+                    table = {}
+                    for i in range(cnt):
+                        table.setdefault(m[npc + 2 + 2 * i], m[npc + 3 + 2 * i])
+                    name = "switch%d" % len(ns)
+                    ns[name] = table
+                    # Targets outside the function drop out of the pc tests
+                    if self.limited:
+                        emit("return a, b, sp, %s.get(a, %d)"
+                             % (name, m[npc + 1]))
+                    else:
+                        emit("pc = %s.get(a, %d)" % (name, m[npc + 1]))
+                        emit("continue")
+                    break
                 else:
-                    return 0
-        else:  # mode == 'w'
-            f = open(fn, 'wb')
+                    # FINISH, unknown X operations and addressing modes on X
+                    # are left to the interpreter
+                    emit("return a, b, sp, %d" % pc)
+                    break
+                if npc in labels:
+                    goto(npc, label)
+                    break
+                if npc not in insts:
+                    emit("return a, b, sp, %d" % npc)
+                    exits.add(npc)
+                    break
+                pc = npc
+        ns["words"] = frozenset(words)
+        lines = ["def _block(a, b, sp, pc%s):"
+                 % "".join(", %s=%s" % (k, k) for k in ns),
+                 "    while True:"]
+        _place(lines, blocks, sorted(labels), "        ")
+        lines.append("        return a, b, sp, pc")
+        exec("\n".join(lines), ns)
+        fn = ns["_block"]
+        entries = [pc for pc in labels if _enters(insts, pc)]
+        for pc in entries:
+            self.dec[pc] = (OP_JIT, fn, 0, pc)
+        self.jit_blocks[entry] = (fn, entries, words)
+        for w in words:
+            self.jit_cover.setdefault(w, set()).add(entry)
+        # Code the function leaves to gets counted in turn
+        for pc in exits - labels:
+            entry = self.dec[pc]
+            if (self.code_lo <= pc < self.code_hi and entry is not None
+                    and entry[0] < OP_JIT):
+                self.dec[pc] = (OP_ENTRY, 0, entry, pc)
+        return True
+
+    def evict(self, lo, hi):
+        """Drop the compiled functions built from any word in [lo, hi)."""
+        for w in range(lo, hi):
+            entries = self.jit_cover.get(w)
+            if not entries:
+                continue
+            for entry in list(entries):
+                fn, starts, words = self.jit_blocks.pop(entry)
+                for v in words:
+                    self.jit_cover[v].discard(entry)
+                for pc in starts:
+                    if self.dec[pc][1] is fn:
+                        self.dec[pc] = (OP_DECODE, 0, 0, pc)
+
+    # ========================================================================
+    # String Handling
+    # ========================================================================
+
+    def getbytes(self, w_ptr, n):
+        """Return the first n bytes packed in the words from w_ptr on."""
+        words = self.m[w_ptr:w_ptr + -(-n // self.bytesperword)]
+        return words_to_bytes(words, self.typecode)[:n]
+
+    def cstr(self, s_ptr):
+        """Convert BCPL string (packed) to Python string.
         
-        handle = _next_handle
-        _next_handle += 1
-        _file_handles[handle] = f
-        return handle
-    except (FileNotFoundError, IOError):
-        return 0
-
-def findinput(fn_bcpl):
-    """Open a file for input."""
-    if isinstance(fn_bcpl, int):
-        fn = cstr(fn_bcpl)
-    else:
-        fn = fn_bcpl
-    return openfile(fn, 'r')
-
-def findoutput(fn_bcpl):
-    """Open a file for output."""
-    if isinstance(fn_bcpl, int):
-        fn = cstr(fn_bcpl)
-    else:
-        fn = fn_bcpl
-    return openfile(fn, 'w')
-
-def endread():
-    """Close the current input stream."""
-    global cis
-    if cis != sysin and cis in _file_handles:
-        _file_handles[cis].close()
-        del _file_handles[cis]
-    cis = sysin
-
-def endwrite():
-    """Close the current output stream."""
-    global cos
-    if cos != sysprint and cos in _file_handles:
-        _file_handles[cos].close()
-        del _file_handles[cos]
-    cos = sysprint
-
-def rdch():
-    """Read a character from the current input stream."""
-    if cis == sysin:
-        # Read from stdin
-        c = sys.stdin.buffer.read(1)
-        if not c:
-            return ENDSTREAMCH
-        c = c[0]
-    elif cis in _file_handles:
-        c = _file_handles[cis].read(1)
-        if not c:
-            return ENDSTREAMCH
-        c = c[0]
-    else:
-        return ENDSTREAMCH
-    
-    return ASC_LF if c == ASC_CR else c
-
-def wrch(c):
-    """Write a character to the current output stream."""
-    if c == ASC_LF:
-        newline()
-    else:
-        if cos == sysprint:
-            sys.stdout.buffer.write(bytes([c]))
-            sys.stdout.buffer.flush()
-        elif cos in _file_handles:
-            _file_handles[cos].write(bytes([c]))
-
-def newline():
-    """Write a newline to the current output stream."""
-    if cos == sysprint:
-        sys.stdout.write("\n")
-        sys.stdout.flush()
-    elif cos in _file_handles:
-        _file_handles[cos].write(b"\n")
-
-def writes(s_ptr):
-    """Write a BCPL string to the current output stream."""
-    byte_idx = s_ptr * 2
-    length = _get_byte(byte_idx)
-    for i in range(length):
-        wrch(_get_byte(byte_idx + 1 + i))
-
-def writed(n, d):
-    """Write a decimal number with field width d."""
-    s = str(abs(n))
-    if n < 0:
-        s = "-" + s
-    while len(s) < d:
-        s = " " + s
-    for c in s:
-        wrch(ord(c))
-
-def writen(n):
-    """Write a decimal number."""
-    writed(n, 0)
-
-def readn():
-    """Read a number from the current input stream."""
-    global m
-    c = rdch()
-    
-    # Skip whitespace
-    while c == ASC_SPACE or c == ASC_LF or c == ASC_TAB:
-        c = rdch()
-    
-    neg = (c == ASC_MINUS)
-    if neg or c == ASC_PLUS:
-        c = rdch()
-    
-    total = 0
-    while ASC_0 <= c <= ASC_9:
-        total = total * 10 + (c - ASC_0)
-        c = rdch()
-    
-    m[K71_TERMINATOR] = c
-    return -total if neg else total
-
-def writeoct(n, d):
-    """Write a number in octal with field width d."""
-    n = n & 0xFFFF  # Ensure unsigned
-    if d > 1:
-        writeoct(n >> 3, d - 1)
-    wrch(ord(STRDIGITS[n & 7]))
-
-def writehex(n, d):
-    """Write a number in hexadecimal with field width d."""
-    n = n & 0xFFFF  # Ensure unsigned
-    if d > 1:
-        writehex(n >> 4, d - 1)
-    wrch(ord(STRDIGITS[n & 15]))
-
-def writef(v_ptr):
-    """Formatted write using BCPL format string."""
-    fmt_ptr = m[v_ptr]
-    v_ptr += 1
-    
-    byte_idx = fmt_ptr * 2
-    length = _get_byte(byte_idx)
-    ss = 1
-    
-    while ss <= length:
-        c = _get_byte(byte_idx + ss)
-        ss += 1
+        BCPL strings are packed: length byte, then chars.
+        s_ptr is a word index in memory.
+        """
+        return self.strbytes(s_ptr).decode('latin-1')
+
+    def strbytes(self, s_ptr):
+        """Return the characters of the BCPL string at s_ptr as bytes."""
+        length = self._get_byte(s_ptr * self.bytesperword)
+        return self.getbytes(s_ptr, length + 1)[1:]
+
+    # ========================================================================
+    # File I/O
+    # ========================================================================
+
+    def openfile(self, fn, mode):
+        """Open a file and return a handle."""
+        
+        fn_upper = fn.upper()
+        if fn_upper == "SYSIN":
+            return self.sysin
+        if fn_upper == "SYSPRINT":
+            return self.sysprint
+        
+        try:
+            named = fn_upper in self.named_streams
+            if named:
+                f = self.named_streams[fn_upper]
+                fn = fn_upper
+            elif mode == 'r':
+                fn = findfile(fn)
+                if fn is None:
+                    return 0
+                f = open(fn, 'rb')
+            else:  # mode == 'w'
+                f = open(fn, 'wb')
+            if mode == 'w':
+                f = OutputBuffer(f)
         
-        if c != ASC_PERCENT:
-            wrch(c)
+            handle = self._next_handle
+            self._next_handle += 1
+            self._file_handles[handle] = f
+            self._file_names[handle] = (fn, mode, named)
+            return handle
+        except (FileNotFoundError, IOError):
+            return 0
+
+    def findinput(self, fn_bcpl):
+        """Open a file for input."""
+        if isinstance(fn_bcpl, int):
+            fn = self.cstr(fn_bcpl)
         else:
-            c = _get_byte(byte_idx + ss)
-            ss += 1
-            
-            if c == ASC_S:
-                writes(m[v_ptr])
-                v_ptr += 1
-            elif c == ASC_C:
-                wrch(m[v_ptr])
-                v_ptr += 1
-            elif c == ASC_O:
-                n = mu_get(v_ptr)
-                v_ptr += 1
-                d = decval(_get_byte(byte_idx + ss))
-                ss += 1
-                writeoct(n, d)
-            elif c == ASC_X:
-                n = mu_get(v_ptr)
-                v_ptr += 1
-                d = decval(_get_byte(byte_idx + ss))
-                ss += 1
-                writehex(n, d)
-            elif c == ASC_I:
-                n = m[v_ptr]
-                v_ptr += 1
-                d = decval(_get_byte(byte_idx + ss))
-                ss += 1
-                writed(n, d)
-            elif c == ASC_N:
-                writen(m[v_ptr])
-                v_ptr += 1
+            fn = fn_bcpl
+        return self.openfile(fn, 'r')
+
+    def findoutput(self, fn_bcpl):
+        """Open a file for output."""
+        if isinstance(fn_bcpl, int):
+            fn = self.cstr(fn_bcpl)
+        else:
+            fn = fn_bcpl
+        return self.openfile(fn, 'w')
+
+    def _close(self, handle):
+        """Close the stream behind handle.
+
+        Streams in named_streams belong to whoever registered them, so
+        output to them is only flushed.
+        """
+        f = self._file_handles.pop(handle)
+        self._file_names.pop(handle, None)
+        self._unread.pop(handle, None)
+        if isinstance(f, OutputBuffer):
+            self._output_closed += f.written + len(f.buf)
+        stream = getattr(f, 'stream', f)
+        if all(stream is not s for s in self.named_streams.values()):
+            f.close()
+        elif isinstance(f, OutputBuffer):
+            f.flush()
+
+    def endread(self):
+        """Close the current input stream."""
+        if self.cis != self.sysin and self.cis in self._file_handles:
+            self._close(self.cis)
+        self.cis = self.sysin
+
+    def endwrite(self):
+        """Close the current output stream."""
+        if self.cos != self.sysprint and self.cos in self._file_handles:
+            self._close(self.cos)
+        self.cos = self.sysprint
+
+    def closefiles(self):
+        """Close the files the program left open and flush SYSPRINT."""
+        for handle in list(self._file_handles):
+            if handle >= 10:
+                self._close(handle)
+        self.stdout.flush()
+
+    def rdch(self):
+        """Read a character from the current input stream."""
+        cis = self.cis
+        pending = self._unread.get(cis)
+        if pending:
+            c = pending.pop()
+        else:
+            f = self._file_handles.get(cis)
+            if f is None:
+                return ENDSTREAMCH
+            if cis == 1 and self._tty_input:
+                # Let a prompt be seen before waiting for the reply
+                out = self._file_handles.get(self.sysprint)
+                if out is not None:
+                    out.flush()
+            c = f.read(1)
+            if c is None:
+                raise InputPending()
+            if not c:
+                c = ENDSTREAMCH
             else:
-                wrch(c)
+                c = c[0]
+                if c == ASC_CR:
+                    c = ASC_LF
+        self._lastread = (cis, c)
+        return c
 
-def packstring(v_ptr, s_ptr):
-    """Pack a BCPL string from words to bytes."""
-    length = m[v_ptr]
-    n = length // BYTESPERWORD
-    
-    # Clear the word at s_ptr + n
-    m[s_ptr + n] = 0
-    
-    byte_dest = s_ptr * 2
-    
-    # Copy length + 1 items (length byte + chars)
-    for i in range(length + 1):
-        _set_byte(byte_dest + i, m[v_ptr + i] & 0xFF)
-    
-    return n
+    def unrdch(self):
+        """Give back the last character read, so rdch() reads it again."""
+        if self._lastread is not None and self._lastread[0] == self.cis:
+            self._unread.setdefault(self.cis, []).append(self._lastread[1])
+            self._lastread = None
 
-def unpackstring(s_ptr, v_ptr):
-    """Unpack a BCPL string from bytes to words."""
-    byte_src = s_ptr * 2
-    length = _get_byte(byte_src)
-    
-    for i in range(length + 1):
-        m[v_ptr + i] = _get_byte(byte_src + i)
+    def rewind(self):
+        """Start the current input stream again from the beginning."""
+        f = self._file_handles.get(self.cis)
+        self._unread.pop(self.cis, None)
+        self._lastread = None
+        if f is not None and getattr(f, 'seekable', lambda: False)():
+            f.seek(0)
 
-# ============================================================================
-# Assembler
-# ============================================================================
+    def wrch(self, c):
+        """Write a character to the current output stream."""
+        f = self._file_handles.get(self.cos)
+        if f is not None:
+            if self._output_room is not None:
+                if not self._output_room:
+                    self.limit_hit = "OUTPUT"
+                    return
+                self._output_room -= 1
+            f.putc(c & 0xFF)
 
-def stw(w):
-    """Store a word in memory."""
-    global lomem, cp
-    # Convert to signed 16-bit
-    w = w & 0xFFFF
-    if w >= 0x8000:
-        w -= 0x10000
-    m[lomem] = w
-    lomem += 1
-    cp = 0
-
-def stc(c):
-    """Store a character (byte) in memory."""
-    global lomem, cp
-    if cp == 0:
-        stw(0)
-    
-    byte_addr = (lomem - 1) * 2 + cp
-    _set_byte(byte_addr, c)
-    cp += 1
-    if cp == BYTESPERWORD:
-        cp = 0
+    def wrbytes(self, data):
+        """Write the bytes in data to the current output stream.
 
-def rch():
-    """Read a character for the assembler, skipping comments."""
-    global ch
-    ch = rdch()
-    while ch == ASC_SLASH:
-        while ch != ASC_LF and ch != ENDSTREAMCH:
-            ch = rdch()
-        while ch == ASC_LF:
-            ch = rdch()
-
-def rdn():
-    """Read a number for the assembler."""
-    global ch
-    total = 0
-    neg = (ch == ASC_MINUS)
-    if neg:
-        rch()
-    while ASC_0 <= ch <= ASC_9:
-        total = total * 10 + (ch - ASC_0)
-        rch()
-    return -total if neg else total
-
-def labref(n, a):
-    """Handle a label reference."""
-    k = m[labv_offset + n]
-    if k < 0:
-        k = -k  # Defined label address
-    else:
-        m[labv_offset + n] = a  # Add to chain
-    new_val = (m[a] + k) & 0xFFFF
-    if new_val >= 0x8000:
-        new_val -= 0x10000
-    m[a] = new_val
-
-def halt(msg, n=None):
-    """Print an error message and exit."""
-    global cos
-    cos = sysprint
-    if n is not None:
-        sys.stderr.write(f"{msg} #{n}\n")
-    else:
-        sys.stderr.write(f"{msg}\n")
-    sys.exit(1)
-
-def assemble():
-    """Assemble INTCODE from the current input stream."""
-    global cp, ch, lomem
-    
-    # Clear labels
-    for i in range(LABVCOUNT):
-        m[labv_offset + i] = 0
-    cp = 0
-    
-    rch()  # Read first character
-    
-    while True:
-        # Check for label definition (starts with digit)
-        if ASC_0 <= ch <= ASC_9:
-            n = rdn()
-            k = m[labv_offset + n]
-            if k < 0:
-                halt(STR_DUPLICATE_LABEL, n)
-            while k > 0:
-                tmp = m[k]
-                m[k] = lomem
-                k = tmp
-            m[labv_offset + n] = -lomem
-            cp = 0
-            continue
+        Under an output limit only what it allows is written, and the
+        limit is then reached.
+        """
+        f = self._file_handles.get(self.cos)
+        if f is not None:
+            if self._output_room is not None:
+                if len(data) > self._output_room:
+                    data = data[:self._output_room]
+                    self.limit_hit = "OUTPUT"
+                self._output_room -= len(data)
+            f.write(data)
+
+    def newline(self):
+        """Write a newline to the current output stream."""
+        self.wrch(ASC_LF)
+
+    def writes(self, s_ptr):
+        """Write a BCPL string to the current output stream."""
+        self.wrbytes(self.strbytes(s_ptr))
+
+    def writed(self, n, d):
+        """Write a decimal number with field width d."""
+        self.wrbytes(_decimal(n, d))
+
+    def writen(self, n):
+        """Write a decimal number."""
+        self.writed(n, 0)
+
+    def readn(self):
+        """Read a number from the current input stream.
+
+        If the input runs out of ready characters part way through, the
+        ones read are given back before InputPending is passed on, so the
+        number can be read again from the start.
+        """
+        taken = []
+
+        def rdch():
+            c = self.rdch()
+            taken.append(c)
+            return c
+
+        try:
+            c = rdch()
+
+            # Skip whitespace
+            while c == ASC_SPACE or c == ASC_LF or c == ASC_TAB:
+                c = rdch()
+
+            neg = (c == ASC_MINUS)
+            if neg or c == ASC_PLUS:
+                c = rdch()
+
+            total = 0
+            while ASC_0 <= c <= ASC_9:
+                total = total * 10 + (c - ASC_0)
+                c = rdch()
+        except InputPending:
+            self._unread.setdefault(self.cis, []).extend(reversed(taken))
+            self._lastread = None
+            raise
+
+        self.m[K71_TERMINATOR] = c
+        return -total if neg else total
+
+    def writeoct(self, n, d):
+        """Write a number in octal with field width d."""
+        self.wrbytes(_digits(n & self.mask, d, 3))
+
+    def writehex(self, n, d):
+        """Write a number in hexadecimal with field width d."""
+        self.wrbytes(_digits(n & self.mask, d, 4))
+
+    def writef(self, v_ptr):
+        """Formatted write using BCPL format string.
+
+        The whole result is built first and written in one go.
+        """
+        fmt_ptr = self.m[v_ptr]
+        v_ptr += 1
         
-        # Handle different instruction characters
-        if ch == ENDSTREAMCH:
-            return
+        length = self._get_byte(fmt_ptr * self.bytesperword)
+        # A % at the end reads on past the string, as it always has
+        fmt = self.getbytes(fmt_ptr, length + 3)
+        ss = 1
+        out = bytearray()
         
-        if ch in (ASC_DOLLAR, ASC_SPACE, ASC_LF):
-            rch()
-            continue
+        while ss <= length:
+            c = fmt[ss]
+            ss += 1
         
-        n = None
-        if ch == ASC_L:
-            n = F0_L
-        elif ch == ASC_S:
-            n = F1_S
-        elif ch == ord('A'):  # ASC_A
-            n = F2_A
-        elif ch == ASC_J:
-            n = F3_J
-        elif ch == ASC_T:
-            n = F4_T
-        elif ch == ASC_F:
-            n = F5_F
-        elif ch == ASC_K:
-            n = F6_K
-        elif ch == ASC_X:
-            n = F7_X
-        elif ch == ASC_C:
-            rch()
-            stc(rdn())
-            continue
-        elif ch == ASC_D:
-            rch()
-            if ch == ASC_L:
-                rch()
-                stw(0)
-                labref(rdn(), lomem - 1)
+            if c != ASC_PERCENT:
+                out.append(c)
             else:
-                stw(rdn())
-            continue
-        elif ch == ASC_G:
-            rch()
-            n = rdn()
-            if ch == ASC_L:
-                rch()
-            else:
-                halt(STR_BAD_CODE_AT_P, lomem)
-            m[n] = 0
-            labref(rdn(), n)
-            continue
-        elif ch == ASC_Z:
-            # Check for unset labels
-            for i in range(LABVCOUNT):
-                if m[labv_offset + i] > 0:
-                    halt(STR_UNSET_LABEL, i)
-            # Clear labels
-            for i in range(LABVCOUNT):
-                m[labv_offset + i] = 0
-            cp = 0
-            rch()
-            continue
-        else:
-            halt(STR_BAD_CH, ch)
+                c = fmt[ss]
+                ss += 1
+            
+                if c == ASC_S:
+                    out += self.strbytes(self.m[v_ptr])
+                    v_ptr += 1
+                elif c == ASC_C:
+                    out.append(self.m[v_ptr] & 0xFF)
+                    v_ptr += 1
+                elif c == ASC_O:
+                    n = self.mu_get(v_ptr)
+                    v_ptr += 1
+                    d = decval(fmt[ss])
+                    ss += 1
+                    out += _digits(n, d, 3)
+                elif c == ASC_X:
+                    n = self.mu_get(v_ptr)
+                    v_ptr += 1
+                    d = decval(fmt[ss])
+                    ss += 1
+                    out += _digits(n, d, 4)
+                elif c == ASC_I:
+                    n = self.m[v_ptr]
+                    v_ptr += 1
+                    d = decval(fmt[ss])
+                    ss += 1
+                    out += _decimal(n, d)
+                elif c == ASC_N:
+                    out += _decimal(self.m[v_ptr], 0)
+                    v_ptr += 1
+                else:
+                    out.append(c)
+        self.wrbytes(out)
+
+    def _check_string(self, ptr, n):
+        """Halt unless the n words from ptr on are all in memory."""
+        if not 0 <= ptr <= self.words - max(n, 1):
+            self.halt(STR_BAD_STRING, ptr)
+
+    def packstring(self, v_ptr, s_ptr):
+        """Pack a BCPL string from words to bytes."""
+        self._check_string(v_ptr, 1)
+        length = self.m[v_ptr]
+        bpw = self.bytesperword
+        n = length // bpw
+        self._check_string(v_ptr, length + 1)
+        self._check_string(s_ptr, n + 1)
         
-        # Process L, S, A, J, T, F, K, X instructions
-        rch()
-        if ch == ASC_I:
-            n |= FI_BIT
-            rch()
-        if ch == ASC_P:
-            n |= FP_BIT
-            rch()
-        if ch == ASC_G:
-            rch()
+        # The low bytes of the length + 1 words (length + chars), with
+        # the last word's spare bytes cleared
+        data = words_to_bytes(self.m[v_ptr:v_ptr + length + 1],
+                              self.typecode)[::bpw]
+        self.m[s_ptr:s_ptr + n + 1] = bytes_to_words(data, self.typecode)
+        self.invalidate(s_ptr, s_ptr + n + 1)
         
-        if ch == ASC_L:
-            rch()
-            stw(n | FD_BIT)
-            stw(0)
-            labref(rdn(), lomem - 1)
+        return n
+
+    def unpackstring(self, s_ptr, v_ptr):
+        """Unpack a BCPL string from bytes to words."""
+        self._check_string(s_ptr, 1)
+        length = self._get_byte(s_ptr * self.bytesperword)
+        self._check_string(s_ptr, length // self.bytesperword + 1)
+        self._check_string(v_ptr, length + 1)
+        self.m[v_ptr:v_ptr + length + 1] = self.getbytes(s_ptr, length + 1)
+        self.invalidate(v_ptr, v_ptr + length + 1)
+
+    # ========================================================================
+    # System Calls
+    # ========================================================================
+
+    # A K-code below PROGSTART is a call to the handler for it in kcalls,
+    # made as fn(machine, v) with v the address of the first argument.
+    # A handler's result, unless None, becomes the result of the call.
+
+    def register_kcall(self, code, fn):
+        """Make K-code code call fn(machine, v), a Python-native routine.
+
+        BCPL code reaches it through a global numbered code that the
+        program does not assign, e.g. GLOBAL $( STRCMP: 120 $).  fn reads
+        its arguments as machine.m[v], machine.m[v + 1], ..., and returns
+        the result as an integer (wrapped to a word) or None.  Codes of
+        the library routines can be registered too, replacing them, except
+        the ones in KCONTROL.
+        """
+        if not 0 < code < PROGSTART or code in KCONTROL:
+            raise ValueError("%s: %r" % (STR_BAD_KCALL, code))
+        signed = self.signed
+
+        def call(vm, v):
+            result = fn(vm, v)
+            return None if result is None else signed(result)
+        self.kcalls[code] = call
+
+    def _k_nothing(self, v):
+        pass
+
+    def _k_selectinput(self, v):
+        self.cis = self.m[v]
+
+    def _k_selectoutput(self, v):
+        self.cos = self.m[v]
+
+    def _k_rdch(self, v):
+        return self.rdch()
+
+    def _k_wrch(self, v):
+        self.wrch(self.m[v])
+
+    def _k_unrdch(self, v):
+        self.unrdch()
+
+    def _k_input(self, v):
+        return self.cis
+
+    def _k_output(self, v):
+        return self.cos
+
+    def _k_rewind(self, v):
+        self.rewind()
+
+    def _k_findoutput(self, v):
+        return self.findoutput(self.m[v])
+
+    def _k_findinput(self, v):
+        return self.findinput(self.m[v])
+
+    def _k_endread(self, v):
+        self.endread()
+
+    def _k_endwrite(self, v):
+        self.endwrite()
+
+    def _k_writes(self, v):
+        self.writes(self.m[v])
+
+    def _k_writen(self, v):
+        self.writen(self.m[v])
+
+    def _k_newline(self, v):
+        self.newline()
+
+    def _k_newpage(self, v):
+        self.wrch(ASC_FF)
+
+    def _k_writeo(self, v):
+        # All the octal digits of a word
+        self.writeoct(self.m[v], (self.bits + 2) // 3)
+
+    def _k_packstring(self, v):
+        return self.packstring(self.m[v], self.m[v + 1])
+
+    def _k_unpackstring(self, v):
+        self.unpackstring(self.m[v], self.m[v + 1])
+
+    def _k_writed(self, v):
+        self.writed(self.m[v], self.m[v + 1])
+
+    def _k_readn(self, v):
+        return self.readn()
+
+    def _k_writex(self, v):
+        # All the hexadecimal digits of a word
+        self.writehex(self.m[v], self.bits // 4)
+
+    def _k_writehex(self, v):
+        self.writehex(self.m[v], self.m[v + 1])
+
+    def _k_writef(self, v):
+        self.writef(v)
+
+    def _k_writeoct(self, v):
+        self.writeoct(self.m[v], self.m[v + 1])
+
+    def _k_mapstore(self, v):
+        self.mapstore(v - 2)
+
+    def _k_getbyte(self, v):
+        return self._get_byte(self.m[v] * self.bytesperword + self.m[v + 1])
+
+    def _k_putbyte(self, v):
+        self._set_byte(self.m[v] * self.bytesperword + self.m[v + 1],
+                       self.m[v + 2])
+
+    def _k_getvec(self, v):
+        return self.getvec(self.m[v], v + 1)
+
+    def _k_freevec(self, v):
+        self.freevec(self.m[v])
+
+    def _k_random(self, v):
+        return self.signed(self.m[v] * RANDOM_MULTIPLIER + RANDOM_INCREMENT)
+
+    def _k_muldiv(self, v):
+        return self.muldiv(self.m[v], self.m[v + 1], self.m[v + 2])
+
+    def _k_result2(self, v):
+        return self.result2
+
+    def _k_checkpoint(self, v, b, sp, pc):
+        # Called from interpret() with the registers, to carry on after
+        # the call with CHECKPOINT_RESTORED as its result
+        try:
+            self.checkpoint(self.cstr(self.m[v]),
+                            (CHECKPOINT_RESTORED, b, sp, pc))
+        except OSError:
+            return 0
+        return -1
+
+    def muldiv(self, a, b, c):
+        """Return a * b / c, computed without overflow.
+
+        The quotient is truncated towards zero, like X6, and the
+        remainder left in result2.  Dividing by zero gives 0.
+        """
+        if c == 0:
+            self.result2 = 0
+            return 0
+        ab = a * b
+        q = abs(ab) // abs(c)
+        if (ab < 0) != (c < 0):
+            q = -q
+        self.result2 = self.signed(ab - q * c)
+        return self.signed(q)
+
+    def mapstore(self, sp):
+        """Write a map of memory to the current output stream.
+
+        sp is the current stack frame.
+        """
+        self.wrbytes(("MEMORY  %d WORDS OF %d BITS\n"
+                      "PROGRAM %d TO %d\n"
+                      "STACK   %d TO %d\n"
+                      "HEAP    %d WORDS FROM %d, %d IN USE\n"
+                      % (self.words, self.bits, PROGSTART, self.lomem - 1,
+                         self.lomem, sp, self.words - self.heap_lo,
+                         self.heap_lo, self.heap_in_use)).encode())
+
+    KCALLS = {
+        K01_START: _k_nothing,
+        K03_ABORT: _k_nothing,
+        K04_BACKTRACE: _k_nothing,
+        K11_SELECTINPUT: _k_selectinput,
+        K12_SELECTOUTPUT: _k_selectoutput,
+        K13_RDCH: _k_rdch,
+        K14_WRCH: _k_wrch,
+        K15_UNRDCH: _k_unrdch,
+        K16_INPUT: _k_input,
+        K17_OUTPUT: _k_output,
+        K34_BINWRCH: _k_wrch,
+        K35_REWIND: _k_rewind,
+        K41_FINDOUTPUT: _k_findoutput,
+        K42_FINDINPUT: _k_findinput,
+        K46_ENDREAD: _k_endread,
+        K47_ENDWRITE: _k_endwrite,
+        K60_WRITES: _k_writes,
+        K62_WRITEN: _k_writen,
+        K63_NEWLINE: _k_newline,
+        K64_NEWPAGE: _k_newpage,
+        K65_WRITEO: _k_writeo,
+        K66_PACKSTRING: _k_packstring,
+        K67_UNPACKSTRING: _k_unpackstring,
+        K68_WRITED: _k_writed,
+        K69_WRITEARG: _k_writen,
+        K70_READN: _k_readn,
+        K74_WRITEX: _k_writex,
+        K75_WRITEHEX: _k_writehex,
+        K76_WRITEF: _k_writef,
+        K77_WRITEOCT: _k_writeoct,
+        K78_MAPSTORE: _k_mapstore,
+        K85_GETBYTE: _k_getbyte,
+        K86_PUTBYTE: _k_putbyte,
+        K87_GETVEC: _k_getvec,
+        K88_FREEVEC: _k_freevec,
+        K89_RANDOM: _k_random,
+        K90_MULDIV: _k_muldiv,
+        K91_RESULT2: _k_result2,
+    }
+
+    # ========================================================================
+    # Assembler
+    # ========================================================================
+
+    def stw(self, w):
+        """Store a word in memory."""
+        self.m[self.lomem] = self.signed(w)
+        self.lomem += 1
+
+    def halt(self, msg, n=None):
+        """Print an error message and exit."""
+        self.cos = self.sysprint
+        self.closefiles()
+        if n is not None:
+            sys.stderr.write(f"{msg} #{n}\n")
         else:
-            d = rdn()
-            if (d & FN_MASK) == d:
-                stw(n | (d << FN_BITS))
+            sys.stderr.write(f"{msg}\n")
+        sys.exit(1)
+
+    def assemble(self, text=None):
+        """Assemble INTCODE text, by default the rest of the current input.
+
+        The words go into a list, stored in memory at the end.  References
+        to a label not yet defined are listed by label and filled in when
+        it is, and a Z, ending a section, checks that none is left.
+        """
+        if text is None:
+            f = self._file_handles.get(self.cis)
+            text = (f.read() if f is not None else None) or b""
+        text = ASM_COMMENT.sub(b"", text.replace(b"\r", b"\n"))
+        m = self.m
+        start = self.lomem
+        code = []
+        labv = self.labv
+        labv[:] = [0] * LABVCOUNT
+        # By label, the references waiting for it: offsets in code, or ~g
+        # for global g
+        refs = [None] * LABVCOUNT
+        functions = ASM_FUNCTIONS
+        bytesperword = self.bytesperword
+        cp = 0
+
+        def ref(label, at):
+            # The address of label, or 0 until it is defined
+            k = labv[label]
+            if k < 0:
+                return -k
+            if refs[label] is None:
+                refs[label] = [at]
             else:
-                stw(n | FD_BIT)
-                stw(d)
+                refs[label].append(at)
+            return 0
 
-# ============================================================================
-# Interpreter
-# ============================================================================
+        for t in ASM_TOKEN.findall(text):
+            if t[0]:
+                # Instruction: function, I, P, L for a label, and number
+                n = functions[t[0]]
+                if t[1]:
+                    n |= FI_BIT
+                if t[2]:
+                    n |= FP_BIT
+                if t[3]:
+                    code.append(n | FD_BIT)
+                    code.append(ref(asm_number(t[4]), len(code)))
+                else:
+                    d = asm_number(t[4])
+                    if (d & FN_MASK) == d:
+                        code.append(n | (d << FN_BITS))
+                    else:
+                        code.append(n | FD_BIT)
+                        code.append(d)
+                cp = 0
+            elif t[5]:
+                n = int(t[5])
+                if labv[n] < 0:
+                    self.halt(STR_DUPLICATE_LABEL, n)
+                here = start + len(code)
+                labv[n] = -here
+                r = refs[n]
+                if r is not None:
+                    for a in r:
+                        if a >= 0:
+                            code[a] = here
+                        else:
+                            m[~a] = here
+                    refs[n] = None
+                cp = 0
+            elif t[6]:
+                if cp == 0:
+                    code.append(0)
+                shift = cp << 3
+                code[-1] = ((code[-1] & ~(0xFF << shift))
+                            | ((asm_number(t[7]) & 0xFF) << shift))
+                cp += 1
+                if cp == bytesperword:
+                    cp = 0
+            elif t[8]:
+                if t[9]:
+                    code.append(ref(asm_number(t[10]), len(code)))
+                else:
+                    code.append(asm_number(t[10]))
+                cp = 0
+            elif t[11]:
+                g = asm_number(t[12])
+                if not t[13]:
+                    self.halt(STR_BAD_CODE_AT_P, start + len(code))
+                m[g] = ref(asm_number(t[14]), ~g)
+                self.assembled_globals.add(g)
+            elif t[15]:
+                for i in range(LABVCOUNT):
+                    if refs[i]:
+                        self.halt(STR_UNSET_LABEL, i)
+                labv[:] = [0] * LABVCOUNT
+                refs[:] = [None] * LABVCOUNT
+                cp = 0
+            elif t[16]:
+                self.halt(STR_BAD_CH, t[16][0])
 
-def interpret():
-    """Execute INTCODE starting from PROGSTART.
-    
-    Optimized version with local variable caching for better performance.
-    """
-    global cis, cos
-    
-    # Cache globals locally for faster access
-    _m = m
-    
-    # Cache constants locally
-    _PROGSTART = PROGSTART
-    _FD_BIT = FD_BIT
-    _FP_BIT = FP_BIT
-    _FI_BIT = FI_BIT
-    _FN_BITS = FN_BITS
-    
-    pc = _PROGSTART
-    sp = lomem
-    a = 0
-    b = 0
-    
-    # Helper function to convert to signed 16-bit (inline for performance)
-    def _s16(val):
-        val = val & 0xFFFF
-        return val - 0x10000 if val >= 0x8000 else val
-    
-    while True:
-        # Fetch instruction (unsigned)
-        w = _m[pc] & 0xFFFF
-        pc += 1
+        end = start + len(code)
+        if end > self.words:
+            raise IndexError("assembled code does not fit in memory")
+        signed = self.signed
+        m[start:end] = [signed(w) for w in code]
+        self.lomem = end
+        self.invalidate(start, end)
+
+    # ========================================================================
+    # Memory Images
+    # ========================================================================
+
+    def readimage(self, path, digest):
+        """Load the image at path if it was built from the source with digest.
+
+        Returns False, leaving memory untouched, if there is no usable image.
+        """
+        try:
+            with open(path, 'rb') as f, \
+                    mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, \
+                    memoryview(mm) as mv:
+                (magic, source, bits, start, end,
+                 ng) = IMAGE_HEADER.unpack_from(mv)
+                off = IMAGE_HEADER.size
+                size = self.bytesperword
+                if (magic != IMAGE_MAGIC or source != digest
+                        or bits != self.bits or start != self.lomem
+                        or not start <= end <= self.words
+                        or len(mv) != off + size * (2 * ng + end - start)):
+                    return False
+                gv = array(self.typecode)
+                gv.frombytes(mv[off:off + size * 2 * ng])
+                words = array(self.typecode)
+                words.frombytes(mv[off + size * 2 * ng:])
+        except (OSError, ValueError, struct.error):
+            return False
+        if sys.byteorder == 'big':
+            gv.byteswap()
+            words.byteswap()
+        self.m[start:end] = words
+        for i in range(0, len(gv), 2):
+            self.m[gv[i]] = gv[i + 1]
+        self.lomem = end
+        return True
+
+    def writeimage(self, path, digest, start):
+        """Save m[start:lomem] and the globals assembled from digest at path."""
+        gv = array(self.typecode)
+        for n in sorted(self.assembled_globals):
+            gv.extend((n, self.m[n]))
+        words = array(self.typecode, self.m[start:self.lomem])
+        if sys.byteorder == 'big':
+            gv.byteswap()
+            words.byteswap()
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(IMAGE_HEADER.pack(IMAGE_MAGIC, digest, self.bits,
+                                          start, self.lomem, len(gv) // 2))
+                f.write(gv.tobytes())
+                f.write(words.tobytes())
+            os.replace(tmp, path)
+        except OSError:
+            # A read-only directory just means no cache
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+    # ========================================================================
+    # Checkpoints
+    # ========================================================================
+
+    # A checkpoint saves what the program can see: memory, the registers,
+    # the heap and the streams it has open, with their places in them.
+    # Everything else the interpreter keeps (decoded and compiled code,
+    # SWITCHON indexes) is rebuilt from memory when the restored run starts.
+    # SYSIN and SYSPRINT are those of the machine restoring it.
+
+    def checkpoint(self, path, regs=None):
+        """Save the state of the run at path, for restore().
+
+        regs are the registers (a, b, sp, pc) to carry on from, by default
+        those of the paused run.  Output is flushed first.  Raises OSError
+        if it cannot be written, and ValueError if no run is paused.
+        """
+        if regs is None:
+            regs = self._regs
+        if regs is None:
+            raise ValueError("no run to checkpoint")
+        streams = []
+        for handle, f in sorted(self._file_handles.items()):
+            if isinstance(f, OutputBuffer):
+                f.flush()
+            if handle not in self._file_names:
+                continue
+            stream = getattr(f, 'stream', f)
+            offset = -1
+            if getattr(stream, 'seekable', lambda: False)():
+                offset = stream.tell()
+            streams.append([handle, *self._file_names[handle], offset])
+        pending = self._pending[1] if self._pending is not None else 0
+        state = {"registers": list(regs),
+                 "pending": pending,
+                 "lomem": self.lomem,
+                 "streams": streams,
+                 "next_handle": self._next_handle,
+                 "selected": [self.cis, self.cos, self.sysin, self.sysprint],
+                 "unread": [[h, cs] for h, cs in self._unread.items() if cs],
+                 "lastread": self._lastread,
+                 "result2": self.result2,
+                 "heap": {"lo": self.heap_lo,
+                          "used": sorted(self.heap_used.items()),
+                          "free": sorted(self.heap_free.items()),
+                          "stats": [self.heap_in_use, self.heap_peak,
+                                    self.heap_peak_size, self.heap_allocs,
+                                    self.heap_frees]}}
+        data = json.dumps(state, separators=(',', ':')).encode()
+        words = array(self.typecode, self.m)
+        if sys.byteorder == 'big':
+            words.byteswap()
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(CHECKPOINT_HEADER.pack(CHECKPOINT_MAGIC, self.bits,
+                                               self.words, len(data)))
+                f.write(data)
+                f.write(words.tobytes())
+            os.replace(tmp, path)
+        except OSError:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+
+    def restore(self, path):
+        """Reset the machine to the checkpoint at path, ready for run().
+
+        The run carries on from where the checkpoint was saved, with the
+        files it had open opened again at the same place; output files are
+        cut back to it.  Raises OSError if the checkpoint or a file cannot
+        be opened, and ValueError if path is not a checkpoint of a machine
+        with this machine's memory.
+        """
+        try:
+            with open(path, 'rb') as f, \
+                    mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, \
+                    memoryview(mm) as mv:
+                magic, bits, words, n = CHECKPOINT_HEADER.unpack_from(mv)
+                off = CHECKPOINT_HEADER.size
+                if (magic != CHECKPOINT_MAGIC or bits != self.bits
+                        or words != self.words
+                        or len(mv) != off + n + words * self.bytesperword):
+                    raise ValueError("%s is not a checkpoint of %d words of "
+                                     "%d bits" % (path, self.words, self.bits))
+                state = json.loads(bytes(mv[off:off + n]))
+                m = array(self.typecode)
+                m.frombytes(mv[off + n:])
+        except struct.error:
+            raise ValueError("%s is not a checkpoint" % path) from None
+        if sys.byteorder == 'big':
+            m.byteswap()
+
+        self.reset()
+        self.m[:] = m
+        self.lomem = state["lomem"]
+        heap = state["heap"]
+        self.heap_lo = heap["lo"]
+        self.heap_used = {start: size for start, size in heap["used"]}
+        for start, size in heap["free"]:
+            self._add_free(start, size)
+        (self.heap_in_use, self.heap_peak, self.heap_peak_size,
+         self.heap_allocs, self.heap_frees) = heap["stats"]
+
+        for handle, fn, mode, named, offset in state["streams"]:
+            if named:
+                if fn not in self.named_streams:
+                    raise OSError("%s %s" % (STR_NO_INPUT if mode == 'r'
+                                             else STR_NO_OUTPUT, fn))
+                f = self.named_streams[fn]
+            else:
+                f = open(fn, 'rb' if mode == 'r' else 'r+b')
+            if offset >= 0:
+                f.seek(offset)
+                if mode == 'w':
+                    f.truncate()
+            if mode == 'w':
+                f = OutputBuffer(f)
+            self._file_handles[handle] = f
+            self._file_names[handle] = (fn, mode, named)
+        self._next_handle = state["next_handle"]
+        self.cis, self.cos, self.sysin, self.sysprint = state["selected"]
+        self._unread = {h: cs for h, cs in state["unread"]}
+        if state["lastread"] is not None:
+            self._lastread = tuple(state["lastread"])
+        self.result2 = state["result2"]
+
+        a, b, sp, pc = state["registers"]
+        self._restored = (a, b, sp, pc)
+        if state["pending"]:
+            # a is the K-code of the call waiting for input
+            self._pending = (self.kcalls[a], state["pending"])
+
+    # ========================================================================
+    # Run Limits
+    # ========================================================================
+
+    # Counting every instruction would slow every run, so the limits are
+    # counted in steps instead: a step is a routine call, a SWITCHON, or
+    # reaching a loop head (the target of a backward jump) or compiled
+    # code.  Any endless run takes endless steps, and between two steps only
+    # straight-line code runs.  The stack limit is checked at every step,
+    # the others every LIMIT_INTERVAL steps at most.  How many steps a
+    # program takes depends on how much of it the block compiler compiles.
+
+    def loop_heads(self, lo, hi):
+        """Return the targets in [lo, hi) of the backward J/T/F jumps."""
+        heads = set()
+        for pc in range(lo, hi):
+            op, d, _, _ = self.decode(pc)
+            if op in (F3_J, F4_T, F5_F) and lo <= d <= pc:
+                heads.add(d)
+        return heads
+
+    def output_bytes(self):
+        """Return the bytes the program has written to all its streams."""
+        n = self._output_closed - self._output_base
+        for f in self._file_handles.values():
+            if isinstance(f, OutputBuffer):
+                n += f.written + len(f.buf)
+        return n
+
+    def stack_max(self):
+        """Return the highest stack pointer allowed: STACK_MARGIN words
+        below the heap, and within the stack limit if there is one."""
+        top = self.heap_lo - STACK_MARGIN
+        if self.stack_limit:
+            top = min(top, self.lomem + self.stack_limit)
+        return top
+
+    def check_limits(self, left, sp):
+        """Count steps and check the run limits, with sp the stack pointer.
+
+        left is what is left of the steps allowed at the last check; it is
+        below 0 once they have all been taken.  Returns the steps allowed
+        until the next check, or -1 if a limit has been reached, which is
+        then named in limit_hit, or the quantum given to interpret() has
+        been used up.  A stack that has come too near the heap stops the
+        program with STACK OVERFLOW.  The output limit is not checked
+        here: wrch() and wrbytes() stop at it as they write.
+        """
+        if sp > self.heap_lo - STACK_MARGIN:
+            self.halt(STR_STACK_OVERFLOW, sp)
+        self.steps += self._allowed - left
+        self._depth = sp - self.lomem
+        if self.step_limit and self.steps > self.step_limit:
+            self.limit_hit = "STEPS"
+        elif self.stack_limit and self._depth > self.stack_limit:
+            self.limit_hit = "STACK"
+        elif (self.time_limit
+              and time.perf_counter() - self._started > self.time_limit):
+            self.limit_hit = "TIME"
+        if self.limit_hit or (self._slice_end
+                              and self.steps >= self._slice_end):
+            self._allowed = 0
+            return -1
+        allowed = LIMIT_INTERVAL
+        if self.step_limit:
+            allowed = min(allowed, self.step_limit - self.steps)
+        if self._slice_end:
+            allowed = min(allowed, self._slice_end - self.steps)
+        self._allowed = allowed
+        return allowed
+
+    def _finish(self, status, left):
+        """Count the last steps of a run that stopped with status."""
+        if self.limited:
+            self.steps += self._allowed - left
+            self._allowed = left
+        return status
+
+    def _pause(self, a, b, sp, pc):
+        """Stop at a step for a limit or the end of the quantum.
+
+        Returns LIMIT_STATUS for a limit, after saving a checkpoint if
+        checkpoint_file is set, otherwise saves the registers to carry on
+        from and returns None.
+        """
+        if self.limit_hit:
+            if self.checkpoint_file:
+                try:
+                    self.checkpoint(self.checkpoint_file, (a, b, sp, pc))
+                except OSError:
+                    self.halt(STR_NO_CHECKPOINT)
+            return LIMIT_STATUS
+        self._regs = (a, b, sp, pc)
+        return None
+
+    def _wait(self, call, v_ptr, left, a, b, sp, pc):
+        """Stop until the input the library call is reading is ready.
+
+        left is what is left of the steps allowed at the last check.
+        Saves the registers and the call, to make it again when resumed,
+        and returns None.
+        """
+        if self.limited:
+            self.steps += self._allowed - left
+            self._allowed = left
+        self._regs = (a, b, sp, pc)
+        self._pending = (call, v_ptr)
+        self.waiting = True
+        return None
+
+    def run_stats(self):
+        """Return the steps, output bytes, stack depth and seconds of the
+        last limited run.  The depth is the one seen at the last check."""
+        return {"steps": self.steps,
+                "output": self.output_bytes(),
+                "stack": self._depth,
+                "seconds": time.perf_counter() - self._started}
+
+    def limit_report(self):
+        """Return a text report of the limit that stopped the run."""
+        st = self.run_stats()
+        return ("%s LIMIT REACHED\nSTEPS %d, OUTPUT %d BYTES, "
+                "STACK %d WORDS, %.2f SECONDS\n"
+                % (self.limit_hit, st["steps"], st["output"], st["stack"],
+                   st["seconds"]))
+
+    # ========================================================================
+    # Interpreter
+    # ========================================================================
+
+    def interpret(self, quantum=0):
+        """Execute INTCODE starting from PROGSTART.
         
-        # Decode operand
-        if w & _FD_BIT:
-            d = _m[pc]
-            pc += 1
-        else:
-            d = w >> _FN_BITS
+        Optimized version with local variable caching for better performance.
+        Instructions are taken from the pre-decoded stream in dec rather than
+        being re-decoded from memory on every step.
+
+        Returns the exit code, or None if the program has not finished:
+        with quantum set it stops after about that many steps (see
+        check_limits()), and it stops with waiting set when it reads input
+        that is not ready (see InputPending).  Its registers are saved, and
+        the next call carries on from there.
+        """
+        
+        if self._regs is None:
+            self.predecode(PROGSTART, self.lomem)
+            self.index_switches(PROGSTART, self.lomem)
+            self._run_kcalls = self.kcalls
+            if self.profile:
+                self.profiler = Profiler(self)
+                self._run_kcalls = self.profiler.timed(self.kcalls)
+                for pc in range(PROGSTART, self.lomem):
+                    self.dec[pc] = (OP_PROFILE, 0, self.dec[pc], pc)
+            else:
+                self.fuse(PROGSTART, self.lomem, self.fusion_stats)
+            jit = self.jit_threshold and not self.profile
+            if jit:
+                self.mark_leaders(PROGSTART, self.lomem)
+            # Loop heads the block compiler leaves alone are wrapped in
+            # checks
+            self.limited = bool(self.step_limit or self.output_limit
+                                or self.stack_limit or self.time_limit
+                                or quantum)
+            self._heads = None
+            if self.limited:
+                self._heads = self.loop_heads(PROGSTART, self.lomem)
+                if not jit:
+                    for pc in self._heads:
+                        self.dec[pc] = (OP_CHECK, 0, self.dec[pc], pc)
+            self.steps = 0
+            self.limit_hit = None
+            self._started = time.perf_counter()
+            # Output is counted from here on
+            self._output_base = 0
+            self._output_base = self.output_bytes()
+            self._output_room = self.output_limit or None
+            self._regs = self._restored or (0, 0, self.lomem, PROGSTART)
+            self._restored = None
+        a, b, sp, pc = self._regs
+        self._regs = None
+        self.waiting = False
+        _kcalls = self._run_kcalls
+        _profile = self.profiler.step if self.profile else None
+        _heads = self._heads
+
+        # Run limits: _fuel counts down the steps allowed until the next
+        # check, and _sp_max is the highest stack pointer allowed, which
+        # moves with the heap
+        self._slice_end = self.steps + quantum if quantum else 0
+        self._allowed = 0
+        _fuel = sys.maxsize
+        _sp_max = self.stack_max()
+        if self.limited:
+            _fuel = self.check_limits(0, sp)
+            if _fuel < 0:
+                return self._pause(a, b, sp, pc)
+
+        # A library call left waiting for input is made again
+        if self._pending is not None:
+            call, v_ptr = self._pending
+            self._pending = None
+            try:
+                r = call(self, v_ptr)
+            except InputPending:
+                return self._wait(call, v_ptr, self._allowed, a, b, sp, pc)
+            if r is not None:
+                a = r
         
-        if w & _FP_BIT:
-            d = _s16(d + sp)
-        if w & _FI_BIT:
-            d = _m[d]
+        # Cache globals locally for faster access
+        _m = self.m
+        _dec = self.dec
+        _hits = self.fusion_hits
+        _compile = self.compile_block
+        _threshold = self.jit_threshold
+        _SLOT = len(_dec) - 1
+        _decode = self.decode
+        _invalidate = self.invalidate
+        _switches = self.switches
+        _switch_table = self.switch_table
+        _lo = self.code_lo
+        _hi = self.code_hi
+        _sw = self.signed
+        _MASK = self.mask
         
-        fn = w & 7  # F7_X = 7
+        # Cache constants locally
+        _PROGSTART = PROGSTART
+        _FP_BIT = FP_BIT
+        _FI_BIT = FI_BIT
         
-        if fn == 0:  # L - Load
-            b = a
-            a = d
-        elif fn == 1:  # S - Store
-            _m[d] = a
-        elif fn == 2:  # A - Add
-            a = _s16(a + d)
-        elif fn == 3:  # J - Jump
-            pc = d
-        elif fn == 4:  # T - True jump
-            if a != 0:
-                pc = d
-        elif fn == 5:  # F - False jump
-            if a == 0:
-                pc = d
-        elif fn == 6:  # K - Call
-            d = _s16(d + sp)
+        while True:
+            # Fetch the decoded instruction; pc moves to the next one
+            try:
+                op, d, e, pc = _dec[pc]
+            except TypeError:
+                # A word never decoded (None); pc is still its address
+                op = 32
+        
+            if op > 7:
+                if op < 32:
+                    # Addressing modes used by most compiled code get their own
+                    # branches; the rest resolve d and fall through
+                    if op == 24:  # LIP - Load indirect from P
+                        b = a
+                        a = _m[d + sp]
+                        continue
+                    if op == 8:  # LI - Load indirect
+                        b = a
+                        a = _m[d]
+                        continue
+                    if op == 17:  # SP - Store to P
+                        d += sp
+                        _m[d] = a
+                        if _lo <= d < _hi:
+                            _invalidate(d, d + 1)
+                        continue
+                    if op == 26:  # AIP - Add indirect from P
+                        a = _sw(a + _m[d + sp])
+                        continue
+                    if op == 10:  # AI - Add indirect
+                        a = _sw(a + _m[d])
+                        continue
+                    if op & _FP_BIT:
+                        d = _sw(d + sp)
+                    if op & _FI_BIT:
+                        d = _m[d]
+                    op &= 7
+                else:
+                    if op >= 64:
+                        if op == 96:  # OP_JIT - compiled block
+                            _fuel -= 1
+                            if _fuel < 0 or sp > _sp_max:
+                                _fuel = self.check_limits(_fuel, sp)
+                                if _fuel < 0:
+                                    return self._pause(a, b, sp, pc)
+                            a, b, sp, pc = d(a, b, sp, pc)
+                            continue
+                        if op == 97:  # OP_ENTRY - e is the entry it wraps
+                            if d + 1 < _threshold:
+                                _dec[pc] = (97, d + 1, e, pc)
+                            elif _compile(pc):
+                                continue
+                            elif _heads is not None and pc in _heads:
+                                _dec[pc] = (99, 0, e, pc)
+                            else:
+                                _dec[pc] = e
+                            _fuel -= 1
+                            if _fuel < 0 or sp > _sp_max:
+                                _fuel = self.check_limits(_fuel, sp)
+                                if _fuel < 0:
+                                    return self._pause(a, b, sp, pc)
+                            # Run the wrapped entry from the spare slot
+                            _dec[_SLOT] = e
+                            pc = _SLOT
+                            continue
+                        if op == 98:  # OP_PROFILE - e is the entry it wraps
+                            _profile(pc, sp)
+                            _dec[_SLOT] = e
+                            pc = _SLOT
+                            continue
+                        if op == 99:  # OP_CHECK - e is the entry it wraps
+                            _fuel -= 1
+                            if _fuel < 0 or sp > _sp_max:
+                                _fuel = self.check_limits(_fuel, sp)
+                                if _fuel < 0:
+                                    return self._pause(a, b, sp, pc)
+                            _dec[_SLOT] = e
+                            pc = _SLOT
+                            continue
+                        # Counted superinstruction (fusion report mode)
+                        op -= 32
+                        _hits[op] += 1
+                    if op == 40:  # SP;LIP
+                        d += sp
+                        _m[d] = a
+                        if _lo <= d < _hi:
+                            _invalidate(d, d + 1)
+                            pc -= 1
+                            continue
+                        b = a
+                        a = _m[e + sp]
+                        continue
+                    elif op == 41:  # SP;LI
+                        d += sp
+                        _m[d] = a
+                        if _lo <= d < _hi:
+                            _invalidate(d, d + 1)
+                            pc -= 1
+                            continue
+                        b = a
+                        a = _m[e]
+                        continue
+                    elif op == 49:  # LIP;X
+                        b = a
+                        a = _m[d + sp]
+                        d = e
+                        op = 7
+                    elif op == 50:  # LI;K
+                        b = a
+                        a = _m[d]
+                        d = e
+                        op = 6
+                    elif op == 51:  # X(cmp);F
+                        if d(b, a):
+                            a = -1
+                        else:
+                            a = 0
+                            pc = e
+                        continue
+                    elif op == 43:  # LIP;SP
+                        b = a
+                        a = _m[d + sp]
+                        e += sp
+                        _m[e] = a
+                        if _lo <= e < _hi:
+                            _invalidate(e, e + 1)
+                        continue
+                    elif op == 52:  # X(cmp);T
+                        if d(b, a):
+                            a = -1
+                            pc = e
+                        else:
+                            a = 0
+                        continue
+                    elif op == 48:  # LI;X
+                        b = a
+                        a = _m[d]
+                        d = e
+                        op = 7
+                    elif op == 42:  # SP;L
+                        d += sp
+                        _m[d] = a
+                        if _lo <= d < _hi:
+                            _invalidate(d, d + 1)
+                            pc -= 1
+                            continue
+                        b = a
+                        a = e
+                        continue
+                    elif op == 44:  # LI;SP
+                        b = a
+                        a = _m[d]
+                        e += sp
+                        _m[e] = a
+                        if _lo <= e < _hi:
+                            _invalidate(e, e + 1)
+                        continue
+                    elif op == 47:  # L;X
+                        b = a
+                        a = d
+                        d = e
+                        op = 7
+                    elif op == 45:  # L;SP
+                        b = a
+                        a = d
+                        e += sp
+                        _m[e] = a
+                        if _lo <= e < _hi:
+                            _invalidate(e, e + 1)
+                        continue
+                    elif op == 46:  # LIP;AIP
+                        b = a
+                        a = _sw(_m[d + sp] + _m[e + sp])
+                        continue
+                    else:  # OP_DECODE
+                        # pc is the address of the word itself here
+                        _dec[pc] = _decode(pc)
+                        if _profile is not None:
+                            _dec[pc] = (98, 0, _dec[pc], pc)
+                        if _heads is not None and pc in _heads:
+                            _dec[pc] = (99, 0, _dec[pc], pc)
+                        if pc < _lo:
+                            _lo = self.code_lo = pc
+                        if pc + 2 > _hi:
+                            _hi = self.code_hi = pc + 2
+                        continue
+        
+            if op == 0:  # L - Load
+                b = a
+                a = d
+            elif op == 6:  # K - Call
+                d = _sw(d + sp)
             
-            if a < _PROGSTART:
-                v_ptr = d + 2
-                
-                # System calls (K-codes)
-                if a == 1:  # K01_START
-                    pass
-                elif a == 2:  # K02_SETPM
-                    _m[sp] = 0
-                    _m[sp + 1] = _PROGSTART + 2
+                if a < _PROGSTART:
+                    v_ptr = d + 2
+                    call = _kcalls.get(a)
+                    if call is not None:
+                        try:
+                            r = call(self, v_ptr)
+                        except InputPending:
+                            return self._wait(call, v_ptr, _fuel,
+                                              a, b, sp, pc)
+                        if r is not None:
+                            a = r
+                        # GETVEC and FREEVEC move the heap
+                        _sp_max = self.stack_max()
+                        # Output stops at its limit as it is written
+                        if self.limit_hit:
+                            self._finish(None, _fuel)
+                            return self._pause(a, b, sp, pc)
+                    # System calls that change the registers (KCONTROL)
+                    elif a == 2:  # K02_SETPM
+                        _m[sp] = 0
+                        _m[sp + 1] = _PROGSTART + 2
+                        if _lo <= sp + 1 and sp < _hi:
+                            _invalidate(sp, sp + 2)
+                        pc = a
+                    elif a == 30:  # K30_STOP
+                        return self._finish(_m[v_ptr], _fuel)
+                    elif a == 31:  # K31_LEVEL
+                        a = sp
+                    elif a == 32:  # K32_LONGJUMP
+                        sp = _m[v_ptr]
+                        pc = _m[v_ptr + 1]
+                    elif a == 40:  # K40_APTOVEC
+                        b = d + _m[v_ptr + 1] + 1
+                        _m[b] = sp
+                        _m[b + 1] = pc
+                        _m[b + 2] = d
+                        _m[b + 3] = _m[v_ptr + 1]
+                        if _lo <= b + 3 and b < _hi:
+                            _invalidate(b, b + 4)
+                        sp = b
+                        pc = _m[v_ptr]
+                    elif a == 92:  # K92_CHECKPOINT
+                        a = self._k_checkpoint(v_ptr, b, sp, pc)
+                    else:
+                        self.halt(STR_UNKNOWN_CALL, a)
+                else:
+                    _m[d] = sp
+                    _m[d + 1] = pc
+                    if _lo <= d + 1 and d < _hi:
+                        _invalidate(d, d + 2)
+                    sp = d
                     pc = a
-                elif a == 3 or a == 4:  # K03_ABORT, K04_BACKTRACE
-                    pass
-                elif a == 11:  # K11_SELECTINPUT
-                    cis = _m[v_ptr]
-                elif a == 12:  # K12_SELECTOUTPUT
-                    cos = _m[v_ptr]
-                elif a == 13:  # K13_RDCH
-                    a = rdch()
-                elif a == 14:  # K14_WRCH
-                    wrch(_m[v_ptr])
-                elif a == 16:  # K16_INPUT
-                    a = cis
-                elif a == 17:  # K17_OUTPUT
-                    a = cos
-                elif a == 30:  # K30_STOP
-                    return _m[v_ptr]
-                elif a == 31:  # K31_LEVEL
-                    a = sp
-                elif a == 32:  # K32_LONGJUMP
-                    sp = _m[v_ptr]
-                    pc = _m[v_ptr + 1]
-                elif a == 40:  # K40_APTOVEC
-                    b = d + _m[v_ptr + 1] + 1
-                    _m[b] = sp
-                    _m[b + 1] = pc
-                    _m[b + 2] = d
-                    _m[b + 3] = _m[v_ptr + 1]
-                    sp = b
-                    pc = _m[v_ptr]
-                elif a == 41:  # K41_FINDOUTPUT
-                    a = findoutput(_m[v_ptr])
-                elif a == 42:  # K42_FINDINPUT
-                    a = findinput(_m[v_ptr])
-                elif a == 46:  # K46_ENDREAD
-                    endread()
-                elif a == 47:  # K47_ENDWRITE
-                    endwrite()
-                elif a == 60:  # K60_WRITES
-                    writes(_m[v_ptr])
-                elif a == 62:  # K62_WRITEN
-                    writen(_m[v_ptr])
-                elif a == 63:  # K63_NEWLINE
-                    newline()
-                elif a == 64:  # K64_NEWPAGE
-                    wrch(12)  # ASC_FF
-                elif a == 66:  # K66_PACKSTRING
-                    a = packstring(_m[v_ptr], _m[v_ptr + 1])
-                elif a == 67:  # K67_UNPACKSTRING
-                    unpackstring(_m[v_ptr], _m[v_ptr + 1])
-                elif a == 68:  # K68_WRITED
-                    writed(_m[v_ptr], _m[v_ptr + 1])
-                elif a == 70:  # K70_READN
-                    a = readn()
-                elif a == 75:  # K75_WRITEHEX
-                    writehex(_m[v_ptr] & 0xFFFF, _m[v_ptr + 1])
-                elif a == 77:  # K77_WRITEOCT
-                    writeoct(_m[v_ptr] & 0xFFFF, _m[v_ptr + 1])
-                elif a == 76:  # K76_WRITEF
-                    writef(v_ptr)
-                elif a == 85:  # K85_GETBYTE
-                    base = _m[v_ptr] * 2
-                    offset = _m[v_ptr + 1]
-                    a = _get_byte(base + offset)
-                elif a == 86:  # K86_PUTBYTE
-                    base = _m[v_ptr] * 2
-                    offset = _m[v_ptr + 1]
-                    _set_byte(base + offset, _m[v_ptr + 2])
+                    _fuel -= 1
+                    if _fuel < 0 or sp > _sp_max:
+                        _fuel = self.check_limits(_fuel, sp)
+                        if _fuel < 0:
+                            return self._pause(a, b, sp, pc)
+        
+            elif op == 7:  # X - Execute
+                if d == 1:
+                    a = _m[a]
+                elif d == 2:
+                    a = _sw(-a)
+                elif d == 3:
+                    a = _sw(~a)
+                elif d == 4:
+                    pc = _m[sp + 1]
+                    sp = _m[sp]
+                elif d == 5:
+                    a = _sw(b * a)
+                elif d == 6:
+                    if a != 0:
+                        # Integer division like C
+                        sign = -1 if (b < 0) != (a < 0) else 1
+                        a = sign * (abs(b) // abs(a))
+                elif d == 7:
+                    if a != 0:
+                        # Modulo like C (sign follows dividend)
+                        if b < 0:
+                            a = -(abs(b) % abs(a))
+                        else:
+                            a = abs(b) % abs(a)
+                elif d == 8:
+                    a = _sw(b + a)
+                elif d == 9:
+                    a = _sw(b - a)
+                elif d == 10:
+                    a = -1 if (b == a) else 0
+                elif d == 11:
+                    a = -1 if (b != a) else 0
+                elif d == 12:
+                    a = -1 if (b < a) else 0
+                elif d == 13:
+                    a = -1 if (b >= a) else 0
+                elif d == 14:
+                    a = -1 if (b > a) else 0
+                elif d == 15:
+                    a = -1 if (b <= a) else 0  # LE
+                elif d == 16:
+                    a = _sw(b << a)   # LSH
+                elif d == 17:
+                    # Logical right shift (unsigned)
+                    a = _sw((b & _MASK) >> a)  # RSH
+                elif d == 18:
+                    a = _sw(b & a)    # AND
+                elif d == 19:
+                    a = _sw(b | a)    # OR
+                elif d == 20:
+                    a = _sw(b ^ a)    # XOR
+                elif d == 21:
+                    a = _sw(b ^ ~a)   # EQV
+                elif d == 22:
+                    return self._finish(0, _fuel)  # FINISH
+                elif d == 23:
+                    # SWITCHON - the table at pc, indexed when first used.
+                    # It may jump backward, so it is a step.
+                    table = _switches.get(pc)
+                    if table is None:
+                        table = _switch_table(pc)
+                        _lo = self.code_lo
+                        _hi = self.code_hi
+                    pc = table[0].get(a, table[1])
+                    _fuel -= 1
+                    if _fuel < 0 or sp > _sp_max:
+                        _fuel = self.check_limits(_fuel, sp)
+                        if _fuel < 0:
+                            return self._pause(a, b, sp, pc)
                 else:
-                    halt(STR_UNKNOWN_CALL, a)
-            else:
-                _m[d] = sp
-                _m[d + 1] = pc
-                sp = d
-                pc = a
+                    self.halt(STR_UNKNOWN_EXEC, d)
         
-        elif fn == 7:  # X - Execute
-            if d == 1:
-                a = _m[a]
-            elif d == 2:
-                a = _s16(-a)
-            elif d == 3:
-                a = _s16(~a)
-            elif d == 4:
-                pc = _m[sp + 1]
-                sp = _m[sp]
-            elif d == 5:
-                a = _s16(b * a)
-            elif d == 6:
-                if a != 0:
-                    # Integer division like C
-                    sign = -1 if (b < 0) != (a < 0) else 1
-                    a = sign * (abs(b) // abs(a))
-            elif d == 7:
+            elif op == 5:  # F - False jump
+                if a == 0:
+                    pc = d
+            elif op == 1:  # S - Store
+                _m[d] = a
+                if _lo <= d < _hi:
+                    _invalidate(d, d + 1)
+            elif op == 3:  # J - Jump
+                pc = d
+            elif op == 4:  # T - True jump
                 if a != 0:
-                    # Modulo like C (sign follows dividend)
-                    if b < 0:
-                        a = -(abs(b) % abs(a))
-                    else:
-                        a = abs(b) % abs(a)
-            elif d == 8:
-                a = _s16(b + a)
-            elif d == 9:
-                a = _s16(b - a)
-            elif d == 10:
-                a = -1 if (b == a) else 0
-            elif d == 11:
-                a = -1 if (b != a) else 0
-            elif d == 12:
-                a = -1 if (b < a) else 0
-            elif d == 13:
-                a = -1 if (b >= a) else 0
-            elif d == 14:
-                a = -1 if (b > a) else 0
-            elif d == 15:
-                a = -1 if (b <= a) else 0  # LE
-            elif d == 16:
-                a = _s16(b << a)   # LSH
-            elif d == 17:
-                # Logical right shift (unsigned)
-                a = _s16((b & 0xFFFF) >> a)  # RSH
-            elif d == 18:
-                a = _s16(b & a)    # AND
-            elif d == 19:
-                a = _s16(b | a)    # OR
-            elif d == 20:
-                a = _s16(b ^ a)    # XOR
-            elif d == 21:
-                a = _s16(b ^ ~a)   # EQV
-            elif d == 22:
-                return 0  # FINISH
-            elif d == 23:
-                # SWITCHON
-                v_idx = pc
-                cnt = _m[v_idx]
-                v_idx += 1
-                pc = _m[v_idx]
-                v_idx += 1
-                
-                while cnt > 0:
-                    if a == _m[v_idx]:
-                        pc = _m[v_idx + 1]
-                        break
-                    v_idx += 2
-                    cnt -= 1
-            else:
-                halt(STR_UNKNOWN_EXEC, d)
-
-def loadcode(fn):
-    """Load and assemble INTCODE from a file."""
-    global cis
-    f = findinput(fn)
-    if f:
-        cis = f
-        assemble()
-        endread()
-    return f
-
-def init():
-    """Initialize the interpreter."""
-    global lomem, cis, cos, sysin, sysprint
-    
-    # Initialize global vector
-    for i in range(PROGSTART):
-        m[i] = i
-    lomem = PROGSTART
-    
-    # Store initial code
-    stw(F0_L | FI_BIT | (K01_START << FN_BITS))
-    stw(F6_K | (2 << FN_BITS))
-    stw(F7_X | (22 << FN_BITS))
-    
-    # Set up stdin/stdout
-    # stdin = 1, stdout = 2 (1-based, like the C/JS version)
-    cis = sysin = 1
-    cos = sysprint = 2
-    
-    # Register stdin and stdout in file handles
-    _file_handles[1] = sys.stdin
-    _file_handles[2] = sys.stdout
-
-def pipeinput(fn):
-    """Set up piped input from a file."""
-    global cis, sysin
-    f = openfile(fn, 'r')
-    if not f:
-        halt(STR_NO_INPUT)
-    cis = sysin = f
-
-def pipeoutput(fn):
-    """Set up piped output to a file."""
-    global cos, sysprint
-    f = openfile(fn, 'w')
-    if not f:
-        halt(STR_NO_OUTPUT)
-    cos = sysprint = f
+                    pc = d
+            elif op == 2:  # A - Add
+                a = _sw(a + d)
+
+    def load(self, fn):
+        """Load and assemble INTCODE from a file.
+
+        The file's memory image is used instead when it is up to date, and
+        written after assembling when it is not.
+        """
+        f = self.findinput(fn)
+        if not f:
+            return f
+        self.cis = f
+        path = None
+        text = None
+        if self.image_cache and f != self.sysin:
+            source = self._file_handles[f]
+            text = source.read()
+            digest = hashlib.sha1(text).digest()
+            path = source.name + IMAGE_SUFFIX
+            if self.readimage(path, digest):
+                self.endread()
+                return f
+        start = self.lomem
+        self.assembled_globals.clear()
+        self.assemble(text)
+        self.endread()
+        if path:
+            self.writeimage(path, digest, start)
+        return f
+
+    def run(self):
+        """Run the loaded program and return its exit code.
+
+        Files the program left open are closed, and SYSPRINT flushed,
+        however it stops.
+        """
+        return self.run_slice()
+
+    def run_slice(self, quantum=0):
+        """Run the loaded program for about quantum steps, or to the end.
+
+        Returns its exit code, or None if it has not finished, having used
+        up the quantum or waiting for input (see interpret()); the next
+        call carries on.  SYSPRINT is flushed either way, and once the
+        program stops, however it stops, the files it left open are closed.
+        """
+        try:
+            status = self.interpret(quantum)
+        except BaseException:
+            self.closefiles()
+            raise
+        if status is None:
+            self.stdout.flush()
+        else:
+            self.closefiles()
+        return status
+
+    def pipeinput(self, fn):
+        """Set up piped input from a file."""
+        f = self.openfile(fn, 'r')
+        if not f:
+            self.halt(STR_NO_INPUT)
+        self.cis = self.sysin = f
+
+    def pipeoutput(self, fn):
+        """Set up piped output to a file."""
+        f = self.openfile(fn, 'w')
+        if not f:
+            self.halt(STR_NO_OUTPUT)
+        self.cos = self.sysprint = f
+
+def limit_option(arg):
+    """Return (Machine attribute, value) for a run limit option.
+
+    arg is one of LIMIT_OPTIONS with its value, e.g. --max-time=2.5.
+    Raises ValueError if the value is not a number of the right kind, or
+    is negative.
+    """
+    option, _, value = arg.partition('=')
+    value = float(value) if option == '--max-time' else int(value)
+    if value < 0:
+        raise ValueError("%s must not be negative" % option)
+    return LIMIT_OPTIONS[option], value
 
 def main():
     """Main entry point."""
-    init()
-    
     args = sys.argv[1:]
     if not args:
         print(STR_USAGE)
         sys.exit(0)
     
+    # Memory options apply to the whole run, wherever they appear; a
+    # restored run has the memory of its checkpoint
+    words = WORDCOUNT
+    bits = WORDBITS
+    for arg in args:
+        if arg[:2] in ('-m', '-w') and arg[2:].isdigit():
+            if arg[1] == 'm':
+                words = int(arg[2:])
+            else:
+                bits = int(arg[2:])
+        elif arg.startswith('--restore='):
+            try:
+                words, bits = checkpoint_shape(arg[len('--restore='):])
+            except (OSError, ValueError):
+                sys.stderr.write(STR_NO_CHECKPOINT + "\n")
+                sys.exit(1)
+    try:
+        vm = Machine(words=words, bits=bits)
+    except ValueError:
+        sys.stderr.write(STR_INVALID_OPTION + "\n")
+        sys.exit(1)
+    heap_report = False
+    profile_file = None
     for arg in args:
         if arg.startswith('-'):
-            if arg.startswith('-i'):
-                pipeinput(arg[2:])
+            if arg[:2] in ('-m', '-w') and arg[2:].isdigit():
+                pass
+            elif arg.startswith('-i'):
+                vm.pipeinput(arg[2:])
             elif arg.startswith('-o'):
-                pipeoutput(arg[2:])
+                vm.pipeoutput(arg[2:])
+            elif arg == '-f':
+                vm.fusion_stats = True
+            elif arg.startswith('-t') and arg[2:].isdigit():
+                vm.jit_threshold = int(arg[2:])
+            elif arg == '-l':
+                vm._file_handles[vm.sysprint].lines = True
+            elif arg == '-g':
+                heap_report = True
+            elif arg == '--profile' or arg.startswith('--profile='):
+                vm.profile = True
+                profile_file = arg[len('--profile='):] or PROFILE_FILE
+            elif arg.startswith('--checkpoint=') and len(arg) > 13:
+                vm.checkpoint_file = arg[len('--checkpoint='):]
+            elif arg.startswith('--restore='):
+                try:
+                    vm.restore(arg[len('--restore='):])
+                except (OSError, ValueError):
+                    vm.halt(STR_NO_CHECKPOINT)
+            elif arg.split('=')[0] in LIMIT_OPTIONS:
+                try:
+                    setattr(vm, *limit_option(arg))
+                except ValueError:
+                    vm.halt(STR_INVALID_OPTION)
             else:
-                halt(STR_INVALID_OPTION)
+                vm.halt(STR_INVALID_OPTION)
         else:
-            if not loadcode(arg):
-                halt(STR_NO_ICFILE)
+            if not vm.load(arg):
+                vm.halt(STR_NO_ICFILE)
     
-    result = interpret()
+    result = vm.run()
+    if vm.limit_hit:
+        sys.stderr.write(vm.limit_report())
+        if vm.checkpoint_file:
+            sys.stderr.write("CHECKPOINT SAVED TO %s\n" % vm.checkpoint_file)
+    if vm.fusion_stats:
+        sys.stderr.write(vm.fusion_report())
+    if heap_report:
+        sys.stderr.write(vm.heap_report())
+    if vm.profile:
+        sys.stderr.write(vm.profiler.report())
+        with open(profile_file, 'w') as f:
+            f.write(vm.profiler.collapsed())
     sys.exit(result)
 
 if __name__ == "__main__":
@@ -0,0 +1,19 @@
+// Two sections whose label numbers are the same, the second with a
+// jump to a jump: the optimizer must keep each section's labels apart
+GET "LIBHDR"
+GLOBAL $( CHECK:200 $)
+LET START() BE
+$( FOR I = 1 TO 3 DO
+   $( IF I = 1 THEN WRITES("ONE ")
+      IF I = 2 THEN WRITES("TWO ")
+      IF I = 3 THEN WRITES("THREE ")
+      CHECK(I) $)
+   NEWLINE() $)
+.
+GET "LIBHDR"
+GLOBAL $( CHECK:200 $)
+LET CHECK(N) BE
+$( TEST N > 1 THEN
+   $( IF N = 2 THEN WRITES("TWO")
+   $) ELSE WRITES("ONE")
+   WRCH('*S') $)